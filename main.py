@@ -1,38 +1,633 @@
 # main.py
+import io
 import os
 import random
 import asyncio
-from typing import Dict, List, Optional, Tuple
+import bisect
+import hashlib
+import heapq
+import json
+import mmap
+import sqlite3
+import struct
+import subprocess
+import sys
+import functools
+import concurrent.futures
+import itertools
+import time
+import traceback
+import weakref
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 import discord
 from discord.ext import commands
 from discord import app_commands
-from PIL import Image
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps
+
+try:
+    import numpy as np      # 任意：/chi_odds のモンテカルロモードでのみ使用
+except ImportError:
+    np = None
 
 # ================== 基本設定 ==================
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-INTENTS = discord.Intents.default()
-INTENTS.guilds = True
-INTENTS.members = True
+# 実行プロファイル
+#   default : 従来どおり（members インテント・既定のキャッシュ）
+#   lean    : ゲームに要るものだけ。メンバー/メッセージはキャッシュせず、名前は必要なときに取りに行く
+RUNTIME_PROFILE = os.getenv("CHI_PROFILE", "default")
+FORCE_COMMAND_SYNC = os.getenv("CHI_FORCE_SYNC", "0") == "1"   # コマンド定義が同じでも同期する
+
+def _make_intents(profile: str) -> discord.Intents:
+    if profile == "lean":
+        intents = discord.Intents.none()
+        intents.guilds = True       # チャンネル/スレッドの解決に必要
+        return intents
+    intents = discord.Intents.default()
+    intents.guilds = True
+    intents.members = True
+    return intents
+
+def _client_options(profile: str) -> dict:
+    if profile == "lean":
+        return {
+            "member_cache_flags": discord.MemberCacheFlags.none(),
+            "max_messages": None,
+            "chunk_guilds_at_startup": False,
+        }
+    return {}
+
+INTENTS = _make_intents(RUNTIME_PROFILE)
+
+# シャーディング
+#   off     : 従来どおり1プロセス1接続
+#   auto    : AutoShardedBot。CHI_SHARD_IDS を指定するとそのシャードだけを受け持つ
+#   cluster : 起動プロセスはシャードを CHI_CLUSTER_PROCS 個に分けて子プロセス（auto）を立てるだけ
+SHARD_MODE = os.getenv("CHI_SHARD_MODE", "off")
+SHARD_COUNT = int(os.getenv("CHI_SHARD_COUNT", "0"))        # 0 = Discord推奨数（auto のみ）
+SHARD_IDS = os.getenv("CHI_SHARD_IDS", "")                  # 例 "0-3" / "0,2"。空なら全シャード
+PROCESS_TAG = f"s{SHARD_IDS.replace(',', '_')}" if SHARD_IDS else "main"   # 共有ファイル/テーブルでこのプロセスの分を区別する名前
+CLUSTER_PROCS = int(os.getenv("CHI_CLUSTER_PROCS", "2"))
+SHARD_REPORT_INTERVAL = 30.0                                # シャード状況を共有ストアに書く間隔（秒）
+
+def parse_shard_ids(spec: str) -> Optional[List[int]]:
+    ids: List[int] = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        lo, _, hi = part.partition("-")
+        ids.extend(range(int(lo), int(hi or lo) + 1))
+    return ids or None
+
+def shard_for_guild(guild_id: Optional[int], shard_count: int) -> int:
+    """ Discordのシャード割り当て式。DM（guild なし）はシャード0 """
+    if not guild_id or shard_count <= 1:
+        return 0
+    return (guild_id >> 22) % shard_count
+
+class MeteredTree(app_commands.CommandTree):
+    """ スラッシュコマンドの開始時刻を interaction.extras に刻む（完了時に on_app_command_completion で計測） """
+    async def interaction_check(self, inter: discord.Interaction) -> bool:
+        inter.extras["t0"] = time.perf_counter()
+        return True
+
+    async def on_error(self, inter: discord.Interaction, error: app_commands.AppCommandError):
+        METRICS.inc("handler_errors", command=inter.command.name if inter.command else "?")
+        await super().on_error(inter, error)
+
+def _make_bot() -> commands.Bot:
+    if SHARD_MODE == "auto":
+        return commands.AutoShardedBot(
+            command_prefix="!", intents=INTENTS, tree_cls=MeteredTree,
+            shard_count=SHARD_COUNT or None, shard_ids=parse_shard_ids(SHARD_IDS),
+            **_client_options(RUNTIME_PROFILE),
+        )
+    return commands.Bot(command_prefix="!", intents=INTENTS, tree_cls=MeteredTree, **_client_options(RUNTIME_PROFILE))
 
-bot = commands.Bot(command_prefix="!", intents=INTENTS)
+bot = _make_bot()
 tree = bot.tree
 
 # ================== 可変設定 ==================
-DICE_ASSET_DIR = "assets/dice"  # dice_1.png … dice_6.png を置くフォルダ
+DICE_ASSET_DIR = "assets/dice"  # dice_1.png … dice_6.png を置くフォルダ（テーマ "classic"）
+DICE_THEMES_DIR = os.getenv("CHI_DICE_THEMES_DIR", "assets/dice_themes")  # <テーマ名>/dice_1.png … を置くとテーマとして選べる
+DICE_THEME_DEFAULT = os.getenv("CHI_DICE_THEME", "classic")              # 卓にもサーバーにも指定が無いときのテーマ
+# 素材を置かなくても選べる色替えテーマ（classic から作る）。"invert" は明暗反転、(R,G,B) はその色を掛ける
+DICE_THEME_RECOLORS = {"noir": "invert", "sakura": (255, 188, 208), "gold": (240, 196, 80)}
+ANIM_SCALES = (0.94, 1.0)       # ロールアニメでサイコロが脈打つ大きさ（コマごとに順に使う）
+ANIM_JITTER = (-1, 0, 1)        # ロールアニメの縦揺れ(px)
 ROLL_ANIM_FRAMES = 12           # アニメコマ数
 ROLL_ANIM_MS = 90               # 1コマms（≈11fps）
 COMPOSITE_GAP = 16              # 合成PNGでのサイコロ間隔
-DELETE_ANIM_AFTER_RESULT = True
+DELETE_ANIM_AFTER_RESULT = True  # classic 表示のみ
+# ロールの見せ方
+#   single      : アニメを1通投稿し、止まったらそのメッセージを結果画像と役に差し替える（削除なし）
+#   interaction : ROLLボタンの付いた手番メッセージ自体をアニメ→結果に差し替える（新規投稿なし）
+#   classic     : アニメ投稿 → 文言編集 → 結果画像を別投稿 → アニメ削除（従来）
+ROLL_PRESENTATION = os.getenv("CHI_ROLL_PRESENTATION", "single")
+ROLL_MIN_ANIM_SECONDS = 0.0     # アニメ投稿から結果に差し替えるまでの最短時間（0=結果が揃い次第すぐ）
+PARENT_DECISION_BATCHED = True  # 親決めを全員同時ロール＋1枚のグリッド画像で行う（False で1人ずつ）
+GRID_DIE_SIZE = 96              # グリッド画像でのサイコロ1個の大きさ(px)
+GRID_MAX_ROWS = 20              # グリッド画像に描く人数の上限（超えた分は省いて「+N」。親になった人の行は必ず描く）
+ANIM_POOL_SIZE = 8              # 事前生成しておくロールアニメの本数
+ANIM_POOL_DIR = os.getenv("CHI_ANIM_POOL_DIR", "")  # 指定するとプールをディスクに保存し、再起動時に読み込む
+
+# 描画ワーカー
+RENDER_WORKERS = int(os.getenv("CHI_RENDER_WORKERS", "2"))
+RENDER_EXECUTOR = os.getenv("CHI_RENDER_EXECUTOR", "thread")   # "thread" or "process"
+RENDER_QUEUE_MAX = int(os.getenv("CHI_RENDER_QUEUE_MAX", "32"))  # 同時に抱える描画ジョブの上限
+
+# 結果画像キャッシュ
+COMPOSITE_CACHE_MAX_BYTES = int(os.getenv("CHI_COMPOSITE_CACHE_MAX_BYTES", "0"))  # 0=無制限、>0でLRU追い出し
+COMPOSITE_PREWARM = os.getenv("CHI_COMPOSITE_PREWARM", "0") == "1"                # 起動時に216通りを全て生成
+
+# ロールアニメのエンコード
+ANIM_FORMAT = os.getenv("CHI_ANIM_FORMAT", "auto")             # "auto"（使えればWEBP）/ "webp" / "gif"
+ANIM_WEBP_QUALITY = int(os.getenv("CHI_ANIM_QUALITY", "75"))   # WEBP（非可逆）の品質 0-100
+ANIM_WEBP_ALPHA_QUALITY = 50                                   # 透過チャンネルの品質。100だと透過部分だけでサイズが3倍になる
+ANIM_WEBP_METHOD = 2                                           # libwebp の圧縮の手間 0-6（この素材では2が速さ/サイズの釣り合いが良い）
+ANIM_WEBP_LOSSLESS = os.getenv("CHI_ANIM_LOSSLESS", "0") == "1"
+ANIM_GIF_COLORS = 32                                           # GIF の共通パレット色数
+ANIM_BYTE_BUDGET = int(os.getenv("CHI_ANIM_BYTE_BUDGET", "0")) # >0 ならこのバイト数に収まるまで品質/色数/コマ数を落とす
+ANIM_MATTE = (49, 51, 56)                                      # GIF の背景色（Discordのダークテーマ）。差分コマにするため不透明にする
+
+# 役ごとの配当倍率（rank -> 倍率）。ルール違いはここを書き換える
+#   例：シゴロ2倍・ゾロ目3倍・ヒフミ2倍払い → {5: 2, 4: 3, 3: 1, 2: 1, 1: 2}
+HAND_PAYOUT = {5: 1, 4: 1, 3: 1, 2: 1, 1: 1}
+MAX_TRIES = 3                   # 1手番で振れる最大回数
+# 出目の乱数。指定するとこの文字列と卓・ラウンドから seed を決める（シミュレータ/ベンチの再現用。本番では空）
+RNG_SEED = os.getenv("CHI_RNG_SEED", "")
+RNG_BLOCKS = 8                  # 出目用のバイト列を SHA-256 何ブロックぶんずつまとめて作るか
 
 # ベットUI
 BET_STEP = 100
 MAX_BET = 1_000_000
+BET_PANEL_EDIT_INTERVAL = 1.0   # ベットパネルを編集する最短間隔（秒）。連打はこの間隔にまとめる
+
+# 卓アクター
+TABLE_QUEUE_MAX = 64            # 1卓あたりの操作キュー上限（溢れた操作は断る）
+
+# 送信スケジューラ（チャンネル単位の送信/編集/削除）。Discord のチャンネル別上限の見積もり：BURST 回 / PER 秒
+OUTBOUND_BURST = int(os.getenv("CHI_OUTBOUND_BURST", "5"))     # 0 でバケットを使わない（優先順と計測だけ）
+OUTBOUND_PER = float(os.getenv("CHI_OUTBOUND_PER", "5.0"))
+# 手番・結果・精算（urgent）だけが使える別枠。使い切ったら共通の枠から借りるので、混んだら先に削られるのは cosmetic
+OUTBOUND_URGENT_BURST = int(os.getenv("CHI_OUTBOUND_URGENT_BURST", str(OUTBOUND_BURST)))
+OUTBOUND_SHED_BELOW = 2.0           # バケットの残りがこれ未満なら見た目だけの呼び出しを出さない
+OUTBOUND_COSMETIC_MAX_WAIT = 1.5    # 見た目だけの呼び出しがこれ以上（秒）待たされたら出さない（遅れたアニメは意味がない）
+
+# 締切（秒）。操作があるたびに延長。0で無効
+TURN_TIMEOUT = float(os.getenv("CHI_TURN_TIMEOUT", "120"))     # ROLL/STOP の手番 → 自動STOP（未ロールなら役なし）
+BET_TIMEOUT = float(os.getenv("CHI_BET_TIMEOUT", "600"))       # ベット受付 → 締め切って親の手番へ
+LOBBY_TIMEOUT = float(os.getenv("CHI_LOBBY_TIMEOUT", "3600"))  # 放置ロビー → 閉じる
+TIMER_TICK = 1.0                # タイマーホイールの1目盛り（秒）
+TIMER_SLOTS = 512               # タイマーホイールの目盛り数（1周 = TICK × SLOTS 秒。超える締切は周回数で持つ）
+
+# メモリ上の卓
+TABLE_IDLE_TTL = float(os.getenv("CHI_TABLE_IDLE_TTL", "1800"))  # 最後の操作からこの秒数でメモリから外す（ストアには残る）
+TABLE_MAX_LIVE = int(os.getenv("CHI_TABLE_MAX_LIVE", "2000"))    # メモリに置く卓の上限。超えたら使われていない順に外す
+TABLE_SWEEP_INTERVAL = 60.0
+READY_THREADS = os.getenv("CHI_READY_THREADS", "auto")           # /chi_ready で卓をスレッドに作るか：auto（既に卓があれば）/ always / never
+
+# 状態の永続化（SQLite / WAL）。空文字なら永続化しない
+GAME_DB_PATH = os.getenv("CHI_GAME_DB", "chinchiro.db")
+
+# 出目・精算の追記ログ（/chi_stats の集計元）。空文字なら記録しない
+ROLL_LOG_DIR = os.getenv("CHI_ROLL_LOG_DIR", "chinchiro_rolls")
+ROLL_LOG_SEGMENT_RECORDS = int(os.getenv("CHI_ROLL_LOG_SEGMENT", str(1 << 18)))  # 1ファイルのレコード数（48B × 262144 ≈ 12MB を先に確保）
+STATS_TOP_N = 10                # /chi_stats のランキング表示人数
+STATS_RECENT = 5                # /chi_stats で出す直近のロール数
 
 # サーバー通貨ボット向け送金テンプレ
 # {payer} 支払側, {payee} 受取側（いずれもメンション文字列）, {amount} 金額
 TRANSFER_TEMPLATE = "!pay {payer} {payee} {amount}"
+SETTLE_EVERY_ROUNDS = 1         # 何ラウンドごとに相殺した精算を出すか
+
+# 精算の配送（アウトボックス）。ゲームは積むだけで先へ進み、裏で配送先へ届ける
+SETTLE_SINKS = os.getenv("CHI_SETTLE_SINKS", "chat")            # カンマ区切り：chat（送金コマンド文を投稿）/ webhook / jsonl
+SETTLE_WEBHOOK_URL = os.getenv("CHI_SETTLE_WEBHOOK_URL", "")    # webhook の POST 先（JSON）
+SETTLE_JSONL_PATH = os.getenv("CHI_SETTLE_JSONL", "settlements.jsonl")
+OUTBOX_BATCH = 100              # 1回に取り出す件数
+OUTBOX_POLL_INTERVAL = 2.0      # 再送待ちを見に行く間隔（秒）。新しい精算が積まれたらすぐ起きる
+OUTBOX_RETRY_BASE = 2.0         # 再送までの待ち：base × 2^(失敗回数-1)（上限 OUTBOX_RETRY_MAX、半分〜等倍のゆらぎ）
+OUTBOX_RETRY_MAX = 300.0
+OUTBOX_MAX_ATTEMPTS = 12        # これだけ失敗したら諦める（dead。/chi_status に出る）
+OUTBOX_SEND_TIMEOUT = 10.0      # 配送1回の制限時間（秒）
+OUTBOX_KEEP_SECONDS = 7 * 86400 # 届いた行を残しておく期間
+MESSAGE_LIMIT = 2000            # Discordの1メッセージ文字数上限
+
+# メトリクス
+METRICS_SAMPLE_RATE = float(os.getenv("CHI_METRICS_SAMPLE", "1.0"))  # 時間計測する割合（0で計測しない。回数は常に数える）
+METRICS_PORT = int(os.getenv("CHI_METRICS_PORT", "0"))               # >0 で 127.0.0.1:port/metrics に Prometheus 形式で出す
+METRICS_FILE = os.getenv("CHI_METRICS_FILE", "")                     # 指定すると同じ内容を定期的にファイルへ書く
+METRICS_FILE_INTERVAL = 15.0
+
+# ================== メトリクス ==================
+# 秒。Discord の REST 往復〜描画まで収まるように 1ms〜10s
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """ 固定バケットのヒストグラム。observe は bisect 1回と加算だけ """
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """ バケット境界での近似（該当バケットの上端） """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return METRIC_BUCKETS[i] if i < len(METRIC_BUCKETS) else float("inf")
+        return float("inf")
+
+class _Timer:
+    __slots__ = ("hist", "t0")
+
+    def __init__(self, hist: Optional[Histogram]):
+        self.hist = hist
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.hist is not None:
+            self.hist.observe(time.perf_counter() - self.t0)
+        return False
+
+class Metrics:
+    """
+    ラベル付きのカウンタとヒストグラム。ラベルはタプルでそのまま辞書キーにする。
+    カウンタは常に数え、時間計測は sample_rate の割合だけ行う（全負荷でも負担を小さくするため）。
+    """
+    def __init__(self, sample_rate: float = METRICS_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], int] = defaultdict(int)
+        self.hists: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self.gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Callable[[], float]] = {}
+        self.started_at = time.time()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or (self.sample_rate > 0.0 and random.random() < self.sample_rate)
+
+    def inc(self, name: str, n: int = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += n
+
+    def hist(self, name: str, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        h = self.hists.get(key)
+        if h is None:
+            h = self.hists[key] = Histogram()
+        return h
+
+    def observe(self, name: str, seconds: float, **labels):
+        if self.sampled():
+            self.hist(name, **labels).observe(seconds)
+
+    def gauge(self, name: str, fn: Callable[[], float], **labels):
+        """ 出力のたびに fn() を読む値（滞留件数など）。reset では消さない """
+        self.gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def _gauge_values(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        out = []
+        for (name, labels), fn in sorted(self.gauges.items()):
+            try:
+                out.append((name, labels, float(fn())))
+            except Exception as e:      # 読めない値は出さない（DB が閉じている等）
+                print("Metrics gauge error:", name, e)
+        return out
+
+    def timer(self, name: str, **labels) -> _Timer:
+        """ with METRICS.timer(...) で囲んだ区間を計測する。サンプル外なら何もしない """
+        return _Timer(self.hist(name, **labels) if self.sampled() else None)
+
+    def reset(self):
+        self.counters.clear()
+        self.hists.clear()
+        self.started_at = time.time()
+
+    # --- 出力
+    def summary_lines(self, top: int = 8) -> List[str]:
+        """ /chi_metrics 用：ヒストグラムは件数の多い順に p50/p99、カウンタは名前ごとの合計と上位ラベル """
+        lines = [f"計測開始から {time.time() - self.started_at:.0f}秒 / サンプリング {self.sample_rate:g}"]
+        ms = lambda v: "∞" if v == float("inf") else f"{v * 1000:.0f}ms"
+        for (name, labels), h in sorted(self.hists.items(), key=lambda kv: -kv[1].count)[:top * 2]:
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            lines.append(f"⏱ {name}{{{label}}} n={h.count} avg {ms(h.total / h.count if h.count else 0)}"
+                         f" p50≤{ms(h.quantile(0.5))} p99≤{ms(h.quantile(0.99))}")
+        for name, labels, v in self._gauge_values():
+            label = ",".join(f"{k}={lv}" for k, lv in labels)
+            lines.append(f"📏 {name}{{{label}}} {v:g}")
+        totals: Dict[str, int] = defaultdict(int)
+        by_name: Dict[str, List[Tuple[int, str]]] = defaultdict(list)
+        for (name, labels), v in self.counters.items():
+            totals[name] += v
+            by_name[name].append((v, ",".join(f"{k}={lv}" for k, lv in labels)))
+        for name in sorted(totals):
+            tops = "、".join(f"{lv}:{v}" for v, lv in sorted(by_name[name], reverse=True)[:top])
+            lines.append(f"# {name} 合計 {totals[name]}（{tops}）")
+        return lines
+
+    def prometheus_text(self) -> str:
+        def fmt(labels, extra=()) -> str:
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in items) + "}"
+        out: List[str] = []
+        seen = set()
+        for (name, labels), v in sorted(self.counters.items()):
+            if name not in seen:
+                out.append(f"# TYPE chi_{name}_total counter")
+                seen.add(name)
+            out.append(f"chi_{name}_total{fmt(labels)} {v}")
+        for (name, labels), h in sorted(self.hists.items(), key=lambda kv: kv[0]):
+            if name not in seen:
+                out.append(f"# TYPE chi_{name} histogram")
+                seen.add(name)
+            acc = 0
+            for bound, c in zip(METRIC_BUCKETS, h.counts):
+                acc += c
+                out.append(f"chi_{name}_bucket{fmt(labels, [('le', bound)])} {acc}")
+            out.append(f"chi_{name}_bucket{fmt(labels, [('le', '+Inf')])} {h.count}")
+            out.append(f"chi_{name}_sum{fmt(labels)} {h.total:.6f}")
+            out.append(f"chi_{name}_count{fmt(labels)} {h.count}")
+        for name, labels, v in self._gauge_values():
+            if name not in seen:
+                out.append(f"# TYPE chi_{name} gauge")
+                seen.add(name)
+            out.append(f"chi_{name}{fmt(labels)} {v:g}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """ 最小限の HTTP：どのパスでも Prometheus テキストを返す """
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = METRICS.prometheus_text().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int = METRICS_PORT) -> Optional[asyncio.AbstractServer]:
+    if port <= 0:
+        return None
+    server = METRICS.server = await asyncio.start_server(_serve_metrics, "127.0.0.1", port)
+    print(f"メトリクス：http://127.0.0.1:{port}/metrics")
+    return server
+
+async def metrics_file_loop(path: str = METRICS_FILE, interval: float = METRICS_FILE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(METRICS.prometheus_text())
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Metrics file error:", e)
+
+# ================== 送信スケジューラ ==================
+PRIO_URGENT, PRIO_PANEL, PRIO_COSMETIC = 0, 1, 2      # 手番・結果・精算 / ロビー・ベットパネル / ロールアニメ・「止まりました」・アニメ削除
+PRIO_NAMES = ("urgent", "panel", "cosmetic")
+_INTERACTION_KINDS = ("followup", "edit_original")   # インタラクションのトークンは別枠の上限なので並べない
+
+class Shed(Exception):
+    """ 混んでいたので見た目だけの呼び出し（cosmetic）を出さなかった """
+
+class _Outbound:
+    __slots__ = ("priority", "seq", "kind", "channel_id", "coro", "future", "enqueued_at", "collapse")
+
+    def __init__(self, priority: int, seq: int, kind: str, channel_id: int, coro: Awaitable, collapse):
+        self.priority = priority
+        self.seq = seq
+        self.kind = kind
+        self.channel_id = channel_id
+        self.coro = coro
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+        self.collapse = collapse
+
+    def __lt__(self, other: "_Outbound") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class ChannelLane:
+    """ 1チャンネルぶんの待ち行列（優先度順のヒープ）とトークンバケット（共通の枠と urgent 専用の枠） """
+    __slots__ = ("heap", "pending", "tokens", "urgent", "stamp", "task", "wake")
+
+    def __init__(self, burst: int, urgent_burst: int):
+        self.heap: List[_Outbound] = []
+        self.pending: Dict[tuple, _Outbound] = {}      # まとめられる呼び出し（同じメッセージへの編集）
+        self.tokens = float(burst)
+        self.urgent = float(urgent_burst)
+        self.stamp = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.wake = asyncio.Event()     # 枠の戻りを待っている間に urgent が来たら起こす
+
+class OutboundScheduler:
+    """
+    チャンネル単位の REST 呼び出し（送信・編集・削除・スレッド作成）をチャンネルごとの優先度つきの列に並べ、
+    トークンバケット（Discord のチャンネル別上限の見積もり：burst 回 / per 秒）に合わせて送り出す。
+    - 残りが少ないときに先に出すのは urgent → panel → cosmetic の順（同じ優先度なら積んだ順）
+    - urgent には専用の枠（urgent_burst 回 / per 秒）があり、使い切ったときだけ共通の枠から借りる
+    - cosmetic は、バケットの残りが shed_below 未満か max_wait 秒以上待ったら出さずに Shed を投げる
+      （アニメを省いて結果だけ出す、など呼び出し側で縮退する）
+    - まだ出ていない同じメッセージへの同じ項目の編集は、最後の内容1回にまとめる
+    burst=0 ならバケットを使わない（順番と待ち時間の計測だけ）。
+    """
+    def __init__(self, burst: int = OUTBOUND_BURST, per: float = OUTBOUND_PER,
+                 shed_below: float = OUTBOUND_SHED_BELOW, max_wait: float = OUTBOUND_COSMETIC_MAX_WAIT,
+                 urgent_burst: Optional[int] = None):
+        self.burst = burst
+        self.rate = burst / per if burst and per > 0 else 0.0
+        self.urgent_burst = OUTBOUND_URGENT_BURST if urgent_burst is None else urgent_burst
+        self.urgent_rate = self.urgent_burst / per if self.urgent_burst and per > 0 else 0.0
+        self.shed_below = shed_below
+        self.max_wait = max_wait
+        self._lanes: Dict[int, ChannelLane] = {}
+        self._seq = itertools.count()
+        self._running: Set[asyncio.Task] = set()       # 送り出した呼び出し（終わるまで参照を持つ）
+
+    def _lane(self, channel_id: int) -> ChannelLane:
+        lane = self._lanes.get(channel_id)
+        if lane is None:
+            if len(self._lanes) >= 4096:
+                self._prune()
+            lane = self._lanes[channel_id] = ChannelLane(self.burst, self.urgent_burst)
+        return lane
+
+    def _prune(self):
+        """ 空で満タンに戻ったチャンネルの状態を捨てる """
+        for cid, lane in list(self._lanes.items()):
+            self._refill(lane)
+            if not lane.heap and lane.task is None and (
+                not self.burst or (lane.tokens >= self.burst and lane.urgent >= self.urgent_burst)
+            ):
+                del self._lanes[cid]
+
+    def _refill(self, lane: ChannelLane):
+        now = time.monotonic()
+        if self.burst:
+            lane.tokens = min(float(self.burst), lane.tokens + (now - lane.stamp) * self.rate)
+            lane.urgent = min(float(self.urgent_burst), lane.urgent + (now - lane.stamp) * self.urgent_rate)
+        lane.stamp = now
+
+    def _take(self, lane: ChannelLane, priority: int) -> float:
+        """ 出せるなら枠を1つ使って 0 を、出せなければ次に出せるまでの秒数を返す（urgent は専用の枠が先） """
+        if not self.burst:
+            return 0.0
+        own = priority == PRIO_URGENT and self.urgent_burst > 0
+        if own and lane.urgent >= 1.0:
+            lane.urgent -= 1.0
+            return 0.0
+        if lane.tokens >= 1.0:
+            lane.tokens -= 1.0
+            return 0.0
+        wait = (1.0 - lane.tokens) / self.rate
+        if own:
+            wait = min(wait, (1.0 - lane.urgent) / self.urgent_rate)
+        return wait
+
+    def hot(self, channel_id: int) -> bool:
+        """ いま cosmetic を出すと捨てられる状態か（残りが少ない、または上位が待っている） """
+        lane = self._lanes.get(channel_id)
+        if lane is None or not self.burst:
+            return False
+        self._refill(lane)
+        return lane.tokens < self.shed_below or any(it.priority < PRIO_COSMETIC for it in lane.heap)
+
+    def queue_depth(self, channel_id: Optional[int] = None) -> int:
+        if channel_id is not None:
+            lane = self._lanes.get(channel_id)
+            return len(lane.heap) if lane else 0
+        return sum(len(lane.heap) for lane in self._lanes.values())
+
+    async def submit(self, kind: str, channel_id: int, coro: Awaitable, priority: int = PRIO_URGENT, collapse=None):
+        lane = self._lane(channel_id)
+        prev = lane.pending.get(collapse) if collapse is not None else None
+        if prev is not None:
+            # まだ出ていない同じ編集 → 中身だけ差し替える（先に待っていた側も同じ結果を受け取る）
+            prev.coro.close()
+            prev.coro = coro
+            if priority < prev.priority:
+                prev.priority = priority
+                heapq.heapify(lane.heap)
+            METRICS.inc("outbound_collapsed", kind=kind)
+            return await asyncio.shield(prev.future)
+        item = _Outbound(priority, next(self._seq), kind, channel_id, coro, collapse)
+        heapq.heappush(lane.heap, item)
+        if collapse is not None:
+            lane.pending[collapse] = item
+        if lane.task is None:
+            lane.task = asyncio.create_task(self._drain(lane))
+        elif priority == PRIO_URGENT:
+            lane.wake.set()
+        return await asyncio.shield(item.future)
+
+    def _pop(self, lane: ChannelLane) -> _Outbound:
+        item = heapq.heappop(lane.heap)
+        if item.collapse is not None:
+            lane.pending.pop(item.collapse, None)
+        return item
+
+    async def _drain(self, lane: ChannelLane):
+        try:
+            while lane.heap:
+                self._refill(lane)
+                item = lane.heap[0]
+                waited = time.perf_counter() - item.enqueued_at
+                if item.priority == PRIO_COSMETIC and (
+                    (self.burst and lane.tokens < self.shed_below) or waited >= self.max_wait
+                ):
+                    self._pop(lane)
+                    item.coro.close()
+                    item.future.set_exception(Shed(item.kind))
+                    METRICS.inc("outbound_shed", kind=item.kind)
+                    continue
+                wait = self._take(lane, item.priority)
+                if wait > 0:
+                    # 待つ間に urgent が来たら起きて、そちらを専用の枠で先に出す
+                    lane.wake.clear()
+                    try:
+                        await asyncio.wait_for(lane.wake.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self._pop(lane)
+                METRICS.observe("outbound_wait_seconds", waited, priority=PRIO_NAMES[item.priority])
+                task = asyncio.create_task(self._run(item))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+        finally:
+            lane.task = None
+
+    async def _run(self, item: _Outbound):
+        METRICS.inc("api_calls", kind=item.kind, channel=str(item.channel_id))
+        try:
+            with METRICS.timer("api_seconds", kind=item.kind, phase=_phase_of(item.channel_id)):
+                result = await item.coro
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            if not item.future.done():
+                item.future.set_result(result)
+
+OUTBOUND = OutboundScheduler()
+METRICS.gauge("outbound_queue_depth", lambda: OUTBOUND.queue_depth())
+
+def _phase_of(channel_id: Optional[int]) -> str:
+    game = GAMES.get(channel_id) if channel_id is not None else None
+    return game.phase if game else "none"
+
+def _channel_id(target) -> Optional[int]:
+    ch = getattr(target, "channel", None)
+    return getattr(ch if ch is not None else target, "id", None)
+
+async def _api(kind: str, channel_id: Optional[int], coro: Awaitable, priority: int = PRIO_URGENT, collapse=None):
+    """
+    REST 呼び出し1回を数えて（サンプル時は）時間を測る。チャンネル単位の呼び出しは送信スケジューラに並べる。
+    priority が PRIO_COSMETIC なら混雑時に Shed が飛ぶので、呼び出し側で省いてよい形にしておくこと。
+    """
+    if channel_id is not None and kind not in _INTERACTION_KINDS:
+        return await OUTBOUND.submit(kind, channel_id, coro, priority, collapse)
+    METRICS.inc("api_calls", kind=kind, channel=str(channel_id))
+    with METRICS.timer("api_seconds", kind=kind, phase=_phase_of(channel_id)):
+        return await coro
+
+async def _send(channel: discord.abc.Messageable, *args, priority: int = PRIO_URGENT, **kwargs) -> discord.Message:
+    return await _api("send", getattr(channel, "id", None), channel.send(*args, **kwargs), priority)
+
+async def _followup(inter: discord.Interaction, *args, **kwargs) -> discord.Message:
+    return await _api("followup", inter.channel_id, inter.followup.send(*args, **kwargs))
+
+async def _edit(message: discord.Message, *, priority: int = PRIO_PANEL, **kwargs) -> discord.Message:
+    # 同じメッセージの同じ項目への編集は、まだ出ていなければ最後の1回にまとめてよい
+    collapse = ("edit", message.id, tuple(sorted(kwargs)))
+    return await _api("edit", _channel_id(message), message.edit(**kwargs), priority, collapse)
+
+async def _edit_original(inter: discord.Interaction, **kwargs) -> discord.Message:
+    return await _api("edit_original", inter.channel_id, inter.edit_original_response(**kwargs))
+
+async def _delete(message: discord.Message, priority: int = PRIO_COSMETIC):
+    return await _api("delete", _channel_id(message), message.delete(), priority)
 
 # ================== 小ユーティリティ ==================
 DICE_FACES = {1:"⚀",2:"⚁",3:"⚂",4:"⚃",5:"⚄",6:"⚅"}
@@ -40,6 +635,22 @@ DICE_FACES = {1:"⚀",2:"⚁",3:"⚂",4:"⚃",5:"⚄",6:"⚅"}
 def dice_face_str(vals: List[int]) -> str:
     return " ".join(DICE_FACES[v] for v in vals)
 
+async def resolve_display_names(guild: Optional[discord.Guild], uids: List[int]) -> Dict[int, str]:
+    """ メンバー/ユーザーキャッシュから表示名を引き、無い分だけまとめて並行 fetch する """
+    names: Dict[int, str] = {}
+    missing: List[int] = []
+    for uid in uids:
+        who = (guild.get_member(uid) if guild else None) or bot.get_user(uid)
+        if who is not None:
+            names[uid] = who.display_name
+        else:
+            missing.append(uid)
+    if missing:
+        fetched = await asyncio.gather(*(bot.fetch_user(uid) for uid in missing), return_exceptions=True)
+        for uid, user in zip(missing, fetched):
+            names[uid] = user.display_name if isinstance(user, discord.abc.User) else str(uid)
+    return names
+
 async def ack(inter: discord.Interaction):
     if not inter.response.is_done():
         await inter.response.defer()
@@ -53,39 +664,303 @@ class HandResult:
       3: 目（1〜6）値で比較
       2: 役なし
       1: ヒフミ(1-2-3)
+    score: rank と value を1つの整数に詰めたもの（大小比較だけで強さが決まる）
+    payout: この役で決着したときの配当倍率
+    役は種類ごとに1つだけ生成して使い回す（変更不可）。
     """
-    def __init__(self, rank: int, value: int, label: str):
-        self.rank = rank
-        self.value = value
-        self.label = label
+    __slots__ = ("rank", "value", "label", "score", "payout")
+
+    def __init__(self, rank: int, value: int, label: str, payout: int = 1):
+        object.__setattr__(self, "rank", rank)
+        object.__setattr__(self, "value", value)
+        object.__setattr__(self, "label", label)
+        object.__setattr__(self, "score", (rank << 3) | value)
+        object.__setattr__(self, "payout", payout)
+    def __setattr__(self, name, value):
+        raise AttributeError("HandResult は変更できません")
     def __str__(self): return self.label
-
-def evaluate_hand(dice: List[int]) -> HandResult:
-    d = sorted(dice)
-    a, b, c = d
-    if d == [1,2,3]:
-        return HandResult(1, 0, "ヒフミ（即負）")
-    if d == [4,5,6]:
-        return HandResult(5, 0, "シゴロ（即勝）")
+    def __repr__(self): return f"<HandResult {self.label} score={self.score}>"
+
+def _classify(dice: Sequence[int]) -> Tuple[int, int, str]:
+    a, b, c = sorted(dice)
+    if (a, b, c) == (1, 2, 3):
+        return 1, 0, "ヒフミ（即負）"
+    if (a, b, c) == (4, 5, 6):
+        return 5, 0, "シゴロ（即勝）"
     if a == b == c:
-        return HandResult(4, a, f"{a}ゾロ（即勝）")
+        return 4, a, f"{a}ゾロ（即勝）"
     if a == b != c:
-        return HandResult(3, c, f"{c}の目")
+        return 3, c, f"{c}の目"
     if b == c != a:
-        return HandResult(3, a, f"{a}の目")
-    return HandResult(2, 0, "役なし")
+        return 3, a, f"{a}の目"
+    return 2, 0, "役なし"
+
+def _build_hand_table() -> Tuple[Tuple[HandResult, ...], Dict[int, HandResult]]:
+    by_score: Dict[int, HandResult] = {}
+    table = []
+    for dice in itertools.product(range(1, 7), repeat=3):
+        rank, value, label = _classify(dice)
+        score = (rank << 3) | value
+        hand = by_score.get(score)
+        if hand is None:
+            hand = by_score[score] = HandResult(rank, value, label, HAND_PAYOUT.get(rank, 1))
+        table.append(hand)
+    return tuple(table), by_score
+
+# 出目(1〜6)^3 の216通り → 役。添字は (a-1)*36 + (b-1)*6 + (c-1)
+_HAND_TABLE, HAND_BY_SCORE = _build_hand_table()
+
+def evaluate_hand(dice: Sequence[int]) -> HandResult:
+    a, b, c = dice
+    return _HAND_TABLE[a*36 + b*6 + c - 43]
+
+def evaluate_hands(rolls: Iterable[Sequence[int]]) -> List[HandResult]:
+    """ まとめて判定（シミュレータ・統計用） """
+    table = _HAND_TABLE
+    return [table[a*36 + b*6 + c - 43] for a, b, c in rolls]
+
+def hand_scores(rolls: Iterable[Sequence[int]]) -> List[int]:
+    table = _HAND_TABLE
+    return [table[a*36 + b*6 + c - 43].score for a, b, c in rolls]
 
 def compare(parent: HandResult, child: HandResult) -> int:
     """ 親 vs 子 → 1:子勝 / -1:子負 / 0:引分 """
-    if parent.rank != child.rank:
-        return 1 if child.rank > parent.rank else -1
-    if parent.value != child.value:
-        return 1 if child.value > parent.value else -1
-    return 0
-
-def roll_dice() -> List[int]:
+    return (child.score > parent.score) - (child.score < parent.score)
+
+def settle_multiplier(parent: HandResult, child: HandResult) -> int:
+    """ 親子対決の配当倍率：勝った側の役の倍率。負けた側がヒフミならその倍率でも払う（大きい方） """
+    res = compare(parent, child)
+    winner, loser = (child, parent) if res > 0 else (parent, child)
+    if loser.rank == 1:
+        return max(winner.payout, loser.payout)
+    return winner.payout
+
+def roll_dice(rng: Optional["DiceStream"] = None) -> List[int]:
+    """ rng を渡せばその卓の列から、無ければ共有の random から（統計・ベンチ用） """
+    if rng is not None:
+        return rng.roll()
     return [random.randint(1,6) for _ in range(3)]
 
+class SeedPool:
+    """ os.urandom をまとめて読み、32バイトずつ配る（ラウンドごとの seed 用） """
+    def __init__(self, per_read: int = 64):
+        self.per_read = per_read
+        self._buf = b""
+
+    def take(self) -> bytes:
+        if not self._buf:
+            self._buf = os.urandom(32 * self.per_read)
+        seed, self._buf = self._buf[:32], self._buf[32:]
+        return seed
+
+SEEDS = SeedPool()
+
+class DiceStream:
+    """
+    卓の1ラウンドぶんの乱数列。ラウンド開始時に seed のハッシュ（commitment）を出し、終わったら seed を明かす。
+    列は SHA-256(seed ‖ 連番8バイト big endian) を RNG_BLOCKS 個ずつまとめて作ったバイトの並び。
+    n 通りから1つ選ぶときは、必要なバイト数を big endian の整数にして、n の倍数に収まる値だけを採って n で割った余りを使う
+    （サイコロなら 1 バイトずつ、252 未満を 6 で割った余り +1）。seed が分かれば誰でも同じ出目を再現できる。
+    """
+    def __init__(self, seed: bytes, pos: int = 0):
+        self.seed = seed
+        self.pos = pos              # 使い終わったバイト数（保存して再起動後も続きから出す）
+        self._buf = b""
+        self._base = 0              # _buf の先頭が列の何バイト目か
+
+    @classmethod
+    def for_round(cls, channel_id: int, round_no: int, master: Optional[str] = None) -> "DiceStream":
+        master = RNG_SEED if master is None else master
+        if master:
+            return cls(hashlib.sha256(f"{master}:{channel_id}:{round_no}".encode()).digest())
+        return cls(SEEDS.take())
+
+    @property
+    def commitment(self) -> str:
+        return hashlib.sha256(self.seed).hexdigest()
+
+    def _fill(self):
+        block = self.pos // 32
+        self._base = block * 32
+        self._buf = b"".join(hashlib.sha256(self.seed + (block + k).to_bytes(8, "big")).digest() for k in range(RNG_BLOCKS))
+
+    def _take(self, k: int) -> int:
+        off = self.pos - self._base
+        if off + k > len(self._buf):
+            self._fill()
+            off = self.pos - self._base
+        self.pos += k
+        return int.from_bytes(self._buf[off:off + k], "big")
+
+    def below(self, n: int) -> int:
+        """ 0 〜 n-1 を一様に """
+        k = max(1, ((n - 1).bit_length() + 7) // 8)
+        limit = (256 ** k) - (256 ** k) % n
+        while True:
+            v = self._take(k)
+            if v < limit:
+                return v % n
+
+    def roll(self) -> List[int]:
+        # below(6) + 1 を3回と同じ。1バイトずつなのでバッファを直接読む
+        out = []
+        while len(out) < 3:
+            off = self.pos - self._base
+            if off >= len(self._buf):
+                self._fill()
+                off = self.pos - self._base
+            self.pos += 1
+            b = self._buf[off]
+            if b < 252:
+                out.append(b % 6 + 1)
+        return out
+
+    def choice(self, seq: Sequence):
+        return seq[self.below(len(seq))]
+
+    def to_dict(self) -> dict:
+        return {"seed": self.seed.hex(), "pos": self.pos}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "DiceStream":
+        return cls(bytes.fromhex(d["seed"]), d["pos"])
+
+def replay_dice(seed_hex: str, n: int) -> List[List[int]]:
+    """ 明かされた seed からそのラウンドの出目を先頭から n 回ぶん再現する（検証用） """
+    stream = DiceStream(bytes.fromhex(seed_hex))
+    return [stream.roll() for _ in range(n)]
+
+# ===== 勝率・期待値 =====
+class Odds:
+    """ win/draw/lose は確率、ev はベット1単位あたりの期待収支（配当倍率込み） """
+    __slots__ = ("win", "draw", "lose", "ev")
+
+    def __init__(self, win: float, draw: float, lose: float, ev: float):
+        self.win, self.draw, self.lose, self.ev = win, draw, lose, ev
+    def flipped(self) -> "Odds":
+        return Odds(self.lose, self.draw, self.win, -self.ev)
+    def __repr__(self):
+        return f"<Odds win={self.win:.4f} draw={self.draw:.4f} lose={self.lose:.4f} ev={self.ev:+.4f}>"
+
+# 1回振ったときの役の分布（score -> 確率）
+_ROLL_DIST: Tuple[Tuple[HandResult, float], ...] = tuple(
+    (HAND_BY_SCORE[score], sum(1 for h in _HAND_TABLE if h.score == score) / 216) for score in sorted(HAND_BY_SCORE)
+)
+
+def _mix(parts: Iterable[Tuple[float, Odds]]) -> Odds:
+    w = d = l = ev = 0.0
+    for p, o in parts:
+        w += p * o.win; d += p * o.draw; l += p * o.lose; ev += p * o.ev
+    return Odds(w, d, l, ev)
+
+@functools.lru_cache(maxsize=None)
+def _child_final(parent_score: int, child_score: int) -> Odds:
+    parent, child = HAND_BY_SCORE[parent_score], HAND_BY_SCORE[child_score]
+    res = compare(parent, child)
+    mult = settle_multiplier(parent, child)
+    if res > 0:
+        return Odds(1.0, 0.0, 0.0, float(mult))
+    if res < 0:
+        return Odds(0.0, 0.0, 1.0, -float(mult))
+    return Odds(0.0, 1.0, 0.0, 0.0)
+
+@functools.lru_cache(maxsize=None)
+def _child_roll(parent_score: int, tries_left: int) -> Odds:
+    """ 子が今から振る（残り tries_left 回）ときの最善手での成績 """
+    parts = []
+    for hand, p in _ROLL_DIST:
+        stop = _child_final(parent_score, hand.score)
+        if hand.rank != 2 or tries_left <= 1:
+            parts.append((p, stop))
+        else:
+            again = _child_roll(parent_score, tries_left - 1)
+            parts.append((p, again if again.ev > stop.ev else stop))
+    return _mix(parts)
+
+@functools.lru_cache(maxsize=None)
+def _parent_final(parent_score: int) -> Odds:
+    """ 親の役が決まったあと、子1人に対する親側の成績（子は最善手で振る） """
+    hand = HAND_BY_SCORE[parent_score]
+    if hand.rank in (5, 4):
+        return Odds(1.0, 0.0, 0.0, float(hand.payout))
+    if hand.rank == 1:
+        return Odds(0.0, 0.0, 1.0, -float(hand.payout))
+    return _child_roll(parent_score, MAX_TRIES).flipped()
+
+@functools.lru_cache(maxsize=None)
+def _parent_roll(tries_left: int) -> Odds:
+    parts = []
+    for hand, p in _ROLL_DIST:
+        stop = _parent_final(hand.score)
+        if hand.rank != 2 or tries_left <= 1:
+            parts.append((p, stop))
+        else:
+            again = _parent_roll(tries_left - 1)
+            parts.append((p, again if again.ev > stop.ev else stop))
+    return _mix(parts)
+
+def child_odds(parent_hand: HandResult, current: Optional[HandResult], tries_left: int) -> Tuple[Optional[Odds], Optional[Odds]]:
+    """ 子の (STOPした場合, ROLLした場合)。選べない方は None """
+    stop = _child_final(parent_hand.score, current.score) if current is not None else None
+    roll = _child_roll(parent_hand.score, tries_left) if tries_left > 0 else None
+    return stop, roll
+
+def parent_odds(current: Optional[HandResult], tries_left: int) -> Tuple[Optional[Odds], Optional[Odds]]:
+    """ 親の (STOPした場合, ROLLした場合)。子1人あたり・親側から見た値 """
+    stop = _parent_final(current.score) if current is not None else None
+    roll = _parent_roll(tries_left) if tries_left > 0 else None
+    return stop, roll
+
+def _warm_odds():
+    for parent in HAND_BY_SCORE:
+        for t in range(1, MAX_TRIES + 1):
+            _child_roll(parent, t)
+        for child in HAND_BY_SCORE:
+            _child_final(parent, child)
+    for t in range(1, MAX_TRIES + 1):
+        _parent_roll(t)
+
+_warm_odds()
+
+def simulate_child_odds(parent_hand: HandResult, tries_left: int = MAX_TRIES, n: int = 200_000,
+                        payout: Optional[Dict[int, int]] = None, reroll_nohand: bool = True,
+                        seed: Optional[int] = None) -> Odds:
+    """
+    ルール違い（倍率・回数・方針）を試すためのモンテカルロ版（NumPy必須）。
+    reroll_nohand=True なら役なしは振れる限り振り直す。
+    """
+    if np is None:
+        raise RuntimeError("モンテカルロモードには numpy が必要です")
+    payout = HAND_PAYOUT if payout is None else payout
+    rng = np.random.default_rng(seed)
+    ranks = np.array([h.rank for h in _HAND_TABLE], dtype=np.int8)
+    scores = np.array([h.score for h in _HAND_TABLE], dtype=np.int16)
+    mult_by_rank = np.zeros(6, dtype=np.float64)
+    for r, m in payout.items():
+        mult_by_rank[r] = m
+
+    idx = rng.integers(0, 216, size=(n, max(1, tries_left)))
+    if reroll_nohand:
+        decided = ranks[idx] != 2
+        decided[:, -1] = True
+        pick = decided.argmax(axis=1)           # 最初に役が決まった回
+    else:
+        pick = np.zeros(n, dtype=np.int64)
+    final = idx[np.arange(n), pick]
+    child_score = scores[final].astype(np.int32)
+    child_rank = ranks[final]
+    child_mult = mult_by_rank[child_rank]
+    parent_mult = mult_by_rank[parent_hand.rank]
+
+    win = child_score > parent_hand.score
+    lose = child_score < parent_hand.score
+    # settle_multiplier と同じ：勝った側の倍率、負けた側がヒフミなら大きい方
+    mult = np.where(win, child_mult, parent_mult)
+    hifumi_lost = (win & (parent_hand.rank == 1)) | (lose & (child_rank == 1))
+    mult = np.where(hifumi_lost, np.maximum(child_mult, parent_mult), mult)
+    ev = (mult * win).sum() - (mult * lose).sum()
+    return Odds(win.mean(), 1.0 - win.mean() - lose.mean(), lose.mean(), ev / n)
+
 # ===== 送金出力 =====
 def build_transfer_line(payer_id: int, payee_id: int, amount: int) -> str:
     payer = f"<@{payer_id}>"
@@ -95,82 +970,1224 @@ def build_transfer_line(payer_id: int, payee_id: int, amount: int) -> str:
     except Exception:
         return f"[TRANSFER] {payer} -> {payee} : {amount}"
 
+def chunk_lines(title: str, lines: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """ 各メッセージが limit 文字に収まるよう行単位で分割する。複数になる場合は見出しに (i/n) を付ける """
+    head_room = len(title) + len(" (999/999)\n")
+    chunks: List[List[str]] = [[]]
+    size = head_room
+    for line in lines:
+        if chunks[-1] and size + len(line) + 1 > limit:
+            chunks.append([])
+            size = head_room
+        chunks[-1].append(line)
+        size += len(line) + 1
+    if len(chunks) == 1:
+        return [f"{title}\n" + "\n".join(chunks[0])]
+    n = len(chunks)
+    return [f"{title} ({i}/{n})\n" + "\n".join(c) for i, c in enumerate(chunks, 1)]
+
 async def post_transfers(channel: discord.abc.Messageable, pairs: List[Tuple[int,int,int]], title: str):
     if not pairs:
-        await channel.send(f"{title}\n（対象なし）")
+        await _send(channel, f"{title}\n（対象なし）")
         return
     lines = [build_transfer_line(p, r, a) for (p, r, a) in pairs]
-    await channel.send(f"{title}\n" + "\n".join(lines))
+    for text in chunk_lines(title, lines):
+        await _send(channel, text)
+
+class SettlementLedger:
+    """ 勝敗ごとの支払いを記録し、精算時に相殺して最小限の 支払側→受取側 にまとめる """
+    def __init__(self):
+        self.entries: List[Tuple[int, int, int]] = []   # (payer, payee, amount)
+        self.rounds = 0                                  # 未精算のラウンド数
+
+    def record(self, payer_id: int, payee_id: int, amount: int):
+        if amount > 0 and payer_id != payee_id:
+            self.entries.append((payer_id, payee_id, amount))
+
+    def balances(self) -> Dict[int, int]:
+        bal: Dict[int, int] = defaultdict(int)
+        for payer, payee, amount in self.entries:
+            bal[payer] -= amount
+            bal[payee] += amount
+        return {u: v for u, v in bal.items() if v}
+
+    def net(self) -> List[Tuple[int, int, int]]:
+        """ 差額を大きい順に突き合わせる（送金件数は最大でも 人数-1） """
+        bal = self.balances()
+        debtors = sorted(((-v, u) for u, v in bal.items() if v < 0), key=lambda x: (-x[0], x[1]))
+        creditors = sorted(((v, u) for u, v in bal.items() if v > 0), key=lambda x: (-x[0], x[1]))
+        out: List[Tuple[int, int, int]] = []
+        i = j = 0
+        while i < len(debtors) and j < len(creditors):
+            owe, payer = debtors[i]
+            due, payee = creditors[j]
+            amt = min(owe, due)
+            out.append((payer, payee, amt))
+            debtors[i] = (owe - amt, payer)
+            creditors[j] = (due - amt, payee)
+            if debtors[i][0] == 0: i += 1
+            if creditors[j][0] == 0: j += 1
+        return out
+
+    def clear(self):
+        self.entries = []
+        self.rounds = 0
+
+async def settle_ledger(channel: discord.abc.Messageable, game: "GameState", title: str = "💴 精算（相殺済み）"):
+    """ 相殺した送金をアウトボックスに積んで戻る（届けるのは裏の配送ループ） """
+    ledger = game.ledger
+    if not ledger.entries:
+        ledger.clear()
+        return
+    pairs = ledger.net()
+    try:
+        OUTBOX.enqueue(channel, game, pairs, title)
+    except sqlite3.Error as e:
+        print("Outbox error:", e)
+        await post_transfers(channel, pairs, title)     # 積めなければその場で出す
+    ledger.clear()
+
+# ================== 精算アウトボックス ==================
+_OUTBOX_COLUMNS = ("id", "key", "sink", "guild_id", "channel_id", "title", "payer", "payee", "amount", "created_at", "attempts")
+
+class ChatSink:
+    """
+    送金コマンド文（TRANSFER_TEMPLATE）を精算したチャンネルに投稿する。
+    1通に収まらなければ分けて送り、送れた1通ごとに mark で配送済みにする（途中で失敗しても送れた分は再送しない）
+    """
+    name = "chat"
+
+    def __init__(self, resolve: Callable[[int], discord.abc.Messageable]):
+        self.resolve = resolve
+
+    async def deliver(self, items: List[dict], mark: Optional[Callable[[List[dict]], None]] = None):
+        channel = self.resolve(items[0]["channel_id"])
+        by_title: Dict[str, List[dict]] = defaultdict(list)
+        for it in items:
+            by_title[it["title"]].append(it)
+        for title, group in by_title.items():
+            lines = [build_transfer_line(it["payer"], it["payee"], it["amount"]) for it in group]
+            pos = 0
+            for text in chunk_lines(title, lines):
+                n = text.count("\n")       # 見出しの後ろの行数（送金1件1行）
+                await _send(channel, text)
+                if mark is not None:
+                    mark(group[pos:pos + n])
+                pos += n
+
+def _transfer_record(it: dict) -> dict:
+    return {k: it[k] for k in ("key", "guild_id", "channel_id", "payer", "payee", "amount", "created_at")}
+
+class WebhookSink:
+    """ まとめて JSON で POST する。Idempotency-Key はバッチ内の冪等キーから作る（受け側で重複を捨てられる） """
+    name = "webhook"
+
+    def __init__(self, url: str = SETTLE_WEBHOOK_URL):
+        self.url = url
+        self._session = None
+
+    async def deliver(self, items: List[dict], mark=None):
+        if not self.url:
+            raise RuntimeError("CHI_SETTLE_WEBHOOK_URL が未設定")
+        import aiohttp      # discord.py の依存に含まれる
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        body = {"transfers": [_transfer_record(it) for it in items]}
+        batch_key = hashlib.sha256("\n".join(it["key"] for it in items).encode()).hexdigest()
+        async with self._session.post(self.url, json=body, headers={"Idempotency-Key": batch_key}) as resp:
+            if resp.status >= 300:
+                raise RuntimeError(f"webhook HTTP {resp.status}")
+
+class JsonlSink:
+    """ 1送金1行の JSON を追記する（fsync してから配送済みにする） """
+    name = "jsonl"
+
+    def __init__(self, path: str = SETTLE_JSONL_PATH):
+        self.path = path
+
+    def _write(self, lines: List[str]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def deliver(self, items: List[dict], mark=None):
+        lines = [json.dumps(_transfer_record(it), ensure_ascii=False, separators=(",", ":")) + "\n" for it in items]
+        await asyncio.to_thread(self._write, lines)
+
+class SettlementOutbox:
+    """
+    精算の送金を書き溜め、裏の配送ループが配送先（シンク）へまとめて届ける（少なくとも1回）。
+    1行は (冪等キー, シンク) で一意。同じ精算を積み直しても増えない。シンクにもキーを渡すので、受け側で重複を捨てられる。
+    失敗したら指数バックオフで再送し、OUTBOX_MAX_ATTEMPTS 回失敗したら dead にする。
+    行はゲームと同じ SQLite に置く（ストアが無効ならメモリ上。再起動で消える）。
+    複数プロセスで DB を共有しても、自分が積んだ行（owner）しか配らない。
+    """
+    def __init__(self, sinks: Optional[Sequence] = None, owner: str = PROCESS_TAG):
+        self.sinks = {s.name: s for s in (sinks if sinks is not None else default_sinks())}
+        self.owner = owner
+        self._conn: Optional[sqlite3.Connection] = None
+        self._memory: Optional[sqlite3.Connection] = None
+        self._channels: Dict[int, discord.abc.Messageable] = {}    # 積んだときのチャンネル（スレッドもそのまま使う）
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()     # 配送ループと flush が同じ行を同時に配らないように
+        self._task: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+
+    def _db(self) -> sqlite3.Connection:
+        if STORE.enabled:
+            conn = STORE._db()
+        else:
+            if self._memory is None:
+                self._memory = sqlite3.connect(":memory:", isolation_level=None)
+            conn = self._memory
+        if conn is not self._conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY, key TEXT NOT NULL, sink TEXT NOT NULL, owner TEXT NOT NULL,"
+                " guild_id INTEGER, channel_id INTEGER NOT NULL, title TEXT NOT NULL,"
+                " payer INTEGER NOT NULL, payee INTEGER NOT NULL, amount INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL,"
+                " delivered_at REAL, dead INTEGER NOT NULL DEFAULT 0, last_error TEXT, UNIQUE (key, sink))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (owner, next_at) WHERE delivered_at IS NULL AND dead = 0")
+            self._conn = conn
+        return conn
+
+    def enqueue(self, channel: discord.abc.Messageable, game: "GameState", pairs: List[Tuple[int, int, int]], title: str) -> int:
+        """ 送金をシンクの数だけ積む。冪等キーは ゲーム:ラウンド:支払側:受取側（相殺後は組が重ならない） """
+        now = time.time()
+        rows = [
+            (f"{game.game_id}:{game.round_no}:{payer}:{payee}", sink, self.owner, game.guild_id, game.channel_id,
+             title, payer, payee, amount, now, now)
+            for payer, payee, amount in pairs for sink in self.sinks
+        ]
+        db = self._db()
+        before = db.total_changes
+        db.executemany(
+            "INSERT OR IGNORE INTO outbox (key, sink, owner, guild_id, channel_id, title, payer, payee, amount, created_at, next_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows,
+        )
+        added = db.total_changes - before
+        METRICS.inc("outbox_enqueued", added)
+        self._channels[game.channel_id] = channel
+        self._wake.set()
+        return added
+
+    def backlog(self, sink: Optional[str] = None) -> int:
+        q = "SELECT COUNT(*) FROM outbox WHERE owner = ? AND delivered_at IS NULL AND dead = 0"
+        args: tuple = (self.owner,)
+        if sink is not None:
+            q += " AND sink = ?"
+            args += (sink,)
+        return self._db().execute(q, args).fetchone()[0]
+
+    def dead(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM outbox WHERE owner = ? AND dead = 1", (self.owner,)).fetchone()[0]
+
+    def oldest_age(self) -> float:
+        row = self._db().execute(
+            "SELECT MIN(created_at) FROM outbox WHERE owner = ? AND delivered_at IS NULL AND dead = 0", (self.owner,)
+        ).fetchone()
+        return time.time() - row[0] if row[0] is not None else 0.0
+
+    def channel_for(self, channel_id: int) -> discord.abc.Messageable:
+        return self._channels.get(channel_id) or bot.get_channel(channel_id) or bot.get_partial_messageable(channel_id)
+
+    # --- 配送
+    def _backoff(self, attempts: int) -> float:
+        delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _mark_delivered(self, sink_name: str, items: List[dict]):
+        done = time.time()
+        self._db().executemany("UPDATE outbox SET delivered_at = ?, attempts = attempts + 1 WHERE id = ?",
+                               [(done, it["id"]) for it in items])
+        METRICS.inc("outbox_delivered", len(items), sink=sink_name)
+        for it in items:
+            METRICS.observe("outbox_delay_seconds", done - it["created_at"], sink=sink_name)
+
+    async def deliver_due(self) -> int:
+        """ 期限の来た行を (シンク, チャンネル) ごとにまとめて届ける。処理した行数を返す """
+        async with self._lock:
+            return await self._deliver_due()
+
+    async def _deliver_due(self) -> int:
+        db = self._db()
+        now = time.time()
+        rows = db.execute(
+            f"SELECT {', '.join(_OUTBOX_COLUMNS)} FROM outbox"
+            " WHERE owner = ? AND delivered_at IS NULL AND dead = 0 AND next_at <= ? ORDER BY id LIMIT ?",
+            (self.owner, now, OUTBOX_BATCH),
+        ).fetchall()
+        groups: Dict[Tuple[str, int], List[dict]] = defaultdict(list)
+        for row in rows:
+            it = dict(zip(_OUTBOX_COLUMNS, row))
+            groups[(it["sink"], it["channel_id"])].append(it)
+        for (sink_name, channel_id), items in groups.items():
+            sink = self.sinks.get(sink_name)
+            delivered: set = set()
+
+            def mark(part: List[dict], sink_name=sink_name, delivered=delivered):
+                self._mark_delivered(sink_name, part)
+                delivered.update(it["id"] for it in part)
+
+            try:
+                if sink is None:
+                    raise RuntimeError(f"シンク {sink_name} が無効")
+                await asyncio.wait_for(sink.deliver(items, mark), OUTBOX_SEND_TIMEOUT)
+            except Exception as e:
+                # 届いた分（mark 済み）はそのまま。残りを行ごとの試行回数でバックオフ / dead にする
+                failed = [it for it in items if it["id"] not in delivered]
+                METRICS.inc("outbox_failed", len(failed), sink=sink_name)
+                error = f"{type(e).__name__}: {e}"[:500]
+                updates = []
+                for it in failed:
+                    attempts = it["attempts"] + 1
+                    updates.append((time.time() + self._backoff(attempts), int(attempts >= OUTBOX_MAX_ATTEMPTS), error, it["id"]))
+                db.executemany("UPDATE outbox SET attempts = attempts + 1, next_at = ?, dead = ?, last_error = ? WHERE id = ?", updates)
+                dead = sum(u[1] for u in updates)
+                if dead:
+                    print(f"Outbox: {sink_name} への配送を諦めました（{dead}件, {e!r}）")
+                continue
+            rest = [it for it in items if it["id"] not in delivered]
+            if rest:
+                mark(rest)
+        # 未配送が残っていないチャンネルは覚えておかない（次に積むときにまた入る）
+        for channel_id in {cid for _, cid in groups}:
+            if channel_id in self._channels and not self._pending_in(channel_id):
+                del self._channels[channel_id]
+        return len(rows)
+
+    def _pending_in(self, channel_id: int) -> bool:
+        return self._db().execute(
+            "SELECT 1 FROM outbox WHERE owner = ? AND channel_id = ? AND delivered_at IS NULL AND dead = 0 LIMIT 1",
+            (self.owner, channel_id),
+        ).fetchone() is not None
+
+    def prune(self, keep: float = OUTBOX_KEEP_SECONDS):
+        self._db().execute("DELETE FROM outbox WHERE owner = ? AND delivered_at < ?", (self.owner, time.time() - keep))
+
+    async def run(self, interval: float = OUTBOX_POLL_INTERVAL):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                while await self.deliver_due() >= OUTBOX_BATCH:
+                    pass
+                if time.time() - self._pruned_at > 3600:
+                    self.prune()
+                    self._pruned_at = time.time()
+            except sqlite3.Error as e:
+                print("Outbox error:", e)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        for name in self.sinks:
+            METRICS.gauge("outbox_backlog", lambda name=name: self.backlog(name), sink=name)
+        METRICS.gauge("outbox_oldest_seconds", self.oldest_age)
+
+    async def flush(self, timeout: float = 30.0) -> int:
+        """ 今届けられる分を届け切るまで待つ（終了時・シミュレータ用）。残った件数を返す """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if await self.deliver_due() == 0:
+                break
+        return self.backlog()
+
+def default_sinks(spec: Optional[str] = None, jsonl_path: str = SETTLE_JSONL_PATH) -> List:
+    """ CHI_SETTLE_SINKS（または spec）からシンクを作る """
+    sinks = []
+    for name in (s.strip() for s in (SETTLE_SINKS if spec is None else spec).split(",") if s.strip()):
+        if name == "chat":
+            sinks.append(ChatSink(lambda cid: OUTBOX.channel_for(cid)))
+        elif name == "webhook":
+            sinks.append(WebhookSink())
+        elif name == "jsonl":
+            sinks.append(JsonlSink(jsonl_path))
+        else:
+            print(f"不明な精算の配送先：{name}")
+    return sinks
+
+OUTBOX = SettlementOutbox()
+
+# ================== ロールログ ==================
+# 1レコード48バイト固定：時刻, チャンネル, ユーザー, 種別, 出目×3, 役スコア, フラグ, ベット, 収支
+ROLL_RECORD = struct.Struct("<dQQBBBBBBxxqq")
+_RECORD_TS = struct.Struct("<d")
+REC_ROLL, REC_STOP, REC_MATCH = 1, 2, 3     # ロール / STOP・時間切れでの確定 / 親子の1勝負の精算
+REC_PARENT, REC_FINAL = 1, 2                # フラグ：親としての記録 / この出目で役が確定した
+REC_WIN, REC_LOSS, REC_DRAW = 4, 8, 16      # フラグ（勝負）：本人から見た勝敗。ベット0でも勝敗は付く
+RANK_NAMES = {5: "シゴロ", 4: "ゾロ目", 3: "目", 2: "役なし", 1: "ヒフミ"}
+
+class RollLogSegment:
+    """ 容量ぶんを先に確保した1ファイル。mmap 越しに書き足して読む（未使用の部分は時刻が0） """
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self._file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        fd = self._file.fileno()
+        size = max(os.fstat(fd).st_size, capacity * ROLL_RECORD.size)
+        if os.fstat(fd).st_size < size:
+            try:
+                os.posix_fallocate(fd, 0, size)     # 疎ファイルだとディスクが尽きたとき mmap への書き込みで落ちる
+            except (AttributeError, OSError):
+                self._file.truncate(size)
+        self.capacity = size // ROLL_RECORD.size
+        self._mm = mmap.mmap(fd, self.capacity * ROLL_RECORD.size)
+        self.count = self._find_end()
+
+    def _find_end(self) -> int:
+        """ 書き足しだけなので、時刻が0になる最初のレコードを二分探索すれば終端が分かる """
+        lo, hi = 0, self.capacity
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _RECORD_TS.unpack_from(self._mm, mid * ROLL_RECORD.size)[0]:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def append(self, packed: bytes) -> int:
+        i = self.count
+        self._mm[i * ROLL_RECORD.size:(i + 1) * ROLL_RECORD.size] = packed
+        self.count += 1
+        return i
+
+    def read(self, i: int) -> tuple:
+        return ROLL_RECORD.unpack_from(self._mm, i * ROLL_RECORD.size)
+
+    def records(self) -> Iterable[tuple]:
+        return ROLL_RECORD.iter_unpack(self._mm[:self.count * ROLL_RECORD.size])
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()
+
+class Ranking:
+    """
+    収支の順位表。更新のたびに並びを保つので、上位は先頭を読むだけで出せる。
+    (-収支, user) の昇順を BUCKET 件前後の束に分けて持つ（束の末尾を二分探索して、動かすのはその束の中だけ）。
+    1本のリストだと更新のたびに人数ぶんずらすことになり、起動時の読み直しが人数の2乗で遅くなる。
+    """
+    BUCKET = 512
+
+    def __init__(self):
+        self._buckets: List[List[Tuple[int, int]]] = []
+        self._maxes: List[Tuple[int, int]] = []     # 各束の末尾（最大）
+        self._net: Dict[int, int] = {}
+
+    def _insert(self, key: Tuple[int, int]):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            return
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._buckets[i].append(key)
+            self._maxes[i] = key
+        else:
+            bisect.insort(self._buckets[i], key)
+        bucket = self._buckets[i]
+        if len(bucket) > 2 * self.BUCKET:
+            self._buckets[i:i + 1] = [bucket[:self.BUCKET], bucket[self.BUCKET:]]
+            self._maxes[i:i + 1] = [bucket[self.BUCKET - 1], bucket[-1]]
+
+    def _remove(self, key: Tuple[int, int]):
+        i = bisect.bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if bucket:
+            self._maxes[i] = bucket[-1]
+        else:
+            del self._buckets[i], self._maxes[i]
+
+    def add(self, user_id: int, delta: int):
+        old = self._net.get(user_id)
+        if old is not None:
+            self._remove((-old, user_id))
+        new = (old or 0) + delta
+        self._net[user_id] = new
+        self._insert((-new, user_id))
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        keys = itertools.islice(itertools.chain.from_iterable(self._buckets), n)
+        return [(uid, -key) for key, uid in keys]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        net = self._net.get(user_id)
+        if net is None:
+            return None
+        key = (-net, user_id)
+        i = bisect.bisect_left(self._maxes, key)
+        return sum(len(b) for b in self._buckets[:i]) + bisect.bisect_left(self._buckets[i], key) + 1
+
+    def __len__(self) -> int:
+        return len(self._net)
+
+class PlayerStats:
+    """ 1人ぶんの集計。ログに書くたびに足し込む """
+    __slots__ = ("rolls", "hands", "best", "matches", "wins", "losses", "draws", "net", "wagered", "last_ts")
+
+    def __init__(self):
+        self.rolls = 0
+        self.hands = [0] * 6        # 確定した役の回数（添字は rank）
+        self.best = 0               # 確定した役の最高スコア（0=まだ無い）
+        self.matches = 0            # 親子の勝負数
+        self.wins = self.losses = self.draws = 0
+        self.net = 0                # 収支
+        self.wagered = 0            # 勝負にかかったベットの合計
+        self.last_ts = 0.0
+
+class ChannelStats:
+    __slots__ = ("rolls", "matches", "volume", "ranking")
+
+    def __init__(self):
+        self.rolls = 0
+        self.matches = 0
+        self.volume = 0             # 動いた額（子の側で数える）
+        self.ranking = Ranking()
+
+class RollLog:
+    """
+    ロール・確定・精算を固定長レコードで書き足していくログ。一定件数ごとにファイルを分け、mmap で読み書きする。
+    書くたびにユーザー別の位置索引と集計（本人・チャンネル・順位表）を更新するので、/chi_stats は履歴を読まない。
+    既存のファイルを読み直すのは起動時の1回だけ。
+    クラスタ構成ではプロセスごとに別ファイルに書く（集計もそのプロセスのシャードの分だけ）。
+    """
+    def __init__(self, directory: str = ROLL_LOG_DIR, segment_records: int = ROLL_LOG_SEGMENT_RECORDS, writer: str = "main"):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.writer = writer
+        self._segments: List[RollLogSegment] = []
+        self._index: Dict[int, array] = {}          # user → 位置（セグメント番号 << 32 | 番号内の位置）
+        self.players: Dict[int, PlayerStats] = {}
+        self.channels: Dict[int, ChannelStats] = {}
+        self.ranking = Ranking()
+        self._opened = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    @property
+    def count(self) -> int:
+        return sum(seg.count for seg in self._segments)
+
+    def _segment_path(self, n: int) -> str:
+        return os.path.join(self.directory, f"rolls-{self.writer}-{n:06d}.seg")
+
+    def open(self):
+        """ 既存のファイルを読み直して索引と集計を作る。2回目以降は何もしない """
+        if self._opened or not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        n = 0
+        while os.path.exists(self._segment_path(n)):
+            seg = RollLogSegment(self._segment_path(n), self.segment_records)
+            self._segments.append(seg)
+            for i, rec in enumerate(seg.records()):
+                self._apply(n, i, rec)
+            n += 1
+        self._opened = True
+
+    def close(self):
+        for seg in self._segments:
+            seg.close()
+        self._segments = []
+        self._opened = False
+
+    def append(self, kind: int, channel_id: int, user_id: int, dice: Optional[Sequence[int]] = None,
+               score: int = 0, bet: int = 0, result: int = 0, flags: int = 0):
+        if not self.enabled:
+            return
+        self.open()
+        if not self._segments or self._segments[-1].full:
+            self._segments.append(RollLogSegment(self._segment_path(len(self._segments)), self.segment_records))
+        a, b, c = dice or (0, 0, 0)
+        rec = (time.time(), channel_id, user_id, kind, a, b, c, score, flags, bet, result)
+        i = self._segments[-1].append(ROLL_RECORD.pack(*rec))
+        self._apply(len(self._segments) - 1, i, rec)
+
+    def _apply(self, seg_no: int, i: int, rec: tuple):
+        ts, channel_id, user_id, kind, _, _, _, score, flags, bet, result = rec
+        index = self._index.get(user_id)
+        if index is None:
+            index = self._index[user_id] = array("Q")
+        index.append(seg_no << 32 | i)
+        p = self.players.get(user_id)
+        if p is None:
+            p = self.players[user_id] = PlayerStats()
+        ch = self.channels.get(channel_id)
+        if ch is None:
+            ch = self.channels[channel_id] = ChannelStats()
+        p.last_ts = ts
+        if kind == REC_ROLL:
+            p.rolls += 1
+            ch.rolls += 1
+        if flags & REC_FINAL:
+            p.hands[score >> 3] += 1
+            p.best = max(p.best, score)
+        if kind == REC_MATCH:
+            p.matches += 1
+            p.wagered += bet
+            p.net += result
+            if flags & REC_WIN: p.wins += 1
+            elif flags & REC_LOSS: p.losses += 1
+            else: p.draws += 1
+            if not flags & REC_PARENT:
+                ch.matches += 1
+                ch.volume += abs(result)
+            if result:
+                self.ranking.add(user_id, result)
+                ch.ranking.add(user_id, result)
+
+    def recent(self, user_id: int, n: int, kind: Optional[int] = REC_ROLL) -> List[tuple]:
+        """ 索引から本人のレコードを新しい順に n 件（kind で絞る） """
+        out = []
+        index = self._index.get(user_id, ())
+        for pos in reversed(index):
+            rec = self._segments[pos >> 32].read(pos & 0xFFFFFFFF)
+            if kind is None or rec[3] == kind:
+                out.append(rec)
+                if len(out) >= n:
+                    break
+        return out
+
+ROLL_LOG = RollLog(writer=PROCESS_TAG)
+
+def record_roll(kind: int, game: "GameState", rs: "RoundState", dice: Optional[Sequence[int]], hand: HandResult):
+    """ ロール / STOP をログに書く。ログが書けなくてもゲームは止めない """
+    flags = (REC_PARENT if rs.user_id == game.parent_id else 0) | (REC_FINAL if rs.final is not None else 0)
+    bet = 0 if flags & REC_PARENT else game.bets.get(rs.user_id, 0)
+    try:
+        ROLL_LOG.append(kind, game.channel_id, rs.user_id, dice, hand.score, bet, 0, flags)
+    except (OSError, ValueError) as e:
+        print("Roll log error:", e)
+
+def record_match(game: "GameState", child_id: int, child_hand: Optional[HandResult], parent_hand: HandResult,
+                 outcome: int, delta: int):
+    """ 親子の1勝負を両者の側から書く。outcome は子から見た勝敗（1/-1/0）、delta は子から見た収支 """
+    bet = game.bets.get(child_id, 0)
+    child_flags = {1: REC_WIN, -1: REC_LOSS, 0: REC_DRAW}[outcome]
+    parent_flags = {1: REC_LOSS, -1: REC_WIN, 0: REC_DRAW}[outcome] | REC_PARENT
+    try:
+        ROLL_LOG.append(REC_MATCH, game.channel_id, child_id, None, child_hand.score if child_hand else 0, bet, delta, child_flags)
+        ROLL_LOG.append(REC_MATCH, game.channel_id, game.parent_id, None, parent_hand.score, bet, -delta, parent_flags)
+    except (OSError, ValueError) as e:
+        print("Roll log error:", e)
 
 # ================== 画像生成（Pillow） ==================
-_DICE_CACHE: dict[int, Image.Image] = {}
+# ===== サイコロのテーマとスプライトアトラス =====
+class DiceTheme:
+    """ 選べるサイコロの見た目。素材のフォルダと色替えが同じテーマは同じアトラスを共有する """
+    __slots__ = ("name", "source", "recolor")
+
+    def __init__(self, name: str, source: str, recolor=None):
+        self.name = name
+        self.source = source
+        self.recolor = recolor
+
+    @property
+    def key(self) -> tuple:
+        return (os.path.realpath(self.source), self.recolor)
+
+def discover_themes(base_dir: str = DICE_ASSET_DIR, themes_dir: str = DICE_THEMES_DIR,
+                    recolors: Optional[dict] = None) -> Dict[str, DiceTheme]:
+    """ classic（DICE_ASSET_DIR）＋色替え＋ themes_dir の下で6面が揃っているフォルダ """
+    themes = {"classic": DiceTheme("classic", base_dir)}
+    for name, recolor in (DICE_THEME_RECOLORS if recolors is None else recolors).items():
+        themes[name] = DiceTheme(name, base_dir, recolor)
+    if themes_dir and os.path.isdir(themes_dir):
+        for name in sorted(os.listdir(themes_dir)):
+            path = os.path.join(themes_dir, name)
+            if all(os.path.isfile(os.path.join(path, f"dice_{n}.png")) for n in range(1, 7)):
+                themes[name] = DiceTheme(name, path)
+    return themes
+
+DICE_THEMES = discover_themes()
+
+def resolve_theme(name: Optional[str]) -> str:
+    """ 知らない名前（素材を消したテーマなど）は既定に戻す """
+    if name in DICE_THEMES:
+        return name
+    return DICE_THEME_DEFAULT if DICE_THEME_DEFAULT in DICE_THEMES else "classic"
+
+def _recolor(img: Image.Image, recolor) -> Image.Image:
+    if recolor is None:
+        return img
+    rgb, alpha = img.convert("RGB"), img.getchannel("A")
+    if recolor == "invert":
+        # 白黒だけ反転し、色の付いた目（1の赤など）はそのまま残す
+        colored = rgb.convert("HSV").getchannel("S").point(lambda v: 255 if v > 64 else 0)
+        rgb = Image.composite(rgb, ImageOps.invert(rgb), colored)
+    else:
+        rgb = ImageChops.multiply(rgb, Image.new("RGB", img.size, tuple(recolor)))
+    rgb.putalpha(alpha)
+    return rgb
 
-def _load_die(n: int) -> Image.Image:
-    img = _DICE_CACHE.get(n)
-    if img is None:
-        path = os.path.join(DICE_ASSET_DIR, f"dice_{n}.png")
-        img = Image.open(path).convert("RGBA")
-        _DICE_CACHE[n] = img
-    return img
+class DiceAtlas:
+    """
+    1テーマぶんのスプライトシート。6面を使う大きさごとに1行ずつ1枚の RGBA に詰め、(目, 大きさ) → 切り出し矩形を持つ。
+    大きさは倍率（1.0=素材のまま、ANIM_SCALES）か px（グリッド用）。合成は alpha_composite(source=矩形) で写すだけで、
+    描画のたびの縮小はしない。縮小しても素材と同じ大きさになる面は素材の行を指すだけにする。
+    ロールアニメ用に (目, 倍率, 揺れ) → マス内の置き位置 も先に求めておく。
+    """
+    def __init__(self, faces: List[Image.Image], anim_scales: Sequence[float] = ANIM_SCALES,
+                 jitters: Sequence[int] = ANIM_JITTER, sizes: Sequence[int] = (GRID_DIE_SIZE,)):
+        self.cell = (max(f.width for f in faces), max(f.height for f in faces))    # 3つ並べるときの1マス
+        variants: List[tuple] = [(1.0, [f.size for f in faces])]
+        for s in anim_scales:
+            if s != 1.0:
+                variants.append((s, [(int(f.width * s), int(f.height * s)) for f in faces]))
+        for px in sizes:
+            variants.append((px, [(px, px)] * 6))
+        self.boxes: Dict[tuple, Tuple[int, int, int, int]] = {}
+        rows = []
+        y = width = 0
+        for key, dims in variants:
+            placed, x, h = [], 0, 0
+            for n, (face, (w, fh)) in enumerate(zip(faces, dims), 1):
+                if (w, fh) == face.size and key != 1.0:
+                    self.boxes[(n, key)] = self.boxes[(n, 1.0)]
+                    continue
+                placed.append((n, face if (w, fh) == face.size else face.resize((w, fh), Image.LANCZOS), x))
+                self.boxes[(n, key)] = (x, y, x + w, y + fh)
+                x += w
+                h = max(h, fh)
+            rows.append((placed, y))
+            width = max(width, x)
+            y += h
+        self.image = Image.new("RGBA", (max(1, width), max(1, y)), (0, 0, 0, 0))
+        for placed, row_y in rows:
+            for _, sprite, x in placed:
+                self.image.paste(sprite, (x, row_y))
+        cw, ch = self.cell
+        self.offsets: Dict[tuple, Tuple[int, int]] = {}
+        for n in range(1, 7):
+            for s in anim_scales:
+                l, t, r, b = self.boxes[(n, s)]
+                for j in jitters:
+                    self.offsets[(n, s, j)] = ((cw - (r - l)) // 2, max(0, (ch - (b - t)) // 2 + j))
+        self._extra: Dict[tuple, Image.Image] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return self.image.width * self.image.height * len(self.image.getbands())
+
+    def sprite(self, n: int, size=1.0) -> Image.Image:
+        """ 1面を切り出した画像（パレット作りなど、1回きりの用途向け） """
+        return self.image.crop(self.boxes[(n, size)])
+
+    def blit(self, canvas: Image.Image, n: int, dest: Tuple[int, int], size=1.0):
+        box = self.boxes.get((n, size))
+        if box is not None:
+            canvas.alpha_composite(self.image, dest, box)
+            return
+        # アトラスに無い大きさ（設定外の die_size など）はその場で1回だけ縮小して覚えておく
+        img = self._extra.get((n, size))
+        if img is None:
+            img = self._extra[(n, size)] = self.sprite(n).resize((size, size), Image.LANCZOS)
+        canvas.alpha_composite(img, dest)
+
+_ATLASES: Dict[tuple, DiceAtlas] = {}
+
+def dice_atlas(theme: Optional[str] = None) -> DiceAtlas:
+    """ テーマのアトラス。初めて使うときに作る（描画ワーカーのプロセスではそのプロセスで1回） """
+    t = DICE_THEMES[resolve_theme(theme)]
+    atlas = _ATLASES.get(t.key)
+    if atlas is None:
+        faces = []
+        for n in range(1, 7):
+            with Image.open(os.path.join(t.source, f"dice_{n}.png")) as img:
+                faces.append(_recolor(img.convert("RGBA"), t.recolor))
+        atlas = _ATLASES.setdefault(t.key, DiceAtlas(faces))     # 並行して作られても1つに揃える
+    return atlas
+
+def atlas_bytes(theme: str) -> int:
+    """ テーマのアトラスが使っているメモリ（まだ作っていなければ 0） """
+    atlas = _ATLASES.get(DICE_THEMES[theme].key) if theme in DICE_THEMES else None
+    return atlas.nbytes if atlas else 0
+
+def theme_footprint_lines() -> List[str]:
+    """ テーマごとのアトラスの大きさ。同じアトラスを共有するテーマは並べて書く """
+    groups: Dict[tuple, List[str]] = {}
+    for name, t in DICE_THEMES.items():
+        groups.setdefault(t.key, []).append(name)
+    lines = []
+    for key, names in groups.items():
+        atlas = _ATLASES.get(key)
+        size = f"{atlas.nbytes / 1024:,.0f}KB（{atlas.image.width}×{atlas.image.height}）" if atlas else "未生成"
+        lines.append(f"{' = '.join(names)}：{size}")
+    total = sum(a.nbytes for a in _ATLASES.values())
+    lines.append(f"合計 {total / 1024:,.0f}KB（{len(_ATLASES)}枚）")
+    return lines
+
+for _name in DICE_THEMES:
+    METRICS.gauge("dice_atlas_bytes", lambda name=_name: atlas_bytes(name), theme=_name)
 
 def _make_canvas(w: int, h: int, bg=(255,255,255,0)) -> Image.Image:
     return Image.new("RGBA", (w, h), bg)
 
-def compose_three_dice_image(dice: List[int], gap: int = COMPOSITE_GAP) -> str:
-    faces = [_load_die(n) for n in dice]
-    die_w, die_h = faces[0].size
+def compose_three_dice_image(dice: List[int], gap: int = COMPOSITE_GAP, theme: Optional[str] = None) -> bytes:
+    atlas = dice_atlas(theme)
+    die_w, die_h = atlas.cell
     W = die_w * 3 + gap * 2
     H = die_h
     canvas = _make_canvas(W, H)
     x = 0
-    for img in faces:
-        canvas.alpha_composite(img, (x, 0))
+    for n in dice:
+        atlas.blit(canvas, n, (x, 0))
         x += die_w + gap
-    out_path = f"/tmp/dice_{dice[0]}{dice[1]}{dice[2]}_{random.randint(0,99999)}.png"
-    canvas.save(out_path, format="PNG")
-    return out_path
+    buf = io.BytesIO()
+    canvas.save(buf, format="PNG")
+    return buf.getvalue()
 
-def make_roll_animation(frames: int = ROLL_ANIM_FRAMES, duration_ms: int = ROLL_ANIM_MS, gap: int = COMPOSITE_GAP) -> tuple[str, List[int]]:
-    sample = _load_die(1)
-    die_w, die_h = sample.size
+def _grid_font(size: int):
+    try:
+        return ImageFont.load_default(size=size)
+    except (TypeError, AttributeError, OSError):
+        return ImageFont.load_default()
+
+def compose_dice_grid_image(rows: List[List[int]], highlight: Optional[int] = None, die_size: int = GRID_DIE_SIZE,
+                            theme: Optional[str] = None, max_rows: int = GRID_MAX_ROWS) -> bytes:
+    """
+    親決め用：1行1人で出目を縦に並べたPNG。行頭に番号、highlight 行は背景を付ける。
+    max_rows 人を超えたら先頭から描き（highlight 行は最後の枠に入れる）、残りは最終行に「+N」とだけ書く
+    （既定フォントに日本語が無いので画像内は数字だけ）
+    """
+    atlas = dice_atlas(theme)
+    shown = list(range(len(rows)))
+    if max_rows > 0 and len(rows) > max_rows:
+        shown = shown[:max_rows]
+        if highlight is not None and highlight not in shown:
+            shown[-1] = highlight
+    omitted = len(rows) - len(shown)
+    gap = max(4, die_size // 8)
+    label_w = die_size
+    row_h = die_size + gap
+    W = label_w + die_size * 3 + gap * 2 + gap
+    H = row_h * (len(shown) + (1 if omitted else 0)) + gap
+    canvas = _make_canvas(W, H)
+    draw = ImageDraw.Draw(canvas)
+    font = _grid_font(die_size // 2)
+    for row, i in enumerate(shown):
+        dice = rows[i]
+        y = gap + row * row_h
+        if i == highlight:
+            draw.rounded_rectangle((0, y - gap // 2, W - 1, y + die_size + gap // 2), radius=gap, fill=(255, 215, 0, 90))
+        draw.text((label_w // 2, y + die_size // 2), str(i + 1), fill=(255, 255, 255, 255), font=font,
+                  anchor="mm", stroke_width=2, stroke_fill=(0, 0, 0, 255))
+        x = label_w
+        for n in dice:
+            atlas.blit(canvas, n, (x, y), die_size)
+            x += die_size + gap
+    if omitted:
+        draw.text((W // 2, gap + len(shown) * row_h + die_size // 2), f"+{omitted}", fill=(255, 255, 255, 255),
+                  font=font, anchor="mm", stroke_width=2, stroke_fill=(0, 0, 0, 255))
+    buf = io.BytesIO()
+    canvas.save(buf, format="PNG")
+    return buf.getvalue()
+
+def _roll_frames(frames: int, gap: int, matte: Optional[Tuple[int, int, int]] = None,
+                 theme: Optional[str] = None) -> Tuple[List[Image.Image], List[int]]:
+    """ ロールアニメの各コマ（RGBA）と最終コマの目。matte を渡すと不透明な背景にする。縮小と揺れはアトラスで済ませてある """
+    atlas = dice_atlas(theme)
+    die_w, die_h = atlas.cell
     W = die_w * 3 + gap * 2
     H = die_h
+    bg = matte + (255,) if matte else (255,255,255,0)
     seq = []
     last_dice = [1,1,1]
     for i in range(frames):
         cur = [random.randint(1,6) for _ in range(3)]
         last_dice = cur[:]
-        canvas = _make_canvas(W,H)
-        jitter = ((frames - i) % 3) - 1
+        canvas = _make_canvas(W,H,bg)
+        scale = ANIM_SCALES[i % len(ANIM_SCALES)]
+        jitter = ANIM_JITTER[(frames - i) % len(ANIM_JITTER)]
         x = 0
         for n in cur:
-            img = _load_die(n)
-            scale = 0.94 + 0.06 * (i % 2)
-            nw, nh = int(die_w*scale), int(die_h*scale)
-            img2 = img.resize((nw, nh), Image.LANCZOS)
-            y = max(0, (H - nh)//2 + jitter)
-            canvas.alpha_composite(img2, (x + (die_w - nw)//2, y))
+            dx, dy = atlas.offsets[(n, scale, jitter)]
+            atlas.blit(canvas, n, (x + dx, dy), scale)
             x += die_w + gap
         seq.append(canvas)
-    tmp_id = random.randint(0,99999)
-    webp_path = f"/tmp/roll_{tmp_id}.webp"
-    gif_path  = f"/tmp/roll_{tmp_id}.gif"
+    return seq, last_dice
+
+@functools.lru_cache(maxsize=1)
+def anim_formats() -> Tuple[str, ...]:
+    """ このPillowでエンコードできるアニメ形式（1プロセスにつき1回だけ試し書きする） """
+    available = []
+    probe = [Image.new("RGBA", (8, 8), (255, 0, 0, 255)), Image.new("RGBA", (8, 8), (0, 0, 255, 255))]
     try:
-        seq[0].save(webp_path, save_all=True, append_images=seq[1:], duration=ROLL_ANIM_MS, loop=0, disposal=2, format="WEBP")
-        return webp_path, last_dice
-    except Exception:
-        seq[0].save(gif_path, save_all=True, append_images=seq[1:], duration=ROLL_ANIM_MS, loop=0, disposal=2, format="GIF")
-        return gif_path, last_dice
+        buf = io.BytesIO()
+        probe[0].save(buf, format="WEBP", save_all=True, append_images=probe[1:], duration=50, loop=0)
+        if getattr(Image.open(io.BytesIO(buf.getvalue())), "n_frames", 1) == 2:
+            available.append("webp")
+    except (OSError, KeyError, ValueError):
+        pass
+    available.append("gif")
+    return tuple(available)
+
+@functools.lru_cache(maxsize=None)
+def negotiate_anim_format(requested: str = ANIM_FORMAT) -> str:
+    available = anim_formats()
+    if requested in available:
+        return requested
+    if requested != "auto":
+        print(f"ロールアニメ：{requested} は使えないため {available[0]} で出力します（使用可能：{', '.join(available)}）")
+    return available[0]
+
+@functools.lru_cache(maxsize=32)
+def _anim_palette(colors: int, theme: Optional[str] = None) -> Image.Image:
+    """ 6面＋背景色から作る共通パレット。全コマをこれに合わせるので、動かない画素はコマ間で同じ色番号になる """
+    faces = [dice_atlas(theme).sprite(n) for n in range(1, 7)]
+    w, h = dice_atlas(theme).cell
+    strip = Image.new("RGB", (w * 6, h), ANIM_MATTE)
+    for i, face in enumerate(faces):
+        strip.paste(face, (i * w, 0), face)
+    return strip.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+
+def _encode_gif(seq: List[Image.Image], duration_ms: int, colors: int, theme: Optional[str] = None) -> bytes:
+    # 不透明＋共通パレット＋disposal=1 なので、Pillow が前のコマとの差分の矩形だけを書き出す
+    pal = _anim_palette(colors, resolve_theme(theme))
+    frames = [f.convert("RGB").quantize(palette=pal, dither=Image.Dither.NONE) for f in seq]
+    buf = io.BytesIO()
+    frames[0].save(buf, format="GIF", save_all=True, append_images=frames[1:], duration=duration_ms,
+                   loop=0, disposal=1, optimize=False)
+    return buf.getvalue()
+
+def _encode_webp(seq: List[Image.Image], duration_ms: int, quality: int, lossless: bool) -> bytes:
+    # libwebp のアニメエンコーダは前のコマとの差分の矩形だけを符号化する（lossless の quality は圧縮の手間）
+    buf = io.BytesIO()
+    seq[0].save(buf, format="WEBP", save_all=True, append_images=seq[1:], duration=duration_ms, loop=0,
+                quality=quality, lossless=lossless, alpha_quality=ANIM_WEBP_ALPHA_QUALITY, method=ANIM_WEBP_METHOD)
+    return buf.getvalue()
+
+def _encode_steps(fmt: str):
+    """ バイト予算に収まらないときに順に試す設定（最初が既定） """
+    if fmt == "webp":
+        if ANIM_WEBP_LOSSLESS:
+            yield {"quality": 100, "lossless": True}
+        for q in dict.fromkeys((ANIM_WEBP_QUALITY, 60, 45, 30)):
+            if q <= ANIM_WEBP_QUALITY:
+                yield {"quality": q, "lossless": False}
+    else:
+        for colors in dict.fromkeys((ANIM_GIF_COLORS, 32, 16)):     # 既定の 32 を2回試さない
+            if colors <= ANIM_GIF_COLORS:
+                yield {"colors": colors}
+
+def encode_roll_animation(frames: int = ROLL_ANIM_FRAMES, duration_ms: int = ROLL_ANIM_MS, gap: int = COMPOSITE_GAP,
+                          fmt: str = "auto", budget: int = ANIM_BYTE_BUDGET, theme: Optional[str] = None) -> Tuple[bytes, str, List[int], dict]:
+    """
+    make_roll_animation の本体。4つ目に {fmt, bytes, encode_ms, frames, 設定, attempts, over_budget} を返す。
+    budget > 0 なら収まるまで品質/色数を落とし、それでも超えるならコマを間引く。
+    """
+    fmt = negotiate_anim_format(fmt)
+    seq, last_dice = _roll_frames(frames, gap, matte=ANIM_MATTE if fmt == "gif" else None, theme=theme)
+    t0 = time.perf_counter()
+    attempts = 0
+    data, params = b"", {}
+    for thin in (False, True):
+        if thin:
+            seq = seq[::-2][::-1]       # 1コマおきに（最終コマは残す）
+            duration_ms *= 2
+        for params in _encode_steps(fmt):
+            attempts += 1
+            data = _encode_webp(seq, duration_ms, **params) if fmt == "webp" else _encode_gif(seq, duration_ms, theme=theme, **params)
+            if budget <= 0 or len(data) <= budget:
+                break
+        if budget <= 0 or len(data) <= budget or len(seq) <= 2:
+            break
+    info = dict(params, fmt=fmt, theme=resolve_theme(theme), bytes=len(data), encode_ms=1000.0 * (time.perf_counter() - t0),
+                frames=len(seq), attempts=attempts, over_budget=budget > 0 and len(data) > budget)
+    return data, fmt, last_dice, info
+
+def make_roll_animation(frames: int = ROLL_ANIM_FRAMES, duration_ms: int = ROLL_ANIM_MS, gap: int = COMPOSITE_GAP,
+                        fmt: str = "auto", theme: Optional[str] = None) -> tuple[bytes, str, List[int]]:
+    """
+    ロールアニメを生成し (エンコード済みbytes, 拡張子, 最終コマの目) を返す。
+    fmt: "auto"（使えればWEBP）/ "webp" / "gif"。使えない形式は起動時の判定に従って置き換える
+    """
+    return encode_roll_animation(frames, duration_ms, gap, fmt, theme=theme)[:3]
 
-async def send_roll_animation(channel: discord.abc.Messageable, title: str) -> tuple[discord.Message, List[int], str]:
-    anim_path, last_visual = make_roll_animation()
-    msg = await channel.send(content=title, file=discord.File(anim_path, filename=os.path.basename(anim_path)))
-    return msg, last_visual, anim_path
+# ===== 描画ワーカー =====
+class RenderExecutor:
+    """
+    Pillowの描画/エンコードをイベントループの外（スレッド or プロセス）で実行する。
+    同時に抱えるジョブは max_pending 件まで。溢れた分は枠が空くまで待たせる（バックプレッシャ）。
+    """
+    def __init__(self, workers: int = RENDER_WORKERS, kind: str = RENDER_EXECUTOR, max_pending: int = RENDER_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.kind = kind
+        self.max_pending = max(1, max_pending)
+        self._pool: Optional[concurrent.futures.Executor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.pending = 0      # ワーカーに投入済み（実行中＋ワーカー待ち）
+        self.waiting = 0      # 枠が空くのを待っている
+        self.peak_depth = 0
+        self.completed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self.pending + self.waiting
+
+    def _executor(self) -> concurrent.futures.Executor:
+        if self._pool is None:
+            if self.kind == "process":
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+        return self._pool
+
+    async def run(self, fn, *args, **kwargs):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.waiting += 1
+        self.peak_depth = max(self.peak_depth, self.queue_depth)
+        t0 = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        name = getattr(fn, "__name__", "render")
+        METRICS.observe("render_wait_seconds", time.perf_counter() - t0, fn=name)
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with METRICS.timer("render_seconds", fn=name):
+                return await loop.run_in_executor(self._executor(), functools.partial(fn, *args, **kwargs))
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            self._slots.release()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+RENDER = RenderExecutor()
+METRICS.gauge("render_queue_depth", lambda: RENDER.queue_depth)
+METRICS.gauge("render_queue_peak", lambda: RENDER.peak_depth)
+
+async def compose_three_dice_image_async(dice: List[int], gap: int = COMPOSITE_GAP, theme: Optional[str] = None) -> bytes:
+    return await RENDER.run(compose_three_dice_image, list(dice), gap, theme)
+
+LAST_ANIM_ENCODE: dict = {}    # 直近のロールアニメのエンコード結果（/chi_status 用）
+
+def record_anim_encode(info: dict):
+    LAST_ANIM_ENCODE.clear()
+    LAST_ANIM_ENCODE.update(info)
+    METRICS.inc("anim_encodes", fmt=info["fmt"])
+    METRICS.inc("anim_bytes", info["bytes"], fmt=info["fmt"])
+    METRICS.observe("anim_encode_seconds", info["encode_ms"] / 1000.0, fmt=info["fmt"])
+    if info["over_budget"]:
+        METRICS.inc("anim_over_budget", fmt=info["fmt"])
+
+async def make_roll_animation_async(frames: int = ROLL_ANIM_FRAMES, duration_ms: int = ROLL_ANIM_MS, gap: int = COMPOSITE_GAP,
+                                    fmt: str = "auto", theme: Optional[str] = None) -> tuple[bytes, str, List[int]]:
+    data, ext, last_dice, info = await RENDER.run(encode_roll_animation, frames, duration_ms, gap, fmt, theme=theme)
+    record_anim_encode(info)
+    return data, ext, last_dice
+
+async def compose_dice_grid_image_async(rows: List[List[int]], highlight: Optional[int] = None, die_size: int = GRID_DIE_SIZE,
+                                        theme: Optional[str] = None) -> bytes:
+    return await RENDER.run(compose_dice_grid_image, [list(r) for r in rows], highlight, die_size, theme)
+
+# ===== 結果画像キャッシュ =====
+class CompositeCache:
+    """
+    合成済みPNGを (目の並び, gap, テーマ) をキーに保持する。目の並びは1テーマ216通りしかないので基本は全部載る。
+    max_bytes > 0 のときは合計サイズが超えないよう古いものからLRUで追い出す。
+    """
+    def __init__(self, max_bytes: int = COMPOSITE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+        return data
+
+    def put(self, key: tuple, data: bytes):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.total_bytes -= len(old)
+        self._items[key] = data
+        self.total_bytes += len(data)
+        if self.max_bytes > 0:
+            while self.total_bytes > self.max_bytes and len(self._items) > 1:
+                _, dropped = self._items.popitem(last=False)
+                self.total_bytes -= len(dropped)
+
+    async def get_or_render(self, dice: List[int], gap: int = COMPOSITE_GAP, theme: Optional[str] = None) -> bytes:
+        theme = resolve_theme(theme)
+        key = (tuple(dice), gap, theme)
+        data = self.get(key)
+        if data is not None:
+            return data
+        fut = self._inflight.get(key)
+        if fut is not None:     # 同じ目を描画中なら相乗り
+            return await fut
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            data = await compose_three_dice_image_async(list(dice), gap, theme)
+            self.put(key, data)
+            fut.set_result(data)
+            return data
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # 相乗りがいなくても警告を出さない
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def prewarm(self, gap: int = COMPOSITE_GAP, theme: Optional[str] = None):
+        for dice in itertools.product(range(1, 7), repeat=3):
+            await self.get_or_render(list(dice), gap, theme)
+
+COMPOSITE_CACHE = CompositeCache()
+
+# ===== ロールアニメのプール =====
+class AnimationPool:
+    """
+    ロールアニメをテーマごとに事前にN本レンダリングしてメモリに保持する。
+    既定のテーマは起動時に作り、ほかのテーマは初めて使われたときに1本その場で作って残りをバックグラウンドで埋める。
+    同じチャンネルで同じアニメが連続しないように選ぶ。
+    cache_dir を指定すると <テーマ>/roll_XX.<ext> として保存し、次回起動時はそれを読む。
+    """
+    def __init__(self, size: int = ANIM_POOL_SIZE, cache_dir: str = ANIM_POOL_DIR):
+        self.size = size
+        self.cache_dir = cache_dir
+        self.items: Dict[str, List[Tuple[bytes, str, List[int]]]] = defaultdict(list)
+        self._last: Dict[int, Tuple[str, int]] = {}      # channel_id -> 直前に出した (テーマ, プール番号)
+        self._fill_tasks: Dict[str, asyncio.Task] = {}
+
+    def _dir(self, theme: str) -> str:
+        return os.path.join(self.cache_dir, theme) if self.cache_dir else ""
+
+    def load_from_disk(self, theme: Optional[str] = None) -> int:
+        theme = resolve_theme(theme)
+        items, path = self.items[theme], self._dir(theme)
+        if not path or not os.path.isdir(path):
+            return 0
+        for name in sorted(os.listdir(path)):
+            if len(items) >= self.size:
+                break
+            stem, _, ext = name.rpartition(".")
+            if not stem.startswith("roll_") or ext not in ("webp", "gif"):
+                continue
+            with open(os.path.join(path, name), "rb") as f:
+                items.append((f.read(), ext, [1,1,1]))
+        return len(items)
+
+    def _save_to_disk(self, theme: str, idx: int, data: bytes, ext: str):
+        path = self._dir(theme)
+        if not path:
+            return
+        try:
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, f"roll_{idx:02d}.{ext}"), "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print("Anim pool save error:", e)
+
+    async def _render_one(self, theme: str) -> Tuple[bytes, str, List[int]]:
+        item = await make_roll_animation_async(theme=theme)
+        items = self.items[theme]
+        if len(items) < self.size:
+            items.append(item)
+            self._save_to_disk(theme, len(items) - 1, item[0], item[1])
+        return item
+
+    async def fill(self, theme: Optional[str] = None):
+        theme = resolve_theme(theme)
+        while len(self.items[theme]) < self.size:
+            await self._render_one(theme)
+
+    def _fill_later(self, theme: str):
+        task = self._fill_tasks.get(theme)
+        if len(self.items[theme]) < self.size and (task is None or task.done()):
+            self._fill_tasks[theme] = asyncio.create_task(self.fill(theme))
+
+    def start(self, theme: Optional[str] = None):
+        """ 起動時に呼ぶ。ディスクにあれば読み込み、足りない分はバックグラウンドで生成 """
+        theme = resolve_theme(theme)
+        self.load_from_disk(theme)
+        self._fill_later(theme)
+
+    async def pick(self, channel_id: int, theme: Optional[str] = None) -> Tuple[bytes, str, List[int]]:
+        theme = resolve_theme(theme)
+        items = self.items[theme]
+        if not items:
+            # まだ1本もない（起動直後・初めてのテーマ）→ その場で1本作ってプールに入れ、残りは後で埋める
+            if self.cache_dir and self.load_from_disk(theme):
+                return await self.pick(channel_id, theme)
+            item = await self._render_one(theme)
+            self._last[channel_id] = (theme, 0)
+            self._fill_later(theme)
+            return item
+        last = self._last.get(channel_id)
+        choices = [i for i in range(len(items)) if last != (theme, i)] or [0]
+        idx = random.choice(choices)
+        self._last[channel_id] = (theme, idx)
+        return items[idx]
+
+    def forget(self, channel_id: int):
+        """ 閉じた・退避した卓の「直前に出したアニメ」を捨てる """
+        self._last.pop(channel_id, None)
+
+ANIM_POOL = AnimationPool()
+
+async def roll_animation_file(channel_id: int, theme: Optional[str] = None) -> Tuple[discord.File, List[int]]:
+    data, ext, last_visual = await ANIM_POOL.pick(channel_id, theme)
+    return discord.File(io.BytesIO(data), filename=f"roll.{ext}"), last_visual
+
+async def final_image_file(dice: List[int], theme: Optional[str] = None) -> discord.File:
+    png = await COMPOSITE_CACHE.get_or_render(dice, theme=theme)
+    return discord.File(io.BytesIO(png), filename=f"dice_{dice[0]}{dice[1]}{dice[2]}.png")
+
+def roll_result_text(who_mention: str, role_label: str, hand_label: str, tries: int) -> str:
+    return f"{role_label} {who_mention} のロール #{tries}\n→ **{hand_label}**"
+
+async def send_roll_animation(channel: discord.abc.Messageable, title: str,
+                              theme: Optional[str] = None) -> Tuple[Optional[discord.Message], List[int], str]:
+    """ ロールアニメを投稿する。チャンネルが混んでいれば出さずに (None, [], "") を返す（呼び出し側は結果だけ出す） """
+    cid = getattr(channel, "id", 0)
+    if OUTBOUND.hot(cid):
+        METRICS.inc("outbound_shed", kind="send")
+        return None, [], ""
+    file, last_visual = await roll_animation_file(cid, theme)
+    try:
+        msg = await _send(channel, content=title, file=file, priority=PRIO_COSMETIC)
+    except Shed:
+        return None, [], ""
+    return msg, last_visual, file.filename
 
-async def send_final_composited_image(channel, who_mention: str, role_label: str, dice: List[int], hand_label: str, tries: int):
-    png_path = compose_three_dice_image(dice)
-    text = f"{role_label} {who_mention} のロール #{tries}\n→ **{hand_label}**"
-    await channel.send(content=text, file=discord.File(png_path, filename=os.path.basename(png_path)))
+async def send_final_composited_image(channel, who_mention: str, role_label: str, dice: List[int], hand_label: str, tries: int,
+                                      theme: Optional[str] = None):
+    file = await final_image_file(dice, theme)
+    await _send(channel, content=roll_result_text(who_mention, role_label, hand_label, tries), file=file)
 
 # ================== 状態管理 ==================
 class RoundState:
@@ -181,10 +2198,29 @@ class RoundState:
         self.last_roll: Optional[List[int]] = None
         self.final: Optional[HandResult] = None
 
+    def to_dict(self) -> dict:
+        return {
+            "user_id": self.user_id, "role_label": self.role_label, "tries": self.tries,
+            "last_roll": self.last_roll, "final": self.final.score if self.final else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Optional[dict]) -> Optional["RoundState"]:
+        if d is None:
+            return None
+        rs = cls(d["user_id"], d["role_label"])
+        rs.tries = d["tries"]
+        rs.last_roll = d["last_roll"]
+        rs.final = HAND_BY_SCORE[d["final"]] if d["final"] is not None else None
+        return rs
+
 class GameState:
-    def __init__(self, channel_id: int, host_id: int):
+    def __init__(self, channel_id: int, host_id: int, guild_id: Optional[int] = None, rng: Optional[DiceStream] = None):
         self.channel_id = channel_id
         self.host_id = host_id
+        self.guild_id = guild_id
+        self.game_id = os.urandom(8).hex()       # 同じチャンネルで立て直した卓と区別する（精算の冪等キー用）
+        self.round_no = 0                        # 終わったラウンド数
 
         self.lobby_open = True
         self.lobby_message_id: Optional[int] = None
@@ -196,15 +2232,309 @@ class GameState:
         self.bets: Dict[int, int] = {}           # 確定ベット
         self.temp_bets: Dict[int, int] = {}      # 入力途中の一時ベット
         self.bet_panel_message_id: Optional[int] = None
+        self.bet_panel: Optional["PanelRenderer"] = None
+        self.turn_message_id: Optional[int] = None   # いまの手番（ROLL/STOP ボタン）のメッセージ
 
         self.turn_index = 0
         self.parent_hand: Optional[HandResult] = None
         self.phase: str = "lobby"                # lobby -> choose_parent -> betting -> parent_roll -> children_roll
         self.parent_round: Optional[RoundState] = None
         self.child_round: Optional[RoundState] = None
-        self.lock = asyncio.Lock()
+        self.ledger = SettlementLedger()
+        # このラウンドの出目（seed は終わるまで明かさない）。読み込み時は保存済みの列を渡す（seed を無駄に作らない）
+        self.rng = rng if rng is not None else DiceStream.for_round(channel_id, 0)
+        self.theme: Optional[str] = None         # 卓で選んだサイコロのテーマ（None ならサーバーの既定）
+        self.actor: Optional["TableActor"] = None
+        self.last_active = time.monotonic()      # 最後に操作された時刻（保存しない）
+        self.pins = 0                            # アクターへ積む途中の操作数（この間は退避しない）
+        self.views: "weakref.WeakSet[discord.ui.View]" = weakref.WeakSet()   # この卓に結び付いたビュー（保存しない）
+
+    def stop_views(self, *kinds: type):
+        """ 卓のビューを止めて ViewStore から外す（kinds を渡せばその種類だけ）。止めないとビュー経由で卓が残り続ける """
+        for view in list(self.views):
+            if not kinds or isinstance(view, kinds):
+                view.stop()
+                self.views.discard(view)
+
+    def to_dict(self) -> dict:
+        return {
+            "channel_id": self.channel_id, "host_id": self.host_id, "guild_id": self.guild_id, "game_id": self.game_id,
+            "round_no": self.round_no,
+            "lobby_open": self.lobby_open, "lobby_message_id": self.lobby_message_id,
+            "participants": self.participants, "parent_id": self.parent_id, "children_order": self.children_order,
+            "bets": self.bets, "temp_bets": self.temp_bets, "bet_panel_message_id": self.bet_panel_message_id,
+            "turn_message_id": self.turn_message_id,
+            "turn_index": self.turn_index, "parent_hand": self.parent_hand.score if self.parent_hand else None,
+            "phase": self.phase,
+            "parent_round": self.parent_round.to_dict() if self.parent_round else None,
+            "child_round": self.child_round.to_dict() if self.child_round else None,
+            "ledger": {"entries": self.ledger.entries, "rounds": self.ledger.rounds},
+            "rng": self.rng.to_dict(), "theme": self.theme,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "GameState":
+        rng = DiceStream.from_dict(d["rng"]) if d.get("rng") else DiceStream.for_round(d["channel_id"], d.get("round_no", 0))
+        game = cls(d["channel_id"], d["host_id"], d.get("guild_id"), rng=rng)
+        game.game_id = d.get("game_id", f"c{game.channel_id}")
+        game.round_no = d.get("round_no", 0)
+        game.lobby_open = d["lobby_open"]
+        game.lobby_message_id = d["lobby_message_id"]
+        game.participants = list(d["participants"])
+        game.parent_id = d["parent_id"]
+        game.children_order = list(d["children_order"])
+        game.bets = {int(k): v for k, v in d["bets"].items()}
+        game.temp_bets = {int(k): v for k, v in d["temp_bets"].items()}
+        game.bet_panel_message_id = d["bet_panel_message_id"]
+        game.turn_message_id = d.get("turn_message_id")
+        game.turn_index = d["turn_index"]
+        game.parent_hand = HAND_BY_SCORE[d["parent_hand"]] if d["parent_hand"] is not None else None
+        game.phase = d["phase"]
+        game.parent_round = RoundState.from_dict(d["parent_round"])
+        game.child_round = RoundState.from_dict(d["child_round"])
+        game.ledger.entries = [tuple(e) for e in d["ledger"]["entries"]]
+        game.ledger.rounds = d["ledger"]["rounds"]
+        game.theme = d.get("theme")
+        if game.phase == "choose_parent":
+            # 親決めの途中で落ちた → ロビーに戻してやり直せるようにする
+            game.phase = "lobby"
+            game.lobby_open = True
+        return game
+
+class GameStore:
+    """
+    GameState のスナップショットを SQLite(WAL) に1ゲーム1行で保存する。
+    フェーズの区切りごとに save() し、読み込みはチャンネルごとに必要になった時だけ行う。
+    """
+    def __init__(self, path: str = GAME_DB_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS games ("
+                " channel_id INTEGER PRIMARY KEY, phase TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def save(self, game: GameState):
+        if not self.enabled:
+            return
+        self._db().execute(
+            "INSERT OR REPLACE INTO games (channel_id, phase, data, updated_at) VALUES (?, ?, ?, ?)",
+            (game.channel_id, game.phase, json.dumps(game.to_dict(), separators=(",", ":")), time.time()),
+        )
+
+    def load(self, channel_id: int) -> Optional[GameState]:
+        if not self.enabled:
+            return None
+        row = self._db().execute("SELECT data FROM games WHERE channel_id = ?", (channel_id,)).fetchone()
+        return GameState.from_dict(json.loads(row[0])) if row else None
+
+    def delete(self, channel_id: int):
+        if self.enabled:
+            self._db().execute("DELETE FROM games WHERE channel_id = ?", (channel_id,))
+
+    def count(self) -> int:
+        if not self.enabled:
+            return 0
+        return self._db().execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    # --- シャード状況（複数プロセスで同じDBを共有して突き合わせる）
+    def report_shard(self, shard_id: int, latency_ms: Optional[float], tables: int, guilds: int):
+        if not self.enabled:
+            return
+        db = self._db()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            " shard_id INTEGER PRIMARY KEY, pid INTEGER, latency_ms REAL, tables INTEGER, guilds INTEGER, updated_at REAL)"
+        )
+        db.execute(
+            "INSERT OR REPLACE INTO shards (shard_id, pid, latency_ms, tables, guilds, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (shard_id, os.getpid(), latency_ms, tables, guilds, time.time()),
+        )
+
+    # --- 任意のキー/値（コマンド定義のハッシュなど）
+    def get_meta(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        if not self.enabled:
+            return
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def shard_reports(self) -> List[Tuple[int, int, Optional[float], int, int, float]]:
+        if not self.enabled:
+            return []
+        try:
+            return self._db().execute(
+                "SELECT shard_id, pid, latency_ms, tables, guilds, updated_at FROM shards ORDER BY shard_id"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return []
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class TableManager:
+    """
+    メモリ上の卓（channel_id → GameState）。チャンネルIDはスレッドのIDでもよい。
+    使われた順を覚えておき、放置された卓（idle_ttl）と上限（max_live）を超えた分を、
+    使われていない順にストアへ退避してメモリから外す（次に触られたとき get_game が読み直す）。
+    ストアが無効だと退避できないので、放置卓は閉じ、上限では新しい卓を断る。
+    """
+    def __init__(self, idle_ttl: float = TABLE_IDLE_TTL, max_live: int = TABLE_MAX_LIVE):
+        self.idle_ttl = idle_ttl
+        self.max_live = max_live
+        self._tables: "OrderedDict[int, GameState]" = OrderedDict()
+        self.evicted: Counter = Counter()
+
+    # --- dict と同じ使い方
+    def get(self, channel_id: int, default=None) -> Optional[GameState]:
+        return self._tables.get(channel_id, default)
+
+    def __getitem__(self, channel_id: int) -> GameState:
+        return self._tables[channel_id]
+
+    def __setitem__(self, channel_id: int, game: GameState):
+        self._tables[channel_id] = game
+        self.touch(game)
+        self._enforce_cap(keep=game)
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._tables
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+    def pop(self, channel_id: int, default=None) -> Optional[GameState]:
+        return self._tables.pop(channel_id, default)
+
+    def values(self):
+        return self._tables.values()
+
+    # --- 管理
+    def touch(self, game: GameState):
+        game.last_active = time.monotonic()
+        if self._tables.get(game.channel_id) is game:
+            self._tables.move_to_end(game.channel_id)
+
+    def is_full(self) -> bool:
+        """ 新しい卓を作れないか（ストアがあれば退避できるので常に作れる） """
+        return not STORE.enabled and len(self._tables) >= self.max_live
+
+    @staticmethod
+    def _busy(game: GameState) -> bool:
+        actor = game.actor
+        if game.pins:
+            return True
+        return actor is not None and (actor.current is not None or not actor.queue.empty())
+
+    def spill(self, game: GameState, reason: str):
+        """ ストアに書いてメモリから外す。締切タイマーは残す（期限が来たら読み直して進める） """
+        persist(game)
+        if self._tables.get(game.channel_id) is game:
+            del self._tables[game.channel_id]
+        if game.actor is not None:
+            game.actor.close()
+        game.stop_views()       # ボタンは起動時の受け口が拾って読み直す
+        ANIM_POOL.forget(game.channel_id)
+        self.evicted[reason] += 1
+
+    def _enforce_cap(self, keep: Optional[GameState] = None):
+        """ 上限を超えた分を古い順に退避する。処理中の卓と今入れた卓は残す（一時的に上限を超えてよい） """
+        if not STORE.enabled:
+            return
+        for game in list(self._tables.values()):
+            if len(self._tables) <= self.max_live:
+                break
+            if game is not keep and not self._busy(game):
+                self.spill(game, "lru")
+
+    def sweep(self) -> List[GameState]:
+        """ 放置された卓を退避する。ストアが無くて閉じた卓を返す（精算とお知らせは呼び出し側で） """
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [g for g in self._tables.values() if g.last_active < cutoff and not self._busy(g)]
+        closed = []
+        for game in idle:
+            if STORE.enabled:
+                self.spill(game, "idle")
+            else:
+                drop_game(game.channel_id)
+                self.evicted["closed"] += 1
+                closed.append(game)
+        return closed
+
+    async def sweep_loop(self, interval: float = TABLE_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                closed = self.sweep()
+                self._enforce_cap()     # 入れたときに処理中で残した卓も、手が空いたらここで退避する
+            except sqlite3.Error as e:
+                print("Table sweep error:", e)
+                continue
+            for game in closed:
+                try:
+                    await close_idle_table(game)
+                except discord.HTTPException as e:
+                    print("Idle close notice error:", e)
+
+GAMES = TableManager()
+STORE = GameStore()
+
+def get_game(channel_id: int) -> Optional[GameState]:
+    """ メモリに無ければストアから読み込む（起動時に全件は読まない） """
+    game = GAMES.get(channel_id)
+    if game is None:
+        game = STORE.load(channel_id)
+        if game is not None:
+            GAMES[channel_id] = game
+            arm_deadline(game)      # 再起動をまたいだ卓も止まったままにしない
+    return game
+
+def persist(game: GameState):
+    try:
+        STORE.save(game)
+    except sqlite3.Error as e:
+        print("Game store error:", e)
+
+def drop_game(channel_id: int):
+    TIMERS.cancel(channel_id)
+    game = GAMES.pop(channel_id, None)
+    if game is not None:
+        if game.actor is not None:
+            game.actor.close()
+        game.stop_views()
+    ANIM_POOL.forget(channel_id)
+    try:
+        STORE.delete(channel_id)
+    except sqlite3.Error as e:
+        print("Game store error:", e)
 
-GAMES: Dict[int, GameState] = {}
+async def close_idle_table(game: GameState):
+    """ 放置で閉じた卓（drop_game 済み）の未精算分をアウトボックスに積み、チャンネルに知らせる """
+    channel = OUTBOX.channel_for(game.channel_id)
+    await settle_ledger(channel, game, "💴 精算（放置で閉じた卓）")
+    await _send(channel, "⏰ 卓が放置されていたため閉じました。")
 
 # ================== 表示ヘルパ ==================
 def lobby_text(game: GameState) -> str:
@@ -213,9 +2543,17 @@ def lobby_text(game: GameState) -> str:
         "🎲 **チンチロ ロビー**\n"
         f"ホスト：<@{game.host_id}>\n"
         f"参加者：{mems}\n\n"
-        "Joinで参加、Leaveで退出。ホストは「親を決める」で開始します。"
+        "Joinで参加、Leaveで退出。ホストは「親を決める」で開始します。\n"
+        f"{commit_text(game)}"
     )
 
+def commit_text(game: GameState) -> str:
+    return f"🔒 このラウンドの出目の seed ハッシュ：`{game.rng.commitment}`"
+
+def reveal_text(game: GameState) -> str:
+    """ ラウンドの終わりに seed を明かす（SHA-256 が開始時のハッシュと一致し、この seed から出目を再現できる） """
+    return f"🔓 このラウンドの seed：`{game.rng.seed.hex()}`（{game.rng.pos}バイト使用）"
+
 def bet_panel_text(game: GameState) -> str:
     lines = [f"💰 **ベット受付中**（+100/-100 → ✅確定）  親：<@{game.parent_id}>" if game.parent_id else "💰 **ベット受付中**（+100/-100 → ✅確定）"]
     if not game.children_order:
@@ -227,69 +2565,313 @@ def bet_panel_text(game: GameState) -> str:
     lines.append("\n※ 親が開始すると締切になります。")
     return "\n".join(lines)
 
-# ================== ロビー（参加）ビュー ==================
-class LobbyView(discord.ui.View):
-    def __init__(self, game: GameState, timeout: Optional[float] = 3600):
-        super().__init__(timeout=timeout)
+class PanelRenderer:
+    """
+    1つのパネルメッセージの表示を受け持つ。
+    状態が変わったら request() を呼ぶだけでよく、連続した変更は interval 秒に1回の edit にまとめる。
+    描画結果が前回と同じなら edit しない。メッセージは保持しているので fetch_message は不要。
+    """
+    def __init__(self, message, render: Callable[[], str], view: Optional[discord.ui.View] = None,
+                 interval: float = BET_PANEL_EDIT_INTERVAL, last_text: Optional[str] = None):
+        self.message = message
+        self.render = render
+        self.view = view
+        self.interval = interval
+        self.closed = False
+        self.edits = 0
+        self.skipped = 0
+        self._last_text = last_text
+        self._last_edit = time.monotonic() if last_text is not None else 0.0
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    def request(self):
+        if self.closed:
+            return
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._dirty and not self.closed:
+            wait = self._last_edit + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._dirty = False
+            await self.flush()
+
+    async def flush(self):
+        if self.closed:
+            return
+        text = self.render()
+        if text == self._last_text:
+            self.skipped += 1
+            return
+        self._last_text = text
+        self._last_edit = time.monotonic()
+        self.edits += 1
+        try:
+            await _edit(self.message, content=text, view=self.view)
+        except discord.HTTPException:
+            pass
+
+    async def close(self, text: str):
+        """ 保留中の更新を捨てて最終表示にする（ボタンも外す） """
+        self.closed = True
+        if self._task is not None and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+        try:
+            await _edit(self.message, content=text, view=None, priority=PRIO_URGENT)
+        except discord.HTTPException:
+            pass
+
+def bet_panel_renderer(channel, game: GameState, view: Optional[discord.ui.View] = None) -> Optional[PanelRenderer]:
+    """ ベットパネルの renderer を返す。メッセージIDしか無い場合は PartialMessage から作る """
+    if game.bet_panel is None and game.bet_panel_message_id and hasattr(channel, "get_partial_message"):
+        msg = channel.get_partial_message(game.bet_panel_message_id)
+        game.bet_panel = PanelRenderer(msg, lambda: bet_panel_text(game), view=view)
+    return game.bet_panel
+
+async def close_bet_panel(channel, game: GameState):
+    panel = bet_panel_renderer(channel, game)
+    game.stop_views(BetView)
+    if panel is not None:
+        await panel.close("⛔ ベットは締め切りました。")
+    game.bet_panel = None
+
+# ================== 卓アクター ==================
+# 卓をまたいだ受付状況（accepted / dedup / full / stale / error）
+ACTOR_STATS: Counter = Counter()
+
+REJECT_TEXT = {
+    "dedup": "処理中です。",
+    "full": "混み合っています。少し待ってからもう一度押してください。",
+    "stale": "いまはその操作はできません。",
+}
+
+class TableCommand:
+    """ 卓アクターに渡す1操作。phases 以外のフェーズで順番が来たら捨てる """
+    __slots__ = ("kind", "user_id", "phases", "inter", "run", "dedup", "enqueued_at")
+
+    def __init__(self, kind: str, user_id: int, phases: Optional[Tuple[str, ...]], inter: Optional[discord.Interaction],
+                 run: Callable[[], Awaitable[None]], dedup: bool = True):
+        self.kind = kind
+        self.user_id = user_id
+        self.phases = phases
+        self.inter = inter
+        self.run = run
+        self.dedup = dedup      # 同じ人の同じ操作が未処理のうちは重ねて受け付けない
+        self.enqueued_at = time.perf_counter()
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        return (self.kind, self.user_id)
+
+class TableActor:
+    """
+    1卓につき1タスクで操作を順番に処理する。ハンドラは応答(defer)して submit() するだけでよい。
+    卓ごとに独立しているので、ある卓の処理が長くても他の卓は待たない。
+    """
+    def __init__(self, game: GameState, maxsize: int = TABLE_QUEUE_MAX):
         self.game = game
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._keys: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.current: Optional[TableCommand] = None     # 処理中の操作
+
+    def submit(self, cmd: TableCommand) -> Optional[str]:
+        """ 受け付けたら None、断ったら理由（REJECT_TEXT のキー）を返す """
+        if self._closed:
+            ACTOR_STATS["stale"] += 1
+            return "stale"
+        if cmd.dedup and cmd.key in self._keys:
+            ACTOR_STATS["dedup"] += 1
+            return "dedup"
+        try:
+            self.queue.put_nowait(cmd)
+        except asyncio.QueueFull:
+            ACTOR_STATS["full"] += 1
+            return "full"
+        if cmd.dedup:
+            self._keys.add(cmd.key)
+        ACTOR_STATS["accepted"] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return None
+
+    async def _run(self):
+        while not self._closed:
+            cmd: TableCommand = await self.queue.get()
+            phase = self.game.phase
+            # 旧 GameState.lock の待ち時間に相当：積まれてから順番が来るまで
+            METRICS.observe("queue_wait_seconds", time.perf_counter() - cmd.enqueued_at, command=cmd.kind, phase=phase)
+            try:
+                if cmd.phases and phase not in cmd.phases:
+                    ACTOR_STATS["stale"] += 1
+                    if cmd.inter is not None:
+                        await _followup(cmd.inter, REJECT_TEXT["stale"], ephemeral=True)
+                    continue
+                self.current = cmd
+                with METRICS.timer("handler_seconds", command=cmd.kind, phase=phase):
+                    await cmd.run()
+            except Exception:
+                ACTOR_STATS["error"] += 1
+                METRICS.inc("handler_errors", command=cmd.kind)
+                traceback.print_exc()
+            finally:
+                self.current = None
+                self._keys.discard(cmd.key)
+
+    def close(self):
+        """ 卓の終了時に呼ぶ。自分の処理中から呼ばれた場合はその操作が終わってから止まる """
+        self._closed = True
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+def table_actor(game: GameState) -> TableActor:
+    if game.actor is None:
+        game.actor = TableActor(game)
+    return game.actor
+
+async def submit_command(inter: discord.Interaction, game: GameState, kind: str, phases: Optional[Tuple[str, ...]],
+                         fn: Callable[[discord.Interaction], Awaitable[None]], *, ephemeral: bool = False, dedup: bool = True):
+    """ 即座に応答してから卓アクターへ積む。断られたら本人にだけ伝える """
+    inter.extras.setdefault("t0", time.perf_counter())
+    GAMES.touch(game)
+    game.pins += 1      # defer 中に他の卓の読み込みで退避されると、操作が外れたオブジェクトに届いてしまう
+    try:
+        if not inter.response.is_done():
+            await inter.response.defer(ephemeral=ephemeral)
+        reason = table_actor(game).submit(TableCommand(kind, inter.user.id, phases, inter, lambda: fn(inter), dedup=dedup))
+    finally:
+        game.pins -= 1
+    if reason is not None:
+        await _followup(inter, REJECT_TEXT[reason], ephemeral=True)
+
+# ================== 永続ビュー共通 ==================
+class GameView(discord.ui.View):
+    """
+    再起動後もボタンが生きるよう timeout なし・固定 custom_id で作るビュー。
+    game なしで作ったものは起動時に add_view する受け口で、押されたらそのチャンネルのゲームを
+    読み込んで本来のビューを組み立て、同じ custom_id のボタン処理へ委譲する。
+    メッセージに結び付いたビューでも、卓が退避→読み直しで別のオブジェクトになっていたら古いビューは外し、同じく委譲する。
+    game 付きのビューは卓に登録し、卓を閉じる・退避する・その段階が終わるときに stop() して ViewStore から外す。
+    """
+    def __init__(self, game: Optional[GameState] = None):
+        super().__init__(timeout=None)
+        self.game = game
+        if game is not None:
+            game.views.add(self)    # 卓を閉じる・退避する・手番が終わるときに止める
+
+    def bind(self, game: GameState) -> Optional["GameView"]:
+        return type(self)(game)
+
+    async def submit(self, inter: discord.Interaction, kind: str, phases: Tuple[str, ...],
+                     fn: Callable[[discord.Interaction], Awaitable[None]], *, ephemeral: bool = False, dedup: bool = True):
+        await submit_command(inter, self.game, kind, phases, fn, ephemeral=ephemeral, dedup=dedup)
+
+    async def interaction_check(self, inter: discord.Interaction) -> bool:
+        if self.game is not None:
+            if get_game(self.game.channel_id) is self.game:
+                return True
+            self.stop()     # 退避された卓を掴んだままのビュー（押すと外れたオブジェクトに操作が届いてしまう）
+        game = get_game(inter.channel_id)
+        bound = self.bind(game) if game else None
+        custom_id = (inter.data or {}).get("custom_id")
+        item = next((c for c in (bound.children if bound else []) if getattr(c, "custom_id", None) == custom_id), None)
+        if item is None:
+            await inter.response.send_message("このボタンのゲームは終了しています。", ephemeral=True)
+            return False
+        await item.callback(inter)
+        return False
+
+# ================== ロビー（参加）ビュー ==================
+class LobbyView(GameView):
 
     async def _refresh(self, message: discord.Message):
-        await message.edit(content=lobby_text(self.game), view=self)
+        await _edit(message, content=lobby_text(self.game), view=self)
 
-    @discord.ui.button(label="Join", style=discord.ButtonStyle.success)
+    @discord.ui.button(label="Join", style=discord.ButtonStyle.success, custom_id="chi:lobby:join")
     async def join_btn(self, inter: discord.Interaction, button: discord.ui.Button):
-        await inter.response.defer(ephemeral=True)
+        await self.submit(inter, "join", ("lobby",), self._join, ephemeral=True)
+
+    async def _join(self, inter: discord.Interaction):
         if not self.game.lobby_open:
-            await inter.followup.send("ロビーは締め切られています。", ephemeral=True); return
+            await _followup(inter, "ロビーは締め切られています。", ephemeral=True); return
         uid = inter.user.id
         if uid in self.game.participants:
-            await inter.followup.send("すでに参加しています。", ephemeral=True); return
+            await _followup(inter, "すでに参加しています。", ephemeral=True); return
         self.game.participants.append(uid)
-        await inter.followup.send("参加しました。", ephemeral=True)
+        persist(self.game)
+        arm_deadline(self.game, inter.channel)
+        await _followup(inter, "参加しました。", ephemeral=True)
         await self._refresh(inter.message)
 
-    @discord.ui.button(label="Leave", style=discord.ButtonStyle.danger)
+    @discord.ui.button(label="Leave", style=discord.ButtonStyle.danger, custom_id="chi:lobby:leave")
     async def leave_btn(self, inter: discord.Interaction, button: discord.ui.Button):
-        await inter.response.defer(ephemeral=True)
+        await self.submit(inter, "leave", ("lobby",), self._leave, ephemeral=True)
+
+    async def _leave(self, inter: discord.Interaction):
         uid = inter.user.id
         if uid in self.game.participants:
             self.game.participants.remove(uid)
-            await inter.followup.send("退出しました。", ephemeral=True)
+            persist(self.game)
+            arm_deadline(self.game, inter.channel)
+            await _followup(inter, "退出しました。", ephemeral=True)
             await self._refresh(inter.message)
         else:
-            await inter.followup.send("参加していません。", ephemeral=True)
+            await _followup(inter, "参加していません。", ephemeral=True)
 
-    @discord.ui.button(label="親を決める", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="親を決める", style=discord.ButtonStyle.primary, custom_id="chi:lobby:decide")
     async def decide_parent_btn(self, inter: discord.Interaction, button: discord.ui.Button):
-        await inter.response.defer()
+        await self.submit(inter, "decide", ("lobby",), self._decide_parent)
+
+    async def _decide_parent(self, inter: discord.Interaction):
         if inter.user.id != self.game.host_id:
-            await inter.followup.send("ホストのみが開始できます。", ephemeral=True); return
+            await _followup(inter, "ホストのみが開始できます。", ephemeral=True); return
         if len(self.game.participants) < 2:
-            await inter.followup.send("参加者が2人以上必要です。", ephemeral=True); return
+            await _followup(inter, "参加者が2人以上必要です。", ephemeral=True); return
         if not self.game.lobby_open:
-            await inter.followup.send("すでに開始済みです。", ephemeral=True); return
+            await _followup(inter, "すでに開始済みです。", ephemeral=True); return
 
         self.game.lobby_open = False
         self.game.phase = "choose_parent"
-        await inter.followup.send("▶ 親決めを開始します。順番にロールします…")
+        persist(self.game)
+        self.game.stop_views(LobbyView)
+        names = await resolve_display_names(inter.guild, self.game.participants)
+        if PARENT_DECISION_BATCHED:
+            best_uid = await self._decide_parent_batched(inter, names)
+        else:
+            best_uid = await self._decide_parent_sequential(inter, names)
+
+        self.game.parent_id = best_uid
+        self.game.children_order = [u for u in self.game.participants if u != best_uid]
+        self.game.phase = "betting"
+        await send_bet_panel(inter.channel, self.game)
+
+    async def _decide_parent_sequential(self, inter: discord.Interaction, names: Dict[int, str]) -> int:
+        await _followup(inter, "▶ 親決めを開始します。順番にロールします…")
 
         best_uid = None
         best_hand: Optional[HandResult] = None
         logs = []
+        theme = table_theme(self.game)
 
         for uid in self.game.participants:
-            user = await bot.fetch_user(uid)
-            anim_msg, _, _ = await send_roll_animation(inter.channel, title=f"【親決め】{user.display_name} のロール中…")
-            dice = roll_dice()
+            anim_msg, _, _ = await send_roll_animation(inter.channel, title=f"【親決め】{names[uid]} のロール中…", theme=theme)
+            dice = roll_dice(self.game.rng)
             hand = evaluate_hand(dice)
 
-            try:
-                await anim_msg.edit(content=f"【親決め】{user.display_name} のロール中…\n（…止まりました）")
-            except Exception:
-                pass
-            await send_final_composited_image(inter.channel, who_mention=f"<@{uid}>", role_label="【親決め】", dice=dice, hand_label=str(hand), tries=1)
-            if DELETE_ANIM_AFTER_RESULT:
-                try: await anim_msg.delete()
+            if anim_msg is not None:
+                try:
+                    await _edit(anim_msg, content=f"【親決め】{names[uid]} のロール中…\n（…止まりました）", priority=PRIO_COSMETIC)
+                except Exception:
+                    pass
+            await send_final_composited_image(inter.channel, who_mention=f"<@{uid}>", role_label="【親決め】", dice=dice, hand_label=str(hand), tries=1,
+                                              theme=theme)
+            if DELETE_ANIM_AFTER_RESULT and anim_msg is not None:
+                try: await _delete(anim_msg)
                 except Exception: pass
 
             logs.append(f"<@{uid}>: {dice_face_str(dice)} → **{hand}**")
@@ -297,43 +2879,66 @@ class LobbyView(discord.ui.View):
             if best_hand is None or compare(best_hand, hand) > 0:
                 best_uid, best_hand = uid, hand
 
-        await inter.channel.send("結果：\n" + "\n".join(logs))
-        self.game.parent_id = best_uid
-        self.game.children_order = [u for u in self.game.participants if u != best_uid]
-        await inter.channel.send(
+        await _send(inter.channel, "結果：\n" + "\n".join(logs))
+        await _send(
+            inter.channel,
             f"👑 親は <@{best_uid}> に決定！\n"
             "このあとベットパネルが出ます。親は準備ができたら開始してください。"
         )
-        self.game.phase = "betting"
-        await send_bet_panel(inter.channel, self.game)
+        return best_uid
+
+    async def _decide_parent_batched(self, inter: discord.Interaction, names: Dict[int, str]) -> int:
+        """ 全員同時にロール。人数によらずAPI呼び出しは一定（開始通知・アニメ・結果・アニメ削除） """
+        uids = list(self.game.participants)
+        await _followup(inter, f"▶ 親決めを開始します。{len(uids)}人同時にロールします…")
+        who = "、".join(names[u] for u in uids)
+        if len(who) > 1500:
+            who = who[:1500] + "…"
+        theme = table_theme(self.game)
+        anim_msg, _, _ = await send_roll_animation(inter.channel, title=f"【親決め】{who} のロール中…", theme=theme)
+
+        rolls = [roll_dice(self.game.rng) for _ in uids]
+        hands = evaluate_hands(rolls)
+        best = 0
+        for i, hand in enumerate(hands):
+            # 同点なら先に振った人を優先（従来と同じ）
+            if compare(hands[best], hand) > 0:
+                best = i
+        grid = await compose_dice_grid_image_async(rolls, highlight=best, theme=theme)
+
+        logs = [f"{i+1}. <@{uid}>: {dice_face_str(d)} → **{h}**" for i, (uid, d, h) in enumerate(zip(uids, rolls, hands))]
+        logs += ["", f"👑 親は <@{uids[best]}> に決定！", "このあとベットパネルが出ます。親は準備ができたら開始してください。"]
+        # 大人数だと1通に収まらないので分ける（画像は1通目に付ける）
+        for i, text in enumerate(chunk_lines("【親決め】結果：", logs)):
+            if i == 0:
+                await _send(inter.channel, content=text, file=discord.File(io.BytesIO(grid), filename="parent_decision.png"))
+            else:
+                await _send(inter.channel, content=text)
+        if DELETE_ANIM_AFTER_RESULT and anim_msg is not None:
+            try: await _delete(anim_msg)
+            except Exception: pass
+        return uids[best]
 
 # ================== ベットビュー ==================
-class BetView(discord.ui.View):
-    def __init__(self, game: GameState, timeout: Optional[float] = 600):
-        super().__init__(timeout=timeout)
-        self.game = game
+class BetView(GameView):
 
     async def _ensure_child(self, inter: discord.Interaction) -> bool:
         uid = inter.user.id
         if self.game.phase != "betting":
-            await inter.response.send_message("いまはベット受付時間ではありません。", ephemeral=True)
+            await _followup(inter, "いまはベット受付時間ではありません。", ephemeral=True)
             return False
         if uid not in self.game.children_order:
-            await inter.response.send_message("今回ラウンドの子ではありません。", ephemeral=True)
+            await _followup(inter, "今回ラウンドの子ではありません。", ephemeral=True)
             return False
         return True
 
     async def _refresh_panel(self, inter: discord.Interaction):
-        if self.game.bet_panel_message_id:
-            try:
-                msg = await inter.channel.fetch_message(self.game.bet_panel_message_id)
-                await msg.edit(content=bet_panel_text(self.game), view=self)
-            except Exception:
-                pass
+        panel = bet_panel_renderer(inter.channel, self.game, view=self)
+        if panel is not None:
+            panel.request()
 
     async def _bump(self, inter: discord.Interaction, delta: int):
         if not await self._ensure_child(inter): return
-        await inter.response.defer(ephemeral=True)
         uid = inter.user.id
         cur = self.game.temp_bets.get(uid, self.game.bets.get(uid, 0))
         cur = max(0, min(MAX_BET, cur + delta))
@@ -341,129 +2946,174 @@ class BetView(discord.ui.View):
         await self._refresh_panel(inter)
         # 通知は出さない（UIだけ更新）
 
-    @discord.ui.button(label="+100", style=discord.ButtonStyle.success)
+    @discord.ui.button(label="+100", style=discord.ButtonStyle.success, custom_id="chi:bet:plus")
     async def plus_btn(self, inter: discord.Interaction, button: discord.ui.Button):
-        await self._bump(inter, BET_STEP)
+        await self.submit(inter, "bet", ("betting",), lambda i: self._bump(i, BET_STEP), ephemeral=True, dedup=False)
 
-    @discord.ui.button(label="-100", style=discord.ButtonStyle.danger)
+    @discord.ui.button(label="-100", style=discord.ButtonStyle.danger, custom_id="chi:bet:minus")
     async def minus_btn(self, inter: discord.Interaction, button: discord.ui.Button):
-        await self._bump(inter, -BET_STEP)
+        await self.submit(inter, "bet", ("betting",), lambda i: self._bump(i, -BET_STEP), ephemeral=True, dedup=False)
 
-    @discord.ui.button(label="クリア(0)", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="クリア(0)", style=discord.ButtonStyle.secondary, custom_id="chi:bet:clear")
     async def clear_btn(self, inter: discord.Interaction, button: discord.ui.Button):
+        await self.submit(inter, "bet", ("betting",), self._clear, ephemeral=True, dedup=False)
+
+    async def _clear(self, inter: discord.Interaction):
         if not await self._ensure_child(inter): return
-        await inter.response.defer(ephemeral=True)
         uid = inter.user.id
         self.game.temp_bets[uid] = 0
         await self._refresh_panel(inter)
         # 通知なし
 
-    @discord.ui.button(label="✅ 確定", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="✅ 確定", style=discord.ButtonStyle.primary, custom_id="chi:bet:confirm")
     async def confirm_btn(self, inter: discord.Interaction, button: discord.ui.Button):
+        await self.submit(inter, "confirm", ("betting",), self._confirm, ephemeral=True)
+
+    async def _confirm(self, inter: discord.Interaction):
         if not await self._ensure_child(inter): return
-        await inter.response.defer(ephemeral=True)
         uid = inter.user.id
         amt = self.game.temp_bets.get(uid, self.game.bets.get(uid, 0))
         self.game.bets[uid] = amt
         self.game.temp_bets.pop(uid, None)
+        persist(self.game)
         await self._refresh_panel(inter)
         # 公開で確定アナウンス
-        await inter.channel.send(f"💰 <@{uid}> のベット：**{amt}**（確定）")
+        await _send(inter.channel, f"💰 <@{uid}> のベット：**{amt}**（確定）", priority=PRIO_PANEL)
 
     # 親だけ押せる開始ボタン
-    @discord.ui.button(label="▶ 親のROLL開始", style=discord.ButtonStyle.success, row=1)
+    @discord.ui.button(label="▶ 親のROLL開始", style=discord.ButtonStyle.success, row=1, custom_id="chi:bet:start")
     async def start_parent_roll_btn(self, inter: discord.Interaction, button: discord.ui.Button):
+        await self.submit(inter, "start", ("betting",), self._start_parent_roll)
+
+    async def _start_parent_roll(self, inter: discord.Interaction):
         game = self.game
         if inter.user.id != game.parent_id:
-            await inter.response.send_message("親のみが開始できます。", ephemeral=True)
-            return
-        if game.phase != "betting":
-            await inter.response.send_message("いまは開始できません。", ephemeral=True)
+            await _followup(inter, "親のみが開始できます。", ephemeral=True)
             return
-
-        await inter.response.defer()
-        game.phase = "parent_roll"
-
-        # ベット締切：パネルを閉じる
-        if game.bet_panel_message_id:
-            try:
-                panel_msg = await inter.channel.fetch_message(game.bet_panel_message_id)
-                await panel_msg.edit(content="⛔ ベットは締め切りました。", view=None)
-            except Exception:
-                pass
-
-        game.parent_round = RoundState(user_id=game.parent_id, role_label="【親】")
-        view = RollView(game, round_state=game.parent_round, is_parent=True)
-        await inter.followup.send(
-            f"🟨 親 <@{game.parent_id}> の手番です。最大3回までROLL可能、STOPで確定。",
-            view=view
-        )
+        await begin_parent_roll(inter.channel, game, inter)
 
 async def send_bet_panel(channel: discord.abc.Messageable, game: GameState):
     view = BetView(game)
-    msg = await channel.send(bet_panel_text(game), view=view)
+    text = bet_panel_text(game)
+    msg = await _send(channel, text, view=view)
     game.bet_panel_message_id = msg.id
+    game.bet_panel = PanelRenderer(msg, lambda: bet_panel_text(game), view=view, last_text=text)
+    persist(game)
+    arm_deadline(game, channel)
+
+async def begin_parent_roll(channel: discord.abc.Messageable, game: GameState, inter: Optional[discord.Interaction] = None):
+    """ ベットを締め切って親の手番を出す。inter があればその followup で出す """
+    game.phase = "parent_roll"
+
+    # ベット締切：パネルを閉じる
+    await close_bet_panel(channel, game)
+
+    game.parent_round = RoundState(user_id=game.parent_id, role_label="【親】")
+    view = RollView(game, round_state=game.parent_round, is_parent=True)
+    text = f"🟨 親 <@{game.parent_id}> の手番です。最大{MAX_TRIES}回までROLL可能、STOPで確定。{deadline_note()}"
+    if inter is not None:
+        msg = await _followup(inter, text, view=view)
+    else:
+        msg = await _send(channel, text, view=view)
+    game.turn_message_id = msg.id
+    persist(game)
+    arm_deadline(game, channel)
 
 # ================== ROLL/STOP ビュー ==================
-class RollView(discord.ui.View):
-    def __init__(self, game: GameState, round_state: RoundState, is_parent: bool, timeout: Optional[float] = 120):
-        super().__init__(timeout=timeout)
-        self.game = game
+class RollView(GameView):
+    def __init__(self, game: Optional[GameState] = None, round_state: Optional[RoundState] = None, is_parent: bool = False):
+        super().__init__(game)
         self.round_state = round_state
         self.is_parent = is_parent
-        self.working = False
+
+    def bind(self, game: GameState) -> Optional["RollView"]:
+        if game.phase == "parent_roll" and game.parent_round:
+            return RollView(game, game.parent_round, is_parent=True)
+        if game.phase == "children_roll" and game.child_round:
+            return RollView(game, game.child_round, is_parent=False)
+        return None
 
     async def _finalize_parent_and_move_on(self, channel: discord.abc.Messageable):
         hand = self.round_state.final
         assert hand is not None
+        if hand.rank in (5, 4, 1):      # 親の役で即決（子は振らない）
+            sign = 1 if hand.rank == 1 else -1
+            for cid in self.game.children_order:
+                record_match(self.game, cid, None, hand, sign, sign * self.game.bets.get(cid, 0) * hand.payout)
         if hand.rank == 5:      # シゴロ → 親即勝：子→親
-            transfers = [(cid, self.game.parent_id, self.game.bets.get(cid, 0)) for cid in self.game.children_order if self.game.bets.get(cid, 0) > 0]
-            await post_transfers(channel, transfers, "🟢 親の即勝（シゴロ）精算")
+            transfers = [(cid, self.game.parent_id, self.game.bets.get(cid, 0) * hand.payout) for cid in self.game.children_order if self.game.bets.get(cid, 0) > 0]
+            await post_results(channel, self.game, transfers, "🟢 親の即勝（シゴロ）")
             await end_round_and_rotate_parent(channel, self.game)
         elif hand.rank == 1:    # ヒフミ → 親即負：親→子
-            transfers = [(self.game.parent_id, cid, self.game.bets.get(cid, 0)) for cid in self.game.children_order if self.game.bets.get(cid, 0) > 0]
-            await post_transfers(channel, transfers, "🔴 親の即負（ヒフミ）精算")
+            transfers = [(self.game.parent_id, cid, self.game.bets.get(cid, 0) * hand.payout) for cid in self.game.children_order if self.game.bets.get(cid, 0) > 0]
+            await post_results(channel, self.game, transfers, "🔴 親の即負（ヒフミ）")
             await end_round_and_rotate_parent(channel, self.game)
         elif hand.rank == 4:    # ゾロ目 → 親即勝：子→親
-            transfers = [(cid, self.game.parent_id, self.game.bets.get(cid, 0)) for cid in self.game.children_order if self.game.bets.get(cid, 0) > 0]
-            await post_transfers(channel, transfers, "🟢 親の即勝（ゾロ目）精算")
+            transfers = [(cid, self.game.parent_id, self.game.bets.get(cid, 0) * hand.payout) for cid in self.game.children_order if self.game.bets.get(cid, 0) > 0]
+            await post_results(channel, self.game, transfers, "🟢 親の即勝（ゾロ目）")
             await end_round_and_rotate_parent(channel, self.game)
         else:
             self.game.parent_hand = hand
             await start_children_turns(channel, self.game)
 
-    @discord.ui.button(label="ROLL", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="ROLL", style=discord.ButtonStyle.primary, custom_id="chi:roll:roll")
     async def roll_btn(self, inter: discord.Interaction, button: discord.ui.Button):
-        if inter.user.id != self.round_state.user_id:
-            await inter.response.send_message("あなたの手番ではありません。", ephemeral=True); return
-        if self.working:
-            await inter.response.send_message("処理中です。", ephemeral=True); return
-        if self.round_state.final:
-            await inter.response.send_message("すでに確定しています。", ephemeral=True); return
-        if self.round_state.tries >= 3:
-            await inter.response.send_message("最大3回までです。", ephemeral=True); return
+        await self.submit(inter, "roll", ("parent_roll", "children_roll"), self._roll)
 
-        async with self.game.lock:
-            self.working = True
-            self.round_state.tries += 1
+    async def _check_turn(self, inter: discord.Interaction) -> bool:
+        # 古いメッセージのボタン対策：今の手番の RoundState と一致するかも見る
+        current = self.game.parent_round if self.game.phase == "parent_roll" else self.game.child_round
+        if inter.user.id != self.round_state.user_id or current is not self.round_state:
+            await _followup(inter, "あなたの手番ではありません。", ephemeral=True); return False
+        if self.round_state.final:
+            await _followup(inter, "すでに確定しています。", ephemeral=True); return False
+        return True
 
-            await inter.response.defer()
-            for c in self.children: c.disabled = True
-            await inter.edit_original_response(view=self)
+    async def _roll(self, inter: discord.Interaction):
+        if not await self._check_turn(inter): return
+        if self.round_state.tries >= MAX_TRIES:
+            await _followup(inter, f"最大{MAX_TRIES}回までです。", ephemeral=True); return
 
-            title = f"{self.round_state.role_label} {inter.user.mention} のロール中…"
-            anim_msg, _, _ = await send_roll_animation(inter.channel, title=title)
+        self.round_state.tries += 1
+        mode = ROLL_PRESENTATION
 
-            dice = roll_dice()
-            self.round_state.last_roll = dice
-            hand = evaluate_hand(dice)
-            if hand.rank != 2 or self.round_state.tries >= 3:
-                self.round_state.final = hand
+        # 出目は先に決める。結果画像の用意（キャッシュ or 描画）をアニメのアップロードと並行させる
+        dice = roll_dice(self.game.rng)
+        self.round_state.last_roll = dice
+        hand = evaluate_hand(dice)
+        if hand.rank != 2 or self.round_state.tries >= MAX_TRIES:
+            self.round_state.final = hand
+        persist(self.game)
+        record_roll(REC_ROLL, self.game, self.round_state, dice, hand)
+        theme = table_theme(self.game)
+        result_png = asyncio.create_task(COMPOSITE_CACHE.get_or_render(dice, theme=theme))
 
-            try:
-                await anim_msg.edit(content=f"{title}\n（…止まりました）")
-            except Exception:
-                pass
+        title = f"{self.round_state.role_label} {inter.user.mention} のロール中…"
+        try:
+            if mode == "interaction":
+                # 手番メッセージ自体をアニメに差し替える（ボタンは結果が出るまで外す）
+                anim_file, _ = await roll_animation_file(inter.channel_id, theme)
+                await _edit_original(inter, content=title, attachments=[anim_file], view=None)
+            else:
+                if mode == "classic":
+                    for c in self.children: c.disabled = True
+                    await _edit_original(inter, view=self)
+                anim_msg, _, _ = await send_roll_animation(inter.channel, title=title, theme=theme)
+            shown_at = time.perf_counter()
+            await result_png
+        finally:
+            if not result_png.done():
+                result_png.cancel()     # アニメの段階で失敗したら、結果画像の描画も置き去りにしない
+        # アニメを出していない（混雑で省いた）ときは待たない
+        if ROLL_MIN_ANIM_SECONDS > 0 and (mode == "interaction" or anim_msg is not None):
+            await asyncio.sleep(max(0.0, ROLL_MIN_ANIM_SECONDS - (time.perf_counter() - shown_at)))
+
+        if mode == "classic":
+            if anim_msg is not None:
+                try:
+                    await _edit(anim_msg, content=f"{title}\n（…止まりました）", priority=PRIO_COSMETIC)
+                except Exception:
+                    pass
 
             await send_final_composited_image(
                 inter.channel,
@@ -471,59 +3121,100 @@ class RollView(discord.ui.View):
                 role_label=self.round_state.role_label,
                 dice=dice,
                 hand_label=hand.label,
-                tries=self.round_state.tries
+                tries=self.round_state.tries,
+                theme=theme,
             )
 
-            if DELETE_ANIM_AFTER_RESULT:
-                try: await anim_msg.delete()
+            if DELETE_ANIM_AFTER_RESULT and anim_msg is not None:
+                try: await _delete(anim_msg)
                 except Exception: pass
+        else:
+            text = roll_result_text(inter.user.mention, self.round_state.role_label, hand.label, self.round_state.tries)
+            result_file = await final_image_file(dice, theme)
+            if mode == "interaction":
+                if not self.round_state.final:
+                    text += f"\n（あと{MAX_TRIES - self.round_state.tries}回：ROLL / STOPで確定）"
+                await _edit_original(inter, content=text, attachments=[result_file], view=None if self.round_state.final else self)
+            else:
+                # アニメのメッセージをそのまま結果に差し替える。出していない/消えていたら結果だけ投稿
+                try:
+                    if anim_msg is None:
+                        raise Shed()
+                    await _edit(anim_msg, content=text, attachments=[result_file], priority=PRIO_URGENT)
+                except (discord.HTTPException, Shed):
+                    await _send(inter.channel, content=text, file=await final_image_file(dice, theme))
+        t0 = inter.extras.get("t0")
+        if t0 is not None:
+            METRICS.observe("click_to_result_seconds", time.perf_counter() - t0, mode=mode)
 
-            if self.round_state.final:
-                await inter.edit_original_response(view=None)
-                if self.is_parent:
-                    await self._finalize_parent_and_move_on(inter.channel)
-                else:
-                    await conclude_child_vs_parent(inter.channel, self.game, child_id=self.round_state.user_id, child_hand=hand)
+        if self.round_state.final:
+            if mode != "interaction":
+                await _edit_original(inter, view=None)
+            self.game.stop_views(RollView)
+            if self.is_parent:
+                await self._finalize_parent_and_move_on(inter.channel)
             else:
+                await conclude_child_vs_parent(inter.channel, self.game, child_id=self.round_state.user_id, child_hand=hand)
+        else:
+            arm_deadline(self.game, inter.channel)     # 振った分だけ持ち時間を延長
+            if mode == "classic":
                 for c in self.children: c.disabled = False
-                await inter.edit_original_response(view=self)
-
-            self.working = False
+                await _edit_original(inter, view=self)
 
-    @discord.ui.button(label="STOP", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="STOP", style=discord.ButtonStyle.secondary, custom_id="chi:roll:stop")
     async def stop_btn(self, inter: discord.Interaction, button: discord.ui.Button):
-        if inter.user.id != self.round_state.user_id:
-            await inter.response.send_message("あなたの手番ではありません。", ephemeral=True); return
-        if self.round_state.final:
-            await inter.response.send_message("すでに確定しています。", ephemeral=True); return
+        await self.submit(inter, "stop", ("parent_roll", "children_roll"), self._stop)
+
+    async def _stop(self, inter: discord.Interaction):
+        if not await self._check_turn(inter): return
         if not self.round_state.last_roll:
-            await inter.response.send_message("まだ1回も振っていません。先にROLLしてください。", ephemeral=True); return
+            await _followup(inter, "まだ1回も振っていません。先にROLLしてください。", ephemeral=True); return
 
-        async with self.game.lock:
-            await inter.response.defer()
-            hand = evaluate_hand(self.round_state.last_roll)
-            self.round_state.final = hand
+        hand = evaluate_hand(self.round_state.last_roll)
+        self.round_state.final = hand
+        persist(self.game)
+        record_roll(REC_STOP, self.game, self.round_state, self.round_state.last_roll, hand)
 
+        if ROLL_PRESENTATION == "classic":
             await send_final_composited_image(
                 inter.channel,
                 who_mention=inter.user.mention,
                 role_label=self.round_state.role_label,
                 dice=self.round_state.last_roll,
                 hand_label=f"{hand.label}（STOPで確定）",
-                tries=self.round_state.tries
+                tries=self.round_state.tries,
+                theme=table_theme(self.game),
             )
-            await inter.edit_original_response(view=None)
-
-            if self.is_parent:
-                await self._finalize_parent_and_move_on(inter.channel)
-            else:
-                await conclude_child_vs_parent(inter.channel, self.game, child_id=self.round_state.user_id, child_hand=hand)
+            await _edit_original(inter, view=None)
+        else:
+            # 最後のロールの結果画像はもう出ているので、手番メッセージに確定を書いてボタンを外すだけ
+            await _edit_original(inter, content=roll_result_text(
+                inter.user.mention, self.round_state.role_label, f"{hand.label}（STOPで確定）", self.round_state.tries
+            ), view=None)
+        self.game.stop_views(RollView)
+
+        if self.is_parent:
+            await self._finalize_parent_and_move_on(inter.channel)
+        else:
+            await conclude_child_vs_parent(inter.channel, self.game, child_id=self.round_state.user_id, child_hand=hand)
 
 # ================== 進行ユーティリティ ==================
+async def post_results(channel: discord.abc.Messageable, game: GameState, pairs: List[Tuple[int,int,int]], title: str):
+    """ 勝敗を台帳に記録し、結果だけを軽いテキストで出す（送金行は精算時にまとめて出す） """
+    for payer, payee, amount in pairs:
+        game.ledger.record(payer, payee, amount)
+    if not pairs:
+        await _send(channel, f"{title}（対象なし）")
+        return
+    lines = [f"・<@{payer}> → <@{payee}>：{amount}" for payer, payee, amount in pairs]
+    for text in chunk_lines(title, lines):
+        await _send(channel, text)
+
 async def start_children_turns(channel: discord.abc.Messageable, game: GameState):
     game.phase = "children_roll"
     game.turn_index = 0
-    await channel.send(f"▶ 親の役：**{game.parent_hand}**。子のターンに入ります。")
+    persist(game)
+    await _send(channel, f"▶ 親の役：**{game.parent_hand}**。子のターンに入ります。")
     await prompt_next_child(channel, game)
 
 async def prompt_next_child(channel: discord.abc.Messageable, game: GameState):
@@ -532,100 +3223,280 @@ async def prompt_next_child(channel: discord.abc.Messageable, game: GameState):
     cid = game.children_order[game.turn_index]
     game.child_round = RoundState(user_id=cid, role_label="【子】")
     view = RollView(game, round_state=game.child_round, is_parent=False)
-    await channel.send(f"🟦 子 <@{cid}> の手番です。最大3回までROLL可能、STOPで確定。", view=view)
+    msg = await _send(channel, f"🟦 子 <@{cid}> の手番です。最大{MAX_TRIES}回までROLL可能、STOPで確定。{deadline_note()}", view=view)
+    game.turn_message_id = msg.id
+    persist(game)
+    arm_deadline(game, channel)
 
 async def conclude_child_vs_parent(channel: discord.abc.Messageable, game: GameState, child_id: int, child_hand: HandResult):
     parent_hand = game.parent_hand
     assert parent_hand is not None
-    bet = game.bets.get(child_id, 0)
+    bet = game.bets.get(child_id, 0) * settle_multiplier(parent_hand, child_hand)
     res = compare(parent_hand, child_hand)
+    record_match(game, child_id, child_hand, parent_hand, res, res * bet)
 
     if res == 0:
-        await channel.send(f"🔸 引き分け：親 **{parent_hand}** vs 子 **{child_hand}**（精算なし）")
+        await _send(channel, f"🔸 引き分け：親 **{parent_hand}** vs 子 **{child_hand}**（精算なし）")
     elif res > 0:
-        await post_transfers(channel, [(game.parent_id, child_id, bet)], "🟢 子の勝ち 精算")
+        await post_results(channel, game, [(game.parent_id, child_id, bet)], "🟢 子の勝ち")
     else:
-        await post_transfers(channel, [(child_id, game.parent_id, bet)], "🔴 子の負け 精算")
+        await post_results(channel, game, [(child_id, game.parent_id, bet)], "🔴 子の負け")
 
     game.turn_index += 1
     await prompt_next_child(channel, game)
 
 async def end_round_and_rotate_parent(channel: discord.abc.Messageable, game: GameState):
+    game.ledger.rounds += 1
+    if game.ledger.rounds >= SETTLE_EVERY_ROUNDS or not game.participants:
+        await settle_ledger(channel, game)
     if not game.participants:
-        await channel.send("参加者がいないため終了します。")
-        GAMES.pop(game.channel_id, None)
+        await _send(channel, f"参加者がいないため終了します。\n{reveal_text(game)}")
+        drop_game(game.channel_id)
         return
     candidates = [uid for uid in game.participants if uid != game.parent_id] or game.participants[:]
-    next_parent = random.choice(candidates)
-    await channel.send(f"✅ ラウンド終了。次の親はランダム選出 → <@{next_parent}>")
+    next_parent = game.rng.choice(candidates)      # 親の交代もこのラウンドの列から引く（明かす前に）
+    await _send(channel, f"✅ ラウンド終了。次の親はランダム選出 → <@{next_parent}>\n{reveal_text(game)}")
 
+    game.round_no += 1
+    game.rng = DiceStream.for_round(game.channel_id, game.round_no)
     game.parent_id = next_parent
     game.parent_hand = None
     game.children_order = [uid for uid in game.participants if uid != game.parent_id]
     game.bets = {}
     game.temp_bets = {}
+    game.bet_panel = None
     game.turn_index = 0
     game.parent_round = None
     game.child_round = None
     game.phase = "betting"
-    await channel.send(f"▶ 新ラウンド開始。親：<@{game.parent_id}>。これからベットを設定してください。")
+    await _send(channel, f"▶ 新ラウンド開始。親：<@{game.parent_id}>。これからベットを設定してください。\n{commit_text(game)}")
     await send_bet_panel(channel, game)
 
+# ================== 締切タイマー ==================
+class TimerWheel:
+    """
+    ハッシュ化タイマーホイール。1本のタスクが tick 秒ごとに目盛りを1つ進め、その目盛りの期限切れを発火する。
+    キー（チャンネルID）ごとに締切は1つだけで、schedule し直すと前の締切は取り消される。
+    登録/取消は O(1)、毎 tick の仕事は1目盛り分だけなので、卓が多くてもタイマーを個別に持たない。
+    """
+    def __init__(self, tick: float = TIMER_TICK, slots: int = TIMER_SLOTS):
+        self.tick = tick
+        self.slots: List[Dict[int, Tuple[int, Callable[[], None]]]] = [{} for _ in range(slots)]
+        self._where: Dict[int, int] = {}      # key -> 入っている目盛り
+        self._now = 0                         # 進めた目盛り数
+        self._task: Optional[asyncio.Task] = None
+        self.fired = 0
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def schedule(self, key: int, delay: float, fn: Callable[[], None]):
+        self.cancel(key)
+        due = self._now + max(1, int(-(-delay // self.tick)))
+        slot = due % len(self.slots)
+        self.slots[slot][key] = (due, fn)
+        self._where[key] = slot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self, key: int):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            self.slots[slot].pop(key, None)
+
+    def _advance(self):
+        self._now += 1
+        bucket = self.slots[self._now % len(self.slots)]
+        due = [(k, fn) for k, (d, fn) in bucket.items() if d <= self._now]
+        for key, fn in due:
+            del bucket[key]
+            self._where.pop(key, None)
+            self.fired += 1
+            try:
+                fn()
+            except Exception:
+                traceback.print_exc()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time() - self._now * self.tick     # 目盛り0に当たる時刻（止まっていた間は進めない）
+        while self._where:
+            await asyncio.sleep(max(0.0, started + (self._now + 1) * self.tick - loop.time()))
+            # ループが詰まって遅れた分はまとめて進める
+            while self._now < int((loop.time() - started) / self.tick):
+                self._advance()
+
+TIMERS = TimerWheel()
+
+NO_HAND = next(h for h in _HAND_TABLE if h.rank == 2)   # 一度も振らずに時間切れ → 役なし扱い
+
+def _deadline_for(phase: str) -> float:
+    if phase in ("parent_roll", "children_roll"):
+        return TURN_TIMEOUT
+    if phase == "betting":
+        return BET_TIMEOUT
+    if phase == "lobby":
+        return LOBBY_TIMEOUT
+    return 0.0
+
+def deadline_note() -> str:
+    return f"（{TURN_TIMEOUT:.0f}秒操作がなければ自動STOP）" if TURN_TIMEOUT > 0 else ""
+
+def arm_deadline(game: GameState, channel: Optional[discord.abc.Messageable] = None):
+    """ いまのフェーズの締切をセットし直す（前の締切は取り消し）。期限が来たら卓アクターに時間切れを積む """
+    delay = _deadline_for(game.phase)
+    if delay <= 0:
+        TIMERS.cancel(game.channel_id)
+        return
+    phase = game.phase
+    rs = game.parent_round if phase == "parent_roll" else game.child_round if phase == "children_roll" else None
+    token = (rs.user_id, rs.tries) if rs else None
+
+    def fire():
+        # メモリから退避されていても読み直して進める（閉じた卓なら何もしない）
+        current = get_game(game.channel_id)
+        if current is None or current.phase != phase:
+            return
+        ch = channel or bot.get_partial_messageable(current.channel_id)
+        table_actor(current).submit(TableCommand("timeout", 0, (phase,), None, lambda: expire_deadline(ch, current, phase, token)))
+    TIMERS.schedule(game.channel_id, delay, fire)
+
+async def clear_buttons(channel: discord.abc.Messageable, message_id: Optional[int]):
+    """ 時間切れで終わった段階のメッセージからボタンを外す（消されていたら何もしない） """
+    if message_id and hasattr(channel, "get_partial_message"):
+        try:
+            await _edit(channel.get_partial_message(message_id), view=None, priority=PRIO_URGENT)
+        except discord.HTTPException:
+            pass
+
+async def expire_deadline(channel: discord.abc.Messageable, game: GameState, phase: str, token: Optional[Tuple[int, int]]):
+    METRICS.inc("deadline_expired", phase=phase)
+    if phase in ("parent_roll", "children_roll"):
+        rs = game.parent_round if phase == "parent_roll" else game.child_round
+        if rs is None or rs.final or (rs.user_id, rs.tries) != token:
+            return      # 締切のあとに操作が入っていた
+        if rs.last_roll:
+            hand, how = evaluate_hand(rs.last_roll), "自動STOP"
+        else:
+            hand, how = NO_HAND, "一度も振らなかったため"
+        rs.final = hand
+        persist(game)
+        record_roll(REC_STOP, game, rs, rs.last_roll, hand)
+        game.stop_views(RollView)
+        await clear_buttons(channel, game.turn_message_id)
+        await _send(channel, f"⏰ 時間切れ：{rs.role_label} <@{rs.user_id}> は{how} → **{hand.label}**")
+        if phase == "parent_roll":
+            await RollView(game, rs, is_parent=True)._finalize_parent_and_move_on(channel)
+        else:
+            await conclude_child_vs_parent(channel, game, child_id=rs.user_id, child_hand=hand)
+    elif phase == "betting":
+        await _send(channel, "⏰ ベットを締め切りました（未確定の子はベット0）。")
+        await begin_parent_roll(channel, game)
+    elif phase == "lobby":
+        drop_game(game.channel_id)      # LobbyView もここで止まる
+        await clear_buttons(channel, game.lobby_message_id)
+        await _send(channel, "⏰ ロビーが放置されていたため閉じました。")
+
 # ================== Slash Commands ==================
 @tree.command(name="chi_ready", description="チンチロのロビーを作成（ボタンで参加）")
-async def chi_ready(inter: discord.Interaction):
+@app_commands.describe(thread="スレッドに卓を作る（省略時：このチャンネルに卓があればスレッドに作る）")
+async def chi_ready(inter: discord.Interaction, thread: Optional[bool] = None):
     await ack(inter)
     cid = inter.channel_id
-    if cid in GAMES and GAMES[cid].lobby_open:
-        await inter.followup.send("このチャンネルには既にロビーがあります。", ephemeral=True); return
-    game = GameState(channel_id=cid, host_id=inter.user.id)
-    GAMES[cid] = game
-    view = LobbyView(game)
-    msg = await inter.followup.send(lobby_text(game), view=view)
-    game.lobby_message_id = (await inter.original_response()).id
+    existing = get_game(cid)
+    if thread is None:
+        thread = READY_THREADS == "always" or (READY_THREADS == "auto" and existing is not None)
+    thread = thread and hasattr(inter.channel, "create_thread")     # スレッドの中などでは作れない
+    if not thread and existing and existing.lobby_open:
+        await _followup(inter, "このチャンネルには既にロビーがあります。", ephemeral=True); return
+    if GAMES.is_full():
+        await _followup(inter, "卓の数が上限に達しています。終わった卓があれば /chi_end してください。", ephemeral=True); return
+
+    if thread:
+        try:
+            channel = await _api("create_thread", cid, inter.channel.create_thread(
+                name=f"🎲 チンチロ卓（{inter.user.display_name}）", type=discord.ChannelType.public_thread,
+                auto_archive_duration=60,
+            ))
+        except discord.HTTPException:
+            await _followup(inter, "スレッドを作れませんでした（権限を確認してください）。", ephemeral=True); return
+        game = GameState(channel_id=channel.id, host_id=inter.user.id, guild_id=inter.guild_id)
+        GAMES[channel.id] = game
+        msg = await _send(channel, lobby_text(game), view=LobbyView(game))
+        game.lobby_message_id = msg.id
+        await _followup(inter, f"🧵 新しい卓を {channel.mention} に作りました。")
+    else:
+        channel = inter.channel
+        game = GameState(channel_id=cid, host_id=inter.user.id, guild_id=inter.guild_id)
+        GAMES[cid] = game
+        view = LobbyView(game)
+        msg = await _followup(inter, lobby_text(game), view=view)
+        game.lobby_message_id = (await inter.original_response()).id
+    persist(game)
+    arm_deadline(game, channel)
 
 @tree.command(name="chi_panel", description="（ホスト）参加パネルを再送")
 async def chi_panel(inter: discord.Interaction):
     await ack(inter)
     cid = inter.channel_id
-    game = GAMES.get(cid)
+    game = get_game(cid)
     if not game:
-        await inter.followup.send("このチャンネルにロビー/ゲームはありません。", ephemeral=True); return
+        await _followup(inter, "このチャンネルにロビー/ゲームはありません。", ephemeral=True); return
     if inter.user.id != game.host_id:
-        await inter.followup.send("ホストのみ実行できます。", ephemeral=True); return
+        await _followup(inter, "ホストのみ実行できます。", ephemeral=True); return
     view = LobbyView(game)
-    msg = await inter.followup.send(lobby_text(game), view=view)
+    msg = await _followup(inter, lobby_text(game), view=view)
     game.lobby_message_id = (await inter.original_response()).id
+    persist(game)
 
 @tree.command(name="chi_parent_roll", description="（親）ロールを開始（子のベット締切）")
 async def chi_parent_roll(inter: discord.Interaction):
     await ack(inter)
     cid = inter.channel_id
-    game = GAMES.get(cid)
-    if not game or game.phase not in ("betting", "parent_roll"):
-        await inter.followup.send("今は親のロールフェーズではありません。", ephemeral=True); return
-    if inter.user.id != game.parent_id:
-        await inter.followup.send("親のみが開始できます。", ephemeral=True); return
-
-    game.phase = "parent_roll"
-
-    # ベット締切：パネルを閉じる
-    if game.bet_panel_message_id:
-        try:
-            panel_msg = await inter.channel.fetch_message(game.bet_panel_message_id)
-            await panel_msg.edit(content="⛔ ベットは締め切りました。", view=None)
-        except Exception:
-            pass
+    game = get_game(cid)
+    if not game:
+        await _followup(inter, "今は親のロールフェーズではありません。", ephemeral=True); return
+    await submit_command(inter, game, "start", ("betting", "parent_roll"), lambda i: _start_parent_roll_cmd(i, game))
 
-    game.parent_round = RoundState(user_id=game.parent_id, role_label="【親】")
-    view = RollView(game, round_state=game.parent_round, is_parent=True)
-    await inter.followup.send(f"🟨 親 <@{game.parent_id}> の手番です。最大3回までROLL可能、STOPで確定。", view=view)
+async def _start_parent_roll_cmd(inter: discord.Interaction, game: GameState):
+    if inter.user.id != game.parent_id:
+        await _followup(inter, "親のみが開始できます。", ephemeral=True); return
+    await begin_parent_roll(inter.channel, game, inter)
+
+def _odds_line(name: str, o: Optional[Odds]) -> str:
+    if o is None:
+        return f"{name}：—"
+    return f"{name}：勝 {o.win*100:.1f}% / 分 {o.draw*100:.1f}% / 負 {o.lose*100:.1f}%（期待値 {o.ev:+.3f}倍）"
+
+@tree.command(name="chi_odds", description="いまの手番の STOP / ROLL の勝率と期待値を表示")
+async def chi_odds(inter: discord.Interaction):
+    game = get_game(inter.channel_id)
+    rs = None
+    if game and game.phase == "children_roll" and game.child_round and game.parent_hand:
+        rs = game.child_round
+    elif game and game.phase == "parent_roll" and game.parent_round:
+        rs = game.parent_round
+    if rs is None or rs.final:
+        await inter.response.send_message("いまは判断中の手番がありません。", ephemeral=True); return
+
+    current = evaluate_hand(rs.last_roll) if rs.last_roll else None
+    tries_left = MAX_TRIES - rs.tries
+    if rs is game.child_round:
+        stop, roll = child_odds(game.parent_hand, current, tries_left)
+        head = f"🟦 子 <@{rs.user_id}>（親の役：**{game.parent_hand}**）"
+    else:
+        stop, roll = parent_odds(current, tries_left)
+        head = f"🟨 親 <@{rs.user_id}>（子1人あたり・親側から見た値）"
+    lines = [head, f"現在：{current or '未ロール'} / 残り {tries_left} 回", _odds_line("STOP", stop), _odds_line("ROLL", roll)]
+    if stop and roll:
+        lines.append(f"→ 期待値の高い方：**{'ROLL' if roll.ev > stop.ev else 'STOP'}**")
+    await inter.response.send_message("\n".join(lines), ephemeral=True)
 
 @tree.command(name="chi_status", description="状態を表示")
 async def chi_status(inter: discord.Interaction):
     await ack(inter)
     cid = inter.channel_id
-    game = GAMES.get(cid)
+    game = get_game(cid)
     lines = []
     if game:
         lines.append(f"フェーズ：{game.phase}")
@@ -640,33 +3511,353 @@ async def chi_status(inter: discord.Interaction):
             ))
         if game.parent_hand:
             lines.append(f"親の役：{game.parent_hand}")
+        lines.append(f"テーマ：{table_theme(game)}")
     else:
         lines.append("このチャンネルにゲームはありません。")
-    await inter.followup.send("【状態】\n" + "\n".join(lines))
+    lines.append(f"描画キュー：{RENDER.queue_depth}（ピーク {RENDER.peak_depth}）")
+    lines.append(f"メモリ上の卓：{len(GAMES)}（上限 {GAMES.max_live}）/ 退避 "
+                 + " / ".join(f"{k}={GAMES.evicted[k]}" for k in ("idle", "lru", "closed")))
+    if game and game.actor is not None:
+        lines.append(f"操作キュー：{game.actor.queue.qsize()}")
+    lines.append(f"送信待ち：このチャンネル {OUTBOUND.queue_depth(cid)} / 全体 {OUTBOUND.queue_depth()}"
+                 + (f"（{OUTBOUND.burst}回/{OUTBOUND.burst / OUTBOUND.rate:g}秒）" if OUTBOUND.burst else ""))
+    lines.append(f"プロファイル：{RUNTIME_PROFILE}（{STARTUP.summary()}）")
+    if LAST_ANIM_ENCODE:
+        a = LAST_ANIM_ENCODE
+        lines.append(f"直近のロールアニメ：{a['fmt']} {a['bytes'] / 1024:.0f}KB / {a['encode_ms']:.0f}ms / {a['frames']}コマ"
+                     + ("（予算超過）" if a["over_budget"] else ""))
+    try:
+        lines.append(f"精算の配送：未送 {OUTBOX.backlog()} / 諦め {OUTBOX.dead()}（{', '.join(OUTBOX.sinks) or 'なし'}）")
+    except sqlite3.Error as e:
+        lines.append(f"精算の配送：読めません（{e}）")
+    if ROLL_LOG.enabled:
+        lines.append(f"ロールログ：{ROLL_LOG.count:,}件（{len(ROLL_LOG.players):,}人）")
+    lines.append("操作の受付：" + " / ".join(f"{k}={ACTOR_STATS[k]}" for k in ("accepted", "dedup", "full", "stale", "error")))
+    await _followup(inter, "【状態】\n" + "\n".join(lines))
 
 @tree.command(name="chi_end", description="ゲームを終了（ホストまたは親）")
 async def chi_end(inter: discord.Interaction):
     await ack(inter)
     cid = inter.channel_id
-    game = GAMES.get(cid)
+    game = get_game(cid)
     if not game:
-        await inter.followup.send("ゲームはありません。", ephemeral=True); return
+        await _followup(inter, "ゲームはありません。", ephemeral=True); return
+    await submit_command(inter, game, "end", None, lambda i: _end_game_cmd(i, game))
+
+async def _end_game_cmd(inter: discord.Interaction, game: GameState):
     if inter.user.id not in (game.host_id, game.parent_id):
-        await inter.followup.send("終了権限がありません。", ephemeral=True); return
-    GAMES.pop(cid, None)
-    await inter.followup.send("🛑 ゲームを終了しました。")
+        await _followup(inter, "終了権限がありません。", ephemeral=True); return
+    drop_game(game.channel_id)
+    await settle_ledger(inter.channel, game)
+    await _followup(inter, f"🛑 ゲームを終了しました。\n{reveal_text(game)}")
+
+# ================== サイコロのテーマ ==================
+_GUILD_THEMES: Dict[int, Optional[str]] = {}     # guild_id -> サーバーの既定テーマ（ストアの meta の写し）
+
+def guild_theme(guild_id: Optional[int]) -> Optional[str]:
+    if guild_id is None:
+        return None
+    if guild_id not in _GUILD_THEMES:
+        try:
+            _GUILD_THEMES[guild_id] = STORE.get_meta(f"theme:{guild_id}")
+        except sqlite3.Error as e:
+            print("Game store error:", e)
+            return None
+    return _GUILD_THEMES[guild_id]
+
+def set_guild_theme(guild_id: int, theme: str):
+    _GUILD_THEMES[guild_id] = theme
+    STORE.set_meta(f"theme:{guild_id}", theme)
+
+def table_theme(game: GameState) -> str:
+    """ 卓の指定 → サーバーの既定 → DICE_THEME_DEFAULT の順に決める """
+    return resolve_theme(game.theme or guild_theme(game.guild_id))
+
+def theme_list_text(game: Optional[GameState], guild_id: Optional[int]) -> str:
+    lines = ["🎲 サイコロのテーマ"]
+    if game:
+        lines.append(f"この卓：**{table_theme(game)}**" + ("" if game.theme else "（サーバーの既定）"))
+    lines.append(f"サーバーの既定：{resolve_theme(guild_theme(guild_id))}")
+    lines.append("メモリ（アトラス）：")
+    lines += [f"・{line}" for line in theme_footprint_lines()]
+    return "\n".join(lines)
+
+@tree.command(name="chi_theme", description="サイコロのテーマを変更（この卓 / サーバーの既定）。省略で一覧")
+@app_commands.describe(theme="テーマ（省略すると一覧とメモリ使用量を表示）", scope="変更する範囲")
+@app_commands.choices(
+    theme=[app_commands.Choice(name=name, value=name) for name in list(DICE_THEMES)[:25]],
+    scope=[app_commands.Choice(name="この卓（ホスト）", value="table"),
+           app_commands.Choice(name="サーバーの既定（管理者）", value="guild")],
+)
+async def chi_theme(inter: discord.Interaction, theme: Optional[str] = None, scope: str = "table"):
+    game = get_game(inter.channel_id)
+    if theme is None:
+        await inter.response.send_message(theme_list_text(game, inter.guild_id), ephemeral=True); return
+    if scope == "guild":
+        perms = getattr(inter.user, "guild_permissions", None)
+        if inter.guild_id is None or perms is None or not perms.manage_guild:
+            await inter.response.send_message("サーバーの既定はサーバー管理の権限が必要です。", ephemeral=True); return
+        try:
+            set_guild_theme(inter.guild_id, theme)
+        except sqlite3.Error as e:
+            await inter.response.send_message(f"保存できませんでした（{e}）。", ephemeral=True); return
+        text = f"🎲 サーバーの既定テーマを **{theme}** にしました（テーマを指定していない卓に効きます）。"
+    else:
+        if not game:
+            await inter.response.send_message("このチャンネルにロビー/ゲームはありません。", ephemeral=True); return
+        if inter.user.id != game.host_id:
+            await inter.response.send_message("ホストのみ実行できます。", ephemeral=True); return
+        game.theme = theme
+        persist(game)
+        text = f"🎲 この卓のテーマを **{theme}** にしました。"
+    ANIM_POOL.start(theme)      # 初めてのテーマならアニメをバックグラウンドで用意しておく
+    await inter.response.send_message(text)
+
+# ================== 戦績 ==================
+def _signed(v: int) -> str:
+    return f"{v:+,}"
+
+def player_stats_text(user_id: int) -> str:
+    p = ROLL_LOG.players.get(user_id)
+    if p is None:
+        return f"📊 <@{user_id}> の記録はまだありません。"
+    decided = p.wins + p.losses
+    lines = [
+        f"📊 <@{user_id}> の戦績",
+        f"ロール {p.rolls:,} 回 / 勝負 {p.matches:,}（勝 {p.wins}・負 {p.losses}・分 {p.draws}）"
+        + (f" / 勝率 {100 * p.wins / decided:.1f}%" if decided else ""),
+        f"収支 {_signed(p.net)}（賭け額 {p.wagered:,}）"
+        + (f" / {ROLL_LOG.ranking.rank(user_id)}位（{len(ROLL_LOG.ranking)}人中）" if ROLL_LOG.ranking.rank(user_id) else ""),
+    ]
+    if any(p.hands):
+        lines.append("確定した役：" + "・".join(f"{RANK_NAMES[r]} {p.hands[r]}" for r in range(5, 0, -1) if p.hands[r])
+                     + f" / 最高 **{HAND_BY_SCORE[p.best].label}**")
+    recent = ROLL_LOG.recent(user_id, STATS_RECENT)
+    if recent:
+        lines.append("直近：" + " / ".join(dice_face_str(rec[4:7]) for rec in recent))
+    return "\n".join(lines)
+
+def channel_stats_text(channel_id: int) -> str:
+    ch = ROLL_LOG.channels.get(channel_id)
+    if ch is None:
+        return "📊 このチャンネルの記録はまだありません。"
+    lines = ["📊 このチャンネルの記録", f"ロール {ch.rolls:,} 回 / 勝負 {ch.matches:,} / 動いた額 {ch.volume:,}"]
+    lines += [f"{i}. <@{uid}> {_signed(net)}" for i, (uid, net) in enumerate(ch.ranking.top(STATS_TOP_N), 1)]
+    return "\n".join(lines)
+
+def leaderboard_text() -> str:
+    top = ROLL_LOG.ranking.top(STATS_TOP_N)
+    if not top:
+        return "🏆 ランキングはまだありません。"
+    return "\n".join([f"🏆 収支ランキング（{len(ROLL_LOG.ranking)}人）"]
+                     + [f"{i}. <@{uid}> {_signed(net)}" for i, (uid, net) in enumerate(top, 1)])
+
+@tree.command(name="chi_stats", description="戦績を表示（プレイヤー / このチャンネル / ランキング）")
+@app_commands.describe(scope="表示する範囲", user="表示する人（省略時は自分）")
+@app_commands.choices(scope=[
+    app_commands.Choice(name="プレイヤー", value="player"),
+    app_commands.Choice(name="このチャンネル", value="channel"),
+    app_commands.Choice(name="ランキング", value="leaderboard"),
+])
+async def chi_stats(inter: discord.Interaction, scope: str = "player", user: Optional[discord.User] = None):
+    if not ROLL_LOG.enabled:
+        await inter.response.send_message("戦績の記録は無効になっています。", ephemeral=True); return
+    if scope == "channel":
+        text = channel_stats_text(inter.channel_id)
+    elif scope == "leaderboard":
+        text = leaderboard_text()
+    else:
+        text = player_stats_text((user or inter.user).id)
+    await inter.response.send_message(text, allowed_mentions=discord.AllowedMentions.none())
+
+# ================== メトリクス表示 ==================
+@bot.event
+async def on_app_command_completion(inter: discord.Interaction, command: app_commands.Command):
+    t0 = inter.extras.get("t0")
+    if t0 is not None:
+        METRICS.observe("command_seconds", time.perf_counter() - t0, command=command.name, phase=_phase_of(inter.channel_id))
+
+@tree.command(name="chi_metrics", description="処理時間とAPI呼び出しの集計を表示（管理者）")
+@app_commands.default_permissions(manage_guild=True)
+@app_commands.describe(reset="表示後に集計をリセットする")
+async def chi_metrics(inter: discord.Interaction, reset: bool = False):
+    text = chunk_lines("【メトリクス】", METRICS.summary_lines())[0]
+    if reset:
+        METRICS.reset()
+    await inter.response.send_message(text, ephemeral=True)
+
+# ================== シャード状況 ==================
+def local_shards() -> Dict[int, Optional[float]]:
+    """ このプロセスが持つシャード → レイテンシ(ms)。まだ繋がっていなければ None """
+    def ms(v: float) -> Optional[float]:
+        return None if v != v or v == float("inf") else v * 1000.0
+    if isinstance(bot, commands.AutoShardedBot):
+        ids = bot.shard_ids or list(bot.shards)
+        return {sid: ms(bot.shards[sid].latency) if sid in bot.shards else None for sid in ids}
+    return {0: ms(bot.latency)}
+
+def report_shards():
+    shards = local_shards()
+    count = bot.shard_count or 1
+    tables: Counter = Counter(shard_for_guild(g.guild_id, count) for g in GAMES.values())
+    guilds: Counter = Counter(shard_for_guild(g.id, count) for g in bot.guilds)
+    for sid, latency in shards.items():
+        STORE.report_shard(sid, latency, tables.get(sid, 0), guilds.get(sid, 0))
+
+async def shard_report_loop(interval: float = SHARD_REPORT_INTERVAL):
+    while True:
+        try:
+            report_shards()
+        except sqlite3.Error as e:
+            print("Shard report error:", e)
+        await asyncio.sleep(interval)
+
+@tree.command(name="chi_shards", description="シャードごとのレイテンシと卓数を表示")
+async def chi_shards(inter: discord.Interaction):
+    rows = STORE.shard_reports()
+    if not rows:
+        shards = local_shards()
+        rows = [(sid, os.getpid(), lat, len(GAMES), len(bot.guilds), time.time()) for sid, lat in shards.items()]
+    now = time.time()
+    lines = [
+        f"shard {sid}（pid {pid}）：{'—' if lat is None else f'{lat:.0f}ms'} / 卓 {tables} / ギルド {guilds} / {now - ts:.0f}秒前"
+        for sid, pid, lat, tables, guilds, ts in rows
+    ]
+    await inter.response.send_message("【シャード】\n" + "\n".join(lines), ephemeral=True)
+
+def run_cluster(procs: int = CLUSTER_PROCS, shard_count: int = SHARD_COUNT, entry: Optional[List[str]] = None):
+    """
+    シャードを procs 個に分け、それぞれを auto モードの子プロセスで起動して待つ。
+    entry は子プロセスのコマンド（既定はこのファイル。tools/shard_harness.py が偽ゲートウェイにつなぐワーカーを渡す）
+    """
+    entry = entry or [sys.executable, os.path.abspath(__file__)]
+    shard_count = shard_count or procs
+    per = -(-shard_count // procs)
+    children = []
+    for i in range(procs):
+        lo, hi = i * per, min(shard_count, (i + 1) * per) - 1
+        if lo > hi:
+            break
+        env = dict(os.environ, CHI_SHARD_MODE="auto", CHI_SHARD_COUNT=str(shard_count), CHI_SHARD_IDS=f"{lo}-{hi}")
+        children.append(subprocess.Popen(entry, env=env))
+        print(f"shard {lo}-{hi} → pid {children[-1].pid}")
+    try:
+        for p in children:
+            p.wait()
+    except KeyboardInterrupt:
+        for p in children:
+            p.terminate()
+
+# ================== 起動計測 ==================
+def _process_start_time() -> float:
+    """ プロセスの起動時刻（epoch秒）。/proc が無い環境ではこのモジュールの読み込み時刻 """
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return btime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration, AttributeError):
+        return time.time()
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class StartupProbe:
+    """ プロファイル比較用：起動→ready、起動→最初の操作の時間と、その時点の常駐メモリ """
+    def __init__(self, profile: str = RUNTIME_PROFILE):
+        self.profile = profile
+        self.started_at = _process_start_time()
+        self.ready_after: Optional[float] = None
+        self.first_interaction_after: Optional[float] = None
+        self.rss_at_first_interaction: Optional[int] = None
+
+    def mark_ready(self):
+        if self.ready_after is None:
+            self.ready_after = time.time() - self.started_at
+
+    def mark_interaction(self):
+        if self.first_interaction_after is None:
+            self.first_interaction_after = time.time() - self.started_at
+            self.rss_at_first_interaction = rss_bytes()
+            print(f"[profile={self.profile}] {self.summary()}")
+
+    def summary(self) -> str:
+        ready = "—" if self.ready_after is None else f"{self.ready_after:.2f}s"
+        first = "—" if self.first_interaction_after is None else f"{self.first_interaction_after:.2f}s"
+        return f"ready {ready} / 最初の操作 {first} / RSS {rss_bytes() / 2**20:.1f}MB"
+
+STARTUP = StartupProbe()
+
+@bot.listen("on_interaction")
+async def _probe_first_interaction(inter: discord.Interaction):
+    STARTUP.mark_interaction()
+    data = inter.data or {}
+    METRICS.inc("interactions", command=data.get("name") or data.get("custom_id", "?"), phase=_phase_of(inter.channel_id))
+
+# ================== コマンド同期 ==================
+def command_tree_fingerprint() -> str:
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda d: d["name"])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def sync_commands_if_changed() -> bool:
+    """ 前回同期したときのコマンド定義ハッシュと違う場合だけ tree.sync() する """
+    key = f"tree_hash:{bot.application_id}"
+    digest = command_tree_fingerprint()
+    if not FORCE_COMMAND_SYNC and STORE.get_meta(key) == digest:
+        print("コマンド定義に変更なし（同期をスキップ）")
+        return False
+    await tree.sync()
+    STORE.set_meta(key, digest)
+    print("✅ コマンド同期完了")
+    return True
 
 # ================== 起動 ==================
 @bot.event
-async def on_ready():
+async def setup_hook():
+    print(f"ロールアニメ形式：{negotiate_anim_format()}（使用可能：{', '.join(anim_formats())}）")
+    # 永続ビューの受け口（ゲーム本体は押されたときにストアから読む）
+    bot.add_view(LobbyView())
+    bot.add_view(BetView())
+    bot.add_view(RollView())
+    # テーマのアトラスは最初のロールを待たせないよう先に作る（プロセスワーカーは各自で初回に作る）
+    for name in DICE_THEMES:
+        await asyncio.to_thread(dice_atlas, name)
+    print("サイコロのテーマ：" + " / ".join(theme_footprint_lines()))
+    ANIM_POOL.start()
     try:
-        await tree.sync()
+        await asyncio.to_thread(ROLL_LOG.open)     # 既存のログから集計を作り直す（ゲートウェイ接続前に1回）
+    except OSError as e:
+        print("Roll log error:", e)
+    asyncio.create_task(GAMES.sweep_loop())
+    OUTBOX.start()
+    if STORE.enabled:
+        asyncio.create_task(shard_report_loop())
+    if COMPOSITE_PREWARM:
+        asyncio.create_task(COMPOSITE_CACHE.prewarm())
+    await start_metrics_server()
+    if METRICS_FILE:
+        asyncio.create_task(metrics_file_loop())
+    # 再接続のたびに走る on_ready ではなく、起動時に1回だけ
+    try:
+        await sync_commands_if_changed()
     except Exception as e:
         print("Slash sync error:", e)
-    print(f"✅ コマンド同期完了 / Bot {bot.user} 起動")
+
+@bot.event
+async def on_ready():
+    STARTUP.mark_ready()
+    print(f"✅ Bot {bot.user} 起動（profile={RUNTIME_PROFILE}）")
 
 if __name__ == "__main__":
     if not TOKEN:
         print("環境変数 DISCORD_TOKEN が設定されていません。")
+    elif SHARD_MODE == "cluster":
+        run_cluster()
     else:
         bot.run(TOKEN)
@@ -0,0 +1,216 @@
+# tools/bench.py
+# 描画・役判定・表示テキストのマイクロベンチマーク（オフラインで動く）。
+# 1回あたりの時間・ピークのメモリ確保量（tracemalloc）・エンコード後のバイト数を出す。
+#
+#   python tools/bench.py                        # 結果を表示
+#   python tools/bench.py --save bench.json      # ベースラインとして保存
+#   python tools/bench.py --compare bench.json   # ベースラインと比べ、悪化したケースがあれば終了コード1
+#   python tools/bench.py -k anim --quick        # 名前で絞り込み・短時間モード
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # assets/dice を相対パスで読むため
+
+import main  # noqa: E402
+
+SEED = 1234
+
+# ---------- ケース ----------
+def _game(n: int) -> "main.GameState":
+    game = main.GameState(channel_id=1, host_id=10_000_000_000_000_000)
+    game.participants = [10_000_000_000_000_000 + i for i in range(n)]
+    game.parent_id = game.participants[0]
+    game.children_order = game.participants[1:]
+    for i, uid in enumerate(game.children_order):
+        (game.bets if i % 2 else game.temp_bets)[uid] = main.BET_STEP * (i % 50 + 1)
+    return game
+
+def _roll_log(records: int) -> "main.RollLog":
+    """ 一時ディレクトリのロールログに records 件（ロール:勝負 = 2:1、1000人）を書いておく """
+    log = main.RollLog(tempfile.mkdtemp(prefix="chi_bench_"))
+    for k in range(records // 3):
+        dice = main.roll_dice()
+        uid, parent = 10_000 + k % 1000, 10_000 + (k + 1) % 1000
+        log.append(main.REC_ROLL, 1, uid, dice, main.evaluate_hand(dice).score, main.BET_STEP)
+        log.append(main.REC_MATCH, 1, uid, None, 0, main.BET_STEP, random.choice((-1, 0, 1)) * main.BET_STEP)
+        log.append(main.REC_MATCH, 1, parent, None, 0, main.BET_STEP, 0, main.REC_PARENT)
+    return log
+
+def _roll_log_append(log: "main.RollLog"):
+    for k in range(1000):
+        log.append(main.REC_ROLL, 1, 10_000 + k % 1000, (1, 2, 3), 8)
+
+def _stats_with(log: "main.RollLog", user_id: int) -> str:
+    main.ROLL_LOG = log
+    return main.player_stats_text(user_id)
+
+def _atlas_cold(theme: str):
+    main._ATLASES.clear()
+    return main.dice_atlas(theme)
+
+def _cases() -> List[Tuple[str, Callable[[], Callable[[], object]]]]:
+    """ (名前, 準備関数) の一覧。準備関数は計測対象の引数なし関数を返す """
+    cases = [
+        ("anim_webp", lambda: lambda: main.make_roll_animation(fmt="webp")),
+        ("anim_gif", lambda: lambda: main.make_roll_animation(fmt="gif")),
+        ("compose_three_dice", lambda: lambda: main.compose_three_dice_image([random.randint(1, 6) for _ in range(3)])),
+        ("anim_frames", lambda: lambda: main._roll_frames(main.ROLL_ANIM_FRAMES, main.COMPOSITE_GAP)),
+        ("compose_grid_10", lambda: lambda: main.compose_dice_grid_image([main.roll_dice() for _ in range(10)], highlight=0)),
+        ("atlas_build_classic", lambda: lambda: _atlas_cold("classic")),
+        ("atlas_build_noir", lambda: lambda: _atlas_cold("noir")),
+        ("evaluate_hand", lambda: (lambda rolls: lambda: [main.evaluate_hand(d) for d in rolls])(
+            [[random.randint(1, 6) for _ in range(3)] for _ in range(1000)])),
+        ("compare", lambda: (lambda hands: lambda: [main.compare(a, b) for a, b in hands])(
+            [(main.evaluate_hand(main.roll_dice()), main.evaluate_hand(main.roll_dice())) for _ in range(1000)])),
+        ("roll_dice_stream", lambda: (lambda rng: lambda: [main.roll_dice(rng) for _ in range(1000)])(main.DiceStream(bytes(32)))),
+        ("roll_dice_random", lambda: lambda: [main.roll_dice() for _ in range(1000)]),
+        ("roll_log_append", lambda: (lambda log: lambda: _roll_log_append(log))(_roll_log(0))),
+        ("player_stats_text_300k", lambda: (lambda log: lambda: _stats_with(log, 10_500))(_roll_log(300_000))),
+    ]
+    for n in (10, 100, 1000):
+        cases.append((f"lobby_text_{n}", lambda n=n: (lambda g: lambda: main.lobby_text(g))(_game(n))))
+        cases.append((f"bet_panel_text_{n}", lambda n=n: (lambda g: lambda: main.bet_panel_text(g))(_game(n))))
+    return cases
+
+# PER_CALL のケースは1回の呼び出しで1000件処理するので、1件あたりに割り戻す
+PER_CALL = {"evaluate_hand": 1000, "compare": 1000, "roll_dice_stream": 1000, "roll_dice_random": 1000, "roll_log_append": 1000}
+
+# ---------- 計測 ----------
+def _encoded_size(result) -> Optional[int]:
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], (bytes, bytearray)):
+        return len(result[0])
+    if isinstance(result, str):
+        return len(result.encode())
+    return None
+
+def measure(name: str, fn: Callable[[], object], min_time: float, repeat: int) -> Dict[str, object]:
+    random.seed(SEED)
+    result = fn()                          # ウォームアップ兼サイズ計測
+    size = _encoded_size(result)
+
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if time.perf_counter() - t0 >= min_time / 5 or loops >= 1 << 20:
+            break
+        loops *= 2
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((time.perf_counter() - t0) / loops)
+
+    random.seed(SEED)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per = PER_CALL.get(name, 1)
+    return {
+        "us_per_op": 1e6 * statistics.median(samples) / per,
+        "us_min": 1e6 * min(samples) / per,
+        "spread": (max(samples) - min(samples)) / statistics.median(samples),     # 繰り返し間のばらつき（中央値比）
+        "peak_kb": peak / 1024,
+        "bytes": size,
+        "loops": loops,
+    }
+
+def run(pattern: str, quick: bool) -> Dict[str, Dict[str, object]]:
+    results = {}
+    for name, setup in _cases():
+        if pattern and pattern not in name:
+            continue
+        random.seed(SEED)
+        fn = setup()
+        results[name] = measure(name, fn, min_time=0.2 if quick else 1.0, repeat=3 if quick else 7)
+        r = results[name]
+        size = "" if r["bytes"] is None else f"  {r['bytes']:>9,d} B"
+        print(f"{name:<22} {r['us_per_op']:>12.2f} us/op  (min {r['us_min']:.2f})  peak {r['peak_kb']:>9.1f} KiB{size}")
+    return results
+
+def compare(results: Dict[str, Dict[str, object]], baseline: Dict[str, Dict[str, object]],
+            time_tol: float, mem_tol: float, size_tol: float) -> List[str]:
+    """
+    ベースラインより悪化した項目を返す（時間は中央値、サイズ/メモリはそのまま比べる）。
+    時間は、今回とベースラインの繰り返し間のばらつきを足した幅までは誤差として扱う（tol より狭くはしない）
+    """
+    regressions = []
+    print()
+    print(f"{'case':<22} {'time':>9} {'peak':>9} {'bytes':>9}")
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<22} (ベースラインなし)")
+            continue
+        cols = []
+        for key, tol in (("us_per_op", time_tol), ("peak_kb", mem_tol), ("bytes", size_tol)):
+            if not base.get(key) or cur.get(key) is None:
+                cols.append(f"{'—':>9}")
+                continue
+            ratio = cur[key] / base[key]
+            if key == "us_per_op":
+                tol = max(tol, cur.get("spread", 0.0) + base.get("spread", 0.0))
+            flag = "!" if ratio > 1 + tol else " "
+            cols.append(f"{ratio:>8.2f}x{flag}")
+            if flag == "!":
+                regressions.append(f"{name}.{key}: {base[key]:.1f} → {cur[key]:.1f} ({ratio:.2f}x)")
+        print(f"{name:<22} " + " ".join(cols))
+    return regressions
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="描画・役判定・表示テキストのマイクロベンチマーク")
+    ap.add_argument("-k", "--filter", default="", help="名前にこの文字列を含むケースだけ")
+    ap.add_argument("--quick", action="store_true", help="計測時間を短くする")
+    ap.add_argument("--save", help="結果をJSONで保存（ベースライン）")
+    ap.add_argument("--compare", help="このJSONのベースラインと比べる")
+    ap.add_argument("--time-tolerance", type=float, default=None, help="既定 0.15（--quick では 1.0：短い計測は実行ごとに倍近く揺れる）")
+    ap.add_argument("--mem-tolerance", type=float, default=0.10)
+    ap.add_argument("--size-tolerance", type=float, default=0.02)
+    args = ap.parse_args()
+
+    results = run(args.filter, args.quick)
+    if args.save:
+        doc = {
+            "meta": {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "pillow": main.Image.__version__,
+                "machine": platform.machine(),
+                "seed": SEED,
+            },
+            "results": results,
+        }
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(doc, f, indent=2, ensure_ascii=False)
+        print(f"saved {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        time_tol = args.time_tolerance if args.time_tolerance is not None else (1.0 if args.quick else 0.15)
+        regressions = compare(results, baseline, time_tol, args.mem_tolerance, args.size_tolerance)
+        if regressions:
+            print("\n悪化:")
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print("\n悪化なし")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,236 @@
+# tools/fake_discord.py
+# main.py のハンドラをネットワークなしで動かすための Discord スタブ。
+# 送信・編集・削除などの REST 相当の呼び出しは全て CallLog に記録する。
+import asyncio
+import itertools
+import os
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discord.ui.view import ViewStore
+
+_ids = itertools.count(10_000)
+
+# discord.py の ConnectionState と同じく、ビュー付きで送った・編集したメッセージのビューを保持する（stop() で外れる）
+VIEW_STORE = ViewStore(None)
+
+def store_view(view, message_id: int):
+    if view is not None and view is not ... and not view.is_finished():
+        VIEW_STORE.add_view(view, message_id)
+
+def live_views() -> list:
+    """ ViewStore に残っているメッセージ付きビュー """
+    return list(VIEW_STORE._synced_message_views.values())
+
+def snowflake() -> int:
+    return next(_ids)
+
+class CallLog:
+    """ REST 相当の呼び出し回数（種類別・チャンネル別） """
+    def __init__(self):
+        self.by_kind: Counter = Counter()
+        self.by_channel: Counter = Counter()
+        self.total = 0
+
+    def record(self, kind: str, channel_id: int):
+        self.by_kind[kind] += 1
+        self.by_channel[channel_id] += 1
+        self.total += 1
+
+class FakeUser:
+    def __init__(self, uid: int):
+        self.id = uid
+        self.mention = f"<@{uid}>"
+        self.name = self.display_name = f"player{uid}"
+        self.bot = False
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", content: Optional[str] = None, view=None, files: Optional[list] = None):
+        self.id = snowflake()
+        self.channel = channel
+        self.content = content
+        self.view = view
+        self.attachments = list(files or [])
+        self.deleted = False
+
+    async def edit(self, *, content=..., view=..., attachments=..., **kwargs):
+        self.channel.log.record("edit", self.channel.id)
+        await self.channel.latency()
+        if content is not ...:
+            self.content = content
+        if view is not ...:
+            self.view = view
+            store_view(view, self.id)
+        if attachments is not ...:
+            self.attachments = list(attachments)
+        return self
+
+    async def delete(self, **kwargs):
+        self.channel.log.record("delete", self.channel.id)
+        await self.channel.latency()
+        self.deleted = True
+
+class FakeChannel:
+    def __init__(self, channel_id: int, log: CallLog, guild_id: Optional[int] = None, rest_latency: float = 0.0):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+        self.guild_id = guild_id
+        self.log = log
+        self.rest_latency = rest_latency
+        self.messages: Dict[int, FakeMessage] = {}
+        self.threads: List["FakeChannel"] = []
+
+    async def latency(self):
+        await asyncio.sleep(self.rest_latency)
+
+    def _new_message(self, content=None, view=None, file=None, files=None) -> FakeMessage:
+        msg = FakeMessage(self, content, view, ([file] if file else []) + list(files or []))
+        self.messages[msg.id] = msg
+        store_view(view, msg.id)
+        return msg
+
+    async def send(self, content=None, *, view=None, file=None, files=None, **kwargs) -> FakeMessage:
+        self.log.record("send", self.id)
+        await self.latency()
+        return self._new_message(content, view, file, files)
+
+    async def create_thread(self, *, name: str, **kwargs) -> "FakeChannel":
+        self.log.record("create_thread", self.id)
+        await self.latency()
+        thread = FakeChannel(snowflake(), self.log, guild_id=self.guild_id, rest_latency=self.rest_latency)
+        thread.name = name
+        self.threads.append(thread)
+        return thread
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        msg = self.messages.get(message_id)
+        if msg is None:     # 再起動後など、このプロセスが知らないメッセージ
+            msg = FakeMessage(self)
+            msg.id = message_id
+            self.messages[message_id] = msg
+        return msg
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        self.log.record("fetch_message", self.id)
+        await self.latency()
+        return self.get_partial_message(message_id)
+
+    def last_view(self, cls):
+        for msg in reversed(list(self.messages.values())):
+            if isinstance(msg.view, cls) and not msg.deleted:
+                return msg, msg.view
+        return None, None
+
+class FakeResponse:
+    def __init__(self, inter: "FakeInteraction"):
+        self._inter = inter
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    def _mark(self):
+        self._done = True
+        self._inter.responded_at = time.perf_counter()
+
+    async def defer(self, *, ephemeral: bool = False, thinking: bool = False):
+        self._inter.channel.log.record("interaction_response", self._inter.channel.id)
+        self._mark()
+
+    async def send_message(self, content=None, *, ephemeral: bool = False, view=None, file=None, **kwargs):
+        self._inter.channel.log.record("interaction_response", self._inter.channel.id)
+        self._mark()
+        msg = self._inter.channel._new_message(content, view, file)
+        self._inter._original = msg
+        if ephemeral:
+            self._inter.ephemeral.append(content)
+
+class FakeFollowup:
+    def __init__(self, inter: "FakeInteraction"):
+        self._inter = inter
+
+    async def send(self, content=None, *, ephemeral: bool = False, view=None, file=None, files=None, wait: bool = True, **kwargs):
+        ch = self._inter.channel
+        ch.log.record("followup", ch.id)
+        await ch.latency()
+        if ephemeral:
+            self._inter.ephemeral.append(content)
+        msg = ch._new_message(content, view, file, files)
+        if self._inter._original is None:
+            self._inter._original = msg
+        return msg
+
+class FakeInteraction:
+    def __init__(self, channel: FakeChannel, user_id: int, *, message: Optional[FakeMessage] = None,
+                 custom_id: Optional[str] = None):
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = None
+        self.guild_id = channel.guild_id
+        self.user = FakeUser(user_id)
+        self.message = message
+        self.data = {"custom_id": custom_id} if custom_id else {}
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.ephemeral: List[str] = []
+        self.extras: Dict[str, object] = {}
+        self.created_at = time.perf_counter()
+        self.responded_at: Optional[float] = None
+        self._original = message
+
+    async def edit_original_response(self, **kwargs):
+        self.channel.log.record("edit_original_response", self.channel.id)
+        await self.channel.latency()
+        if self._original is not None:
+            for key in ("content", "view", "attachments"):
+                if key in kwargs:
+                    setattr(self._original, key, kwargs[key])
+            store_view(kwargs.get("view"), self._original.id)
+        return self._original
+
+    async def original_response(self):
+        return self._original
+
+def patch_bot(main):
+    """ main.bot のユーザー取得をスタブに差し替える（キャッシュは空扱い） """
+    async def fetch_user(uid: int):
+        return FakeUser(uid)
+    main.bot.fetch_user = fetch_user
+    main.bot.get_user = lambda uid: None
+
+def unbound_views(main) -> Dict[str, object]:
+    """ 起動時に add_view される受け口ビュー（custom_id の接頭辞 → ビュー）。ループ内で呼ぶこと """
+    return {"chi:lobby": main.LobbyView(), "chi:bet": main.BetView(), "chi:roll": main.RollView()}
+
+async def click(views: Dict[str, object], channel: FakeChannel, user_id: int, custom_id: str,
+                message: Optional[FakeMessage] = None) -> FakeInteraction:
+    """
+    ボタンを押す。discord.py の ViewStore と同じく、メッセージに結び付いたビューが生きていればそちらへ、
+    無ければ起動時の受け口ビュー（ゲームはチャンネルIDからストア/メモリで引かれる）へ渡す。
+    """
+    inter = FakeInteraction(channel, user_id, message=message, custom_id=custom_id)
+    bound = getattr(message, "view", None)
+    item = None
+    if bound is not None and not bound.is_finished():
+        item = next((c for c in bound.children if getattr(c, "custom_id", None) == custom_id), None)
+    if item is None:
+        await views[custom_id.rsplit(":", 1)[0]].interaction_check(inter)
+    elif await bound.interaction_check(inter):
+        await item.callback(inter)
+    return inter
+
+async def run_slash(command, channel: FakeChannel, user_id: int) -> FakeInteraction:
+    inter = FakeInteraction(channel, user_id)
+    await command.callback(inter)
+    return inter
+
+async def drain(game, timeout: float = 30.0):
+    """ 卓アクターのキューが空になり、処理中の操作も無くなるまで待つ """
+    deadline = time.monotonic() + timeout
+    actor = game.actor if game is not None else None
+    while actor is not None and (not actor.queue.empty() or actor._keys) and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
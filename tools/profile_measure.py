@@ -0,0 +1,121 @@
+# tools/profile_measure.py
+# CHI_PROFILE（default / lean）ごとの常駐メモリと「起動→最初の操作」の時間を比べる。
+# 子プロセスで main を読み込み、GUILD_CREATE 相当のギルド（メンバー付き）と MESSAGE_CREATE を
+# ゲートウェイ無しで状態に流し込んでから、最初の操作として /chi_status を1回処理する。
+# コマンド同期は2回呼び、2回目が定義ハッシュ一致でスキップされることも確かめる。
+#
+#   python tools/profile_measure.py --guilds 50 --members 500 --messages 2000
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+def _guild_payload(gid: int, members: int) -> dict:
+    channel_id = gid + 1
+    return {
+        "id": str(gid), "name": f"guild{gid}", "owner_id": str(gid + 2), "member_count": members,
+        "roles": [{"id": str(gid), "name": "@everyone", "permissions": "0", "position": 0,
+                   "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [{"id": str(channel_id), "type": 0, "name": "chinchiro", "position": 0,
+                      "guild_id": str(gid), "permission_overwrites": []}],
+        "members": [
+            {"user": {"id": str(gid * 10_000 + i), "username": f"user{i}", "discriminator": "0",
+                      "global_name": None, "avatar": None},
+             "roles": [], "flags": 0, "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False}
+            for i in range(members)
+        ],
+        "emojis": [], "stickers": [], "features": [], "threads": [], "stage_instances": [],
+        "guild_scheduled_events": [], "voice_states": [], "presences": [],
+    }
+
+def _message_payload(gid: int, mid: int) -> dict:
+    return {
+        "id": str(mid), "channel_id": str(gid + 1), "guild_id": str(gid), "type": 0, "content": "ｺﾛｺﾛ",
+        "author": {"id": str(gid * 10_000), "username": "user0", "discriminator": "0", "avatar": None},
+        "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None, "tts": False,
+        "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+        "embeds": [], "pinned": False,
+    }
+
+# ---------- 子プロセス ----------
+def child(args) -> dict:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import fake_discord as fd
+    import main
+
+    state = main.bot._connection
+    state.dispatch = lambda *a, **k: None     # ゲートウェイ無しなのでイベントは配らない
+    base_rss = main.rss_bytes()
+    gids = [(k + 1) << 22 for k in range(args.guilds)]
+    for gid in gids:
+        state._add_guild_from_data(_guild_payload(gid, args.members))
+    for n in range(args.messages):
+        gid = gids[n % len(gids)]
+        state.parse_message_create(_message_payload(gid, (gid + 100) + n))
+
+    syncs = []
+    async def fake_sync(*a, **k):
+        syncs.append(1)
+        return []
+    main.tree.sync = fake_sync
+
+    async def run():
+        await main.sync_commands_if_changed()
+        await main.sync_commands_if_changed()
+        main.STARTUP.mark_ready()
+        ch = fd.FakeChannel(gids[0] + 1, fd.CallLog(), guild_id=gids[0])
+        inter = fd.FakeInteraction(ch, gids[0] * 10_000)
+        await main._probe_first_interaction(inter)
+        await fd.run_slash(main.chi_status, ch, gids[0] * 10_000)
+
+    asyncio.run(run())
+    return {
+        "profile": main.RUNTIME_PROFILE,
+        "intents": main.INTENTS.value,
+        "cached_members": sum(len(g.members) for g in main.bot.guilds),
+        "cached_messages": len(state._messages or ()),
+        "rss_import_mb": base_rss / 2**20,
+        "rss_loaded_mb": main.STARTUP.rss_at_first_interaction / 2**20,
+        "first_interaction_s": main.STARTUP.first_interaction_after,
+        "tree_syncs": len(syncs),
+    }
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="実行プロファイルごとのメモリ/起動時間の比較")
+    ap.add_argument("--guilds", type=int, default=50)
+    ap.add_argument("--members", type=int, default=500)
+    ap.add_argument("--messages", type=int, default=2000)
+    ap.add_argument("--profiles", default="default,lean")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args)))
+        return 0
+
+    results = []
+    for profile in args.profiles.split(","):
+        env = dict(os.environ, CHI_PROFILE=profile, CHI_FORCE_SYNC="0",
+                   CHI_GAME_DB=os.path.join(tempfile.mkdtemp(prefix="chi_profile_"), "games.db"))
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--guilds", str(args.guilds),
+             "--members", str(args.members), "--messages", str(args.messages)],
+            env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"guilds {args.guilds} × members {args.members}, messages {args.messages}")
+    for r in results:
+        print(f"{r['profile']:>8}: RSS import {r['rss_import_mb']:.1f}MB → loaded {r['rss_loaded_mb']:.1f}MB"
+              f" / cached members {r['cached_members']} / cached messages {r['cached_messages']}"
+              f" / first interaction {r['first_interaction_s']:.2f}s / tree.sync calls {r['tree_syncs']}")
+    if len(results) == 2:
+        a, b = results
+        print(f"RSS saved by {b['profile']}: {a['rss_loaded_mb'] - b['rss_loaded_mb']:.1f}MB")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
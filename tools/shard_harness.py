@@ -0,0 +1,266 @@
+# tools/shard_harness.py
+# シャード分割モードをローカルで確かめるハーネス。
+#   親プロセス = 偽ゲートウェイ。ギルドIDからシャードを求め、そのシャードを持つワーカーにイベントを流す。
+#   ワーカー   = main を読み込んだ子プロセス。受け取ったイベントを永続ビュー/スラッシュコマンドに渡す。
+# 卓の状態は共有の SQLite にしか無いので、ゲートウェイもワーカーもそこを見て進行する。
+# --cluster ではワーカーを main.run_cluster で起動する（CHI_SHARD_MODE=auto の AutoShardedBot が受け持つシャードを決め、
+# ローカルのソケットで偽ゲートウェイにつなぐ）。
+# 送信スケジューラの上限（既定 5回/5秒）で頭打ちにならないよう、ワーカーでは --outbound-burst（既定 0=上限なし）にする。
+#
+#   python tools/shard_harness.py --procs 3 --shards 6 --guilds 12 --rounds 2
+#   python tools/shard_harness.py --cluster --procs 2 --shards 4
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import multiprocessing.connection as mpc
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+HOST_OFFSET = 1_000
+PLAYERS_PER_TABLE = 4
+
+def _players(channel_id: int):
+    base = channel_id * 10 + HOST_OFFSET
+    return [base + i for i in range(PLAYERS_PER_TABLE)]
+
+# ---------- ワーカー ----------
+def worker_main(shard_ids, shard_count, db_path, inbox, outbox):
+    os.environ["CHI_GAME_DB"] = db_path
+    os.environ["CHI_ROLL_LOG_DIR"] = os.path.join(os.path.dirname(db_path), "rolls")
+    os.environ["CHI_SHARD_IDS"] = ",".join(map(str, shard_ids))    # ロールログのファイルをワーカーごとに分ける
+    os.environ["CHI_SHARD_MODE"] = "off"
+    serve(shard_ids, shard_count, inbox, outbox)
+
+class _ConnQueue:
+    """ ソケットの接続を Queue と同じ put/get で使う """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, obj):
+        self.conn.send(obj)
+
+    def get(self):
+        return self.conn.recv()
+
+def cluster_worker():
+    """ run_cluster が起動する子プロセス。受け持ちのシャードは AutoShardedBot（CHI_SHARD_IDS / CHI_SHARD_COUNT）から取る """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import fake_discord  # noqa: F401  （main を import できるようにパスを通す）
+    import main
+    from discord.ext import commands
+
+    if not isinstance(main.bot, commands.AutoShardedBot):
+        raise RuntimeError(f"CHI_SHARD_MODE={main.SHARD_MODE}：run_cluster から起動されていない")
+    shard_ids, shard_count = main.bot.shard_ids, main.bot.shard_count
+    host, port = os.environ["CHI_HARNESS_ADDR"].rsplit(":", 1)
+    conn = mpc.Client((host, int(port)), authkey=os.environ["CHI_HARNESS_AUTHKEY"].encode())
+    conn.send(("hello", shard_ids, os.getpid()))
+    q = _ConnQueue(conn)
+    serve(shard_ids, shard_count, q, q)
+    conn.close()
+
+def serve(shard_ids, shard_count, inbox, outbox):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import fake_discord as fd
+    import main
+
+    main.ANIM_POOL = main.AnimationPool(size=2, cache_dir="")
+    fd.patch_bot(main)
+    log = fd.CallLog()
+    channels = {}
+    handled = set()
+    timings = []
+
+    async def handle(ev):
+        cid, gid = ev["channel_id"], ev["guild_id"]
+        owner = main.shard_for_guild(gid, shard_count)
+        if owner not in shard_ids:
+            raise RuntimeError(f"shard {owner} のイベントが別プロセスに届いた")
+        ch = channels.setdefault(cid, fd.FakeChannel(cid, log, guild_id=gid))
+        handled.add(cid)
+        t0 = time.perf_counter()
+        if ev["type"] == "slash":
+            await fd.run_slash(getattr(main, ev["name"]), ch, ev["user_id"])
+        else:
+            msg = ch.get_partial_message(ev["message_id"]) if ev.get("message_id") else None
+            await fd.click(views, ch, ev["user_id"], ev["custom_id"], message=msg)
+        await fd.drain(main.GAMES.get(cid))
+        timings.append((owner, time.perf_counter() - t0))
+
+    async def loop():
+        nonlocal views
+        views = fd.unbound_views(main)
+        main.OUTBOUND = main.OutboundScheduler()    # CHI_OUTBOUND_BURST はゲートウェイが決める
+        while True:
+            batch = await asyncio.get_running_loop().run_in_executor(None, inbox.get)
+            if batch is None:
+                break
+            # チャンネル内は順番に、チャンネル同士は並行に
+            async def run_channel(evs):
+                for ev in evs:
+                    await handle(ev)
+            await asyncio.gather(*(run_channel(evs) for evs in batch))
+            outbox.put(("ack", len(batch)))
+        # シャードごとの状況を共有ストアへ
+        tables = {sid: 0 for sid in shard_ids}
+        for game in main.GAMES.values():
+            tables[main.shard_for_guild(game.guild_id, shard_count)] += 1
+        for sid in shard_ids:
+            ts = [t for s, t in timings if s == sid]
+            latency = 1000.0 * sum(ts) / len(ts) if ts else None
+            main.STORE.report_shard(sid, latency, tables[sid], len({c for c in handled if main.shard_for_guild(channels[c].guild_id, shard_count) == sid}))
+        outbox.put(("done", os.getpid(), sorted(handled), log.total))
+
+    views = None
+    asyncio.run(loop())
+
+# ---------- 偽ゲートウェイ ----------
+def start_workers(args, db_path):
+    """ ワーカーを multiprocessing で起動する（シャードの割り当てはここで決める） """
+    per = -(-args.shards // args.procs)
+    ctx = mp.get_context("spawn")
+    workers = []
+    for i in range(args.procs):
+        ids = list(range(i * per, min(args.shards, (i + 1) * per)))
+        if not ids:
+            break
+        inbox, outbox = ctx.Queue(), ctx.Queue()
+        p = ctx.Process(target=worker_main, args=(ids, args.shards, db_path, inbox, outbox))
+        p.start()
+        workers.append((ids, inbox, outbox, p))
+    return workers
+
+def start_cluster(args, db_path):
+    """ ワーカーを main.run_cluster で起動し、つないできた順に受け持ちのシャードを聞く """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+
+    authkey = os.urandom(16).hex()
+    listener = mpc.Listener(("127.0.0.1", 0), authkey=authkey.encode())
+    os.environ.update({
+        "CHI_GAME_DB": db_path,
+        "CHI_ROLL_LOG_DIR": os.path.join(os.path.dirname(db_path), "rolls"),
+        "CHI_HARNESS_ADDR": "%s:%d" % listener.address,
+        "CHI_HARNESS_AUTHKEY": authkey,
+    })
+    entry = [sys.executable, os.path.abspath(__file__), "--worker"]
+    cluster = threading.Thread(target=main.run_cluster, args=(args.procs, args.shards, entry))
+    cluster.start()
+    per = -(-args.shards // args.procs)
+    procs = -(-args.shards // per)      # run_cluster と同じ分け方で起動される数
+    workers = []
+    while len(workers) < procs:
+        conn = listener.accept()
+        _, ids, pid = conn.recv()
+        q = _ConnQueue(conn)
+        workers.append((list(ids), q, q, cluster))
+    listener.close()
+    return sorted(workers, key=lambda w: w[0])
+def next_events(row, channel_id, guild_id, rounds):
+    """ 共有ストアの卓の状態から、次に人間がしそうな操作を作る（同じチャンネル内は順に処理される） """
+    players = _players(channel_id)
+    host = players[0]
+    base = {"channel_id": channel_id, "guild_id": guild_id}
+    if row is None:
+        return [dict(base, type="slash", name="chi_ready", user_id=host)]
+    g = json.loads(row)
+    if g["round_no"] >= rounds:
+        return []
+    phase = g["phase"]
+    if phase == "lobby":
+        missing = [u for u in players if u not in g["participants"]]
+        base["message_id"] = g["lobby_message_id"]
+        if missing:
+            return [dict(base, type="button", custom_id="chi:lobby:join", user_id=missing[0])]
+        return [dict(base, type="button", custom_id="chi:lobby:decide", user_id=host)]
+    if phase == "betting":
+        base["message_id"] = g["bet_panel_message_id"]
+        unbet = [u for u in g["children_order"] if str(u) not in g["bets"]]
+        if unbet:
+            clicks = ["plus"] * random.randint(0, 3) + ["confirm"]
+            return [dict(base, type="button", custom_id=f"chi:bet:{k}", user_id=unbet[0]) for k in clicks]
+        return [dict(base, type="button", custom_id="chi:bet:start", user_id=g["parent_id"])]
+    rs = g["parent_round"] if phase == "parent_roll" else g["child_round"]
+    if rs is None:
+        return []
+    action = "stop" if rs["last_roll"] and random.random() < 0.3 else "roll"
+    return [dict(base, type="button", custom_id=f"chi:roll:{action}", user_id=rs["user_id"])]
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="シャード分割モードの偽ゲートウェイ")
+    ap.add_argument("--procs", type=int, default=2)
+    ap.add_argument("--shards", type=int, default=4)
+    ap.add_argument("--guilds", type=int, default=8)
+    ap.add_argument("--rounds", type=int, default=1)
+    ap.add_argument("--max-ticks", type=int, default=500)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--cluster", action="store_true", help="ワーカーを main.run_cluster（AutoShardedBot）で起動する")
+    ap.add_argument("--outbound-burst", type=int, default=0,
+                    help="ワーカーの送信バケット（CHI_OUTBOUND_BURST。0=上限なし。events/s がシャードではなく送信上限を測らないように）")
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.worker:
+        cluster_worker()
+        return 0
+    random.seed(args.seed)
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="chi_shards_"), "games.db")
+    os.environ["CHI_OUTBOUND_BURST"] = str(args.outbound_burst)
+    workers = start_cluster(args, db_path) if args.cluster else start_workers(args, db_path)
+
+    # ギルドIDはシャード式 (id >> 22) % shards で散らばるように作る
+    guilds = [((k + 1) << 22) | k for k in range(args.guilds)]
+    channels = {g: 100 + i for i, g in enumerate(guilds)}
+    db = sqlite3.connect(db_path, timeout=5.0)
+    t0 = time.perf_counter()
+    events = 0
+    for tick in range(args.max_ticks):
+        batches = {i: [] for i in range(len(workers))}
+        for gid, cid in channels.items():
+            try:
+                row = db.execute("SELECT data FROM games WHERE channel_id = ?", (cid,)).fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            evs = next_events(row[0] if row else None, cid, gid, args.rounds)
+            if not evs:
+                continue
+            shard = (gid >> 22) % args.shards
+            batches[next(i for i, w in enumerate(workers) if shard in w[0])].append(evs)
+        if not any(batches.values()):
+            break
+        for i, batch in batches.items():
+            workers[i][1].put(batch)
+        for i in batches:
+            workers[i][2].get()
+        events += sum(len(evs) for b in batches.values() for evs in b)
+    elapsed = time.perf_counter() - t0
+
+    owned = {}
+    for ids, inbox, outbox, p in workers:
+        inbox.put(None)
+        _, pid, handled, calls = outbox.get()
+        owned[pid] = set(handled)
+        print(f"pid {pid} shards {ids}: channels {len(handled)}, API calls {calls}")
+    for *_, p in workers:
+        p.join()
+    overlap = [c for a in owned for b in owned if a < b for c in owned[a] & owned[b]]
+
+    print(f"{'cluster (run_cluster → AutoShardedBot)' if args.cluster else 'workers (multiprocessing)'}, "
+          f"outbound burst {args.outbound_burst or '∞'}")
+    print(f"events {events} in {elapsed:.2f}s ({events / elapsed:.0f}/s), ticks {tick + 1}")
+    for sid, pid, lat, tables, gcount, _ in db.execute(
+        "SELECT shard_id, pid, latency_ms, tables, guilds, updated_at FROM shards ORDER BY shard_id"
+    ):
+        print(f"shard {sid} (pid {pid}): {'—' if lat is None else f'{lat:.1f}ms'} / tables {tables} / guilds {gcount}")
+    done = sum(1 for (d,) in db.execute("SELECT data FROM games") if json.loads(d)["round_no"] >= args.rounds)
+    print(f"tables finished {done}/{len(channels)}, channels handled by more than one process: {len(overlap)}")
+    return 0 if not overlap else 1
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,208 @@
+# tools/simulate.py
+# 1プロセスで何卓さばけるかを見るためのヘッドレス負荷シミュレータ（ネットワークなし）。
+# fake_discord のチャンネル/インタラクションで chi_ready → ロビー → 親決め → ベット → ロール → 親交代 を
+# 卓ごとに繰り返し、ラウンド/秒・操作→応答の p50/p99・イベントループの遅れ・1ラウンドあたりのAPI呼び出し数を出す。
+#
+#   python tools/simulate.py --tables 200 --players 5 --rounds 3
+#   python tools/simulate.py --tables 50 --rest-latency 0.05 --think 0.2
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # assets/dice を相対パスで読むため
+
+import fake_discord as fd  # noqa: E402
+import main  # noqa: E402
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+class Stats:
+    def __init__(self):
+        self.response: List[float] = []      # 操作 → 最初の応答（defer / send_message）
+        self.complete: List[float] = []      # 操作 → 卓アクターが処理し終わるまで
+        self.loop_lag: List[float] = []
+        self.actions = 0
+        self.rounds = 0
+        self.unanswered = 0
+        self.stuck = 0
+
+async def loop_lag_monitor(stats: Stats, interval: float, stop: asyncio.Event):
+    """ interval ごとに起き、予定より何秒遅れて起きたかを記録する """
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(max(0.0, time.perf_counter() - t0 - interval))
+
+def next_action(game: "main.GameState", players: List[int]):
+    """ 卓の状態から、次に人間が押しそうなボタンを (user_id, custom_id, message_id) で返す """
+    host = players[0]
+    if game.phase == "lobby":
+        missing = [u for u in players if u not in game.participants]
+        if missing:
+            return missing[0], "chi:lobby:join", game.lobby_message_id
+        return host, "chi:lobby:decide", game.lobby_message_id
+    if game.phase == "betting":
+        unbet = [u for u in game.children_order if u not in game.bets]
+        if unbet:
+            uid = unbet[0]
+            if game.temp_bets.get(uid, 0) < main.BET_STEP * random.randint(1, 5):
+                return uid, "chi:bet:plus", game.bet_panel_message_id
+            return uid, "chi:bet:confirm", game.bet_panel_message_id
+        return game.parent_id, "chi:bet:start", game.bet_panel_message_id
+    rs = game.parent_round if game.phase == "parent_roll" else game.child_round
+    if rs is None:
+        return None
+    action = "stop" if rs.last_roll and random.random() < 0.3 else "roll"
+    return rs.user_id, f"chi:roll:{action}", game.turn_message_id
+
+async def play_table(ch: fd.FakeChannel, players: List[int], args, views, stats: Stats):
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    known = set(ch.threads)
+    await fd.run_slash(main.chi_ready, ch, players[0])
+    new_threads = [t for t in ch.threads if t not in known]
+    if new_threads:     # 同じチャンネルに卓があったのでスレッドに作られた
+        ch = new_threads[0]
+    cid = ch.id
+    game = main.get_game(cid)
+    idle = rounds = repeats = 0
+    last_act = None
+    while game is not None and game.round_no < args.rounds:
+        act = next_action(game, players)
+        repeats = repeats + 1 if act is not None and act == last_act else 0
+        last_act = act
+        if act is None or repeats > 50:     # 押しても進まない（断られ続ける）のも止まったとみなす
+            idle += 1
+            if idle > 100 or repeats > 50:
+                stats.stuck += 1
+                return
+            await asyncio.sleep(0.01)
+            continue
+        idle = 0
+        uid, custom_id, message_id = act
+        if args.think:
+            await asyncio.sleep(random.uniform(0, args.think))
+        msg = ch.get_partial_message(message_id) if message_id else None
+        inter = await fd.click(views, ch, uid, custom_id, message=msg)
+        await fd.drain(game)
+        done = time.perf_counter()
+        stats.actions += 1
+        if inter.responded_at is None:
+            stats.unanswered += 1
+        else:
+            stats.response.append(inter.responded_at - inter.created_at)
+        stats.complete.append(done - inter.created_at)
+        rounds = game.round_no
+        game = main.get_game(cid)
+    stats.rounds += game.round_no if game is not None else rounds
+
+async def run(args) -> int:
+    main.ANIM_POOL = main.AnimationPool(size=args.anim_pool, cache_dir="")
+    main.ANIM_POOL.start()
+    await main.ANIM_POOL.fill()
+    fd.patch_bot(main)
+    views = fd.unbound_views(main)
+    main.OUTBOX.start()
+    log = fd.CallLog()
+    stats = Stats()
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(loop_lag_monitor(stats, 0.01, stop))
+    sweeper = asyncio.create_task(main.GAMES.sweep_loop(interval=0.2))
+
+    tables = []
+    channels = {}
+    for t in range(args.tables):
+        base = 1_000 + t // args.tables_per_channel
+        ch = channels.setdefault(base, fd.FakeChannel(base, log, guild_id=base, rest_latency=args.rest_latency))
+        players = [(1_000 + t) * 100 + i for i in range(args.players)]
+        tables.append(play_table(ch, players, args, views, stats))
+    t0 = time.perf_counter()
+    await asyncio.gather(*tables)
+    settle_left = await main.OUTBOX.flush()
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    await monitor
+    await asyncio.sleep(0.3)     # 最後の掃除（上限を超えた分の退避）を1回通す
+    sweeper.cancel()
+
+    rounds = stats.rounds
+    ms = lambda v: f"{1000 * v:.1f}ms"
+    print(f"tables {args.tables} × players {args.players}, rounds/table {args.rounds}, "
+          f"rest latency {ms(args.rest_latency)}, think ≤{ms(args.think)}, store {'on' if main.STORE.enabled else 'off'}")
+    print(f"rounds {rounds} in {elapsed:.2f}s → {rounds / elapsed:.1f} rounds/s, {stats.actions / elapsed:.0f} actions/s")
+    print(f"interaction → response  p50 {ms(percentile(stats.response, 50))}  p99 {ms(percentile(stats.response, 99))}"
+          f"  max {ms(max(stats.response, default=0))}  (unanswered {stats.unanswered})")
+    print(f"interaction → processed p50 {ms(percentile(stats.complete, 50))}  p99 {ms(percentile(stats.complete, 99))}")
+    print(f"event loop lag          p50 {ms(percentile(stats.loop_lag, 50))}  p99 {ms(percentile(stats.loop_lag, 99))}"
+          f"  max {ms(max(stats.loop_lag, default=0))}  mean {ms(statistics.fmean(stats.loop_lag) if stats.loop_lag else 0)}")
+    per_round = {k: v / max(1, rounds) for k, v in log.by_kind.most_common()}
+    print(f"API calls/round {log.total / max(1, rounds):.1f}  (" + ", ".join(f"{k} {v:.1f}" for k, v in per_round.items()) + ")")
+    print(f"actor {dict(main.ACTOR_STATS)}, render peak queue {main.RENDER.peak_depth}, "
+          f"live tables {len(main.GAMES)}, evicted {dict(main.GAMES.evicted)}")
+    stored = fd.live_views()
+    stale = sum(1 for v in stored if v.game is not None and main.GAMES.get(v.game.channel_id) is not v.game)
+    print(f"views in store {len(stored)} (holding a closed/spilled table {stale})")
+    delivered = sum(v for (name, _), v in main.METRICS.counters.items() if name == "outbox_delivered")
+    print(f"settlement outbox ({', '.join(main.OUTBOX.sinks)}): delivered {delivered}, backlog {settle_left}, dead {main.OUTBOX.dead()}, "
+          f"channels kept {len(main.OUTBOX._channels)}, anim last {len(main.ANIM_POOL._last)}")
+    shed = sum(v for (name, _), v in main.METRICS.counters.items() if name == "outbound_shed")
+    collapsed = sum(v for (name, _), v in main.METRICS.counters.items() if name == "outbound_collapsed")
+    waits = ", ".join(f"{dict(labels)['priority']} p99≤{ms(h.quantile(0.99))}"
+                      for (name, labels), h in sorted(main.METRICS.hists.items()) if name == "outbound_wait_seconds")
+    print(f"outbound (burst {main.OUTBOUND.burst or '∞'}): shed {shed}, collapsed {collapsed}, wait {waits or '—'}")
+    if main.ROLL_LOG.enabled:
+        print(f"roll log {main.ROLL_LOG.count} records, {len(main.ROLL_LOG.players)} players")
+    for (name, labels), h in main.METRICS.hists.items():
+        if name == "click_to_result_seconds":
+            print(f"click → roll result ({dict(labels)['mode']}) n={h.count} avg {ms(h.total / h.count)}"
+                  f"  p50≤{ms(h.quantile(0.5))}  p99≤{ms(h.quantile(0.99))}")
+    if args.metrics:
+        print("\n".join(main.METRICS.summary_lines(top=12)))
+    if stats.stuck:
+        print(f"⚠ 進行しなくなった卓 {stats.stuck}")
+    return 1 if stats.stuck else 0
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="ヘッドレス負荷シミュレータ")
+    ap.add_argument("--tables", type=int, default=100, help="同時に進行する卓（チャンネル）数")
+    ap.add_argument("--players", type=int, default=5, help="1卓あたりの参加者数（ホスト含む）")
+    ap.add_argument("--tables-per-channel", type=int, default=1, help="1チャンネルに立てる卓数（2卓目からはスレッド）")
+    ap.add_argument("--max-live", type=int, default=0, help="メモリに置く卓の上限（--store と併用。0=既定）")
+    ap.add_argument("--rounds", type=int, default=2, help="1卓あたりのラウンド数")
+    ap.add_argument("--rest-latency", type=float, default=0.0, help="REST呼び出し1回の擬似遅延（秒）")
+    ap.add_argument("--think", type=float, default=0.0, help="操作間の思考時間の上限（秒）")
+    ap.add_argument("--ramp", type=float, default=0.5, help="卓の開始をこの秒数の範囲でばらす")
+    ap.add_argument("--anim-pool", type=int, default=4)
+    ap.add_argument("--store", action="store_true", help="一時ファイルの SQLite に保存しながら回す")
+    ap.add_argument("--settle-sinks", default="chat", help="精算の配送先（chat / jsonl / webhook をカンマ区切り。jsonl は一時ファイル）")
+    ap.add_argument("--channel-burst", type=int, default=0, help="チャンネル別の送信バケット（回。0=制限なし）")
+    ap.add_argument("--channel-per", type=float, default=5.0, help="--channel-burst 回ぶんが戻るまでの秒数")
+    ap.add_argument("--channel-urgent-burst", type=int, default=None, help="手番・結果だけが使える別枠（回。省略時は --channel-burst と同じ）")
+    ap.add_argument("--metrics", action="store_true", help="main.METRICS の集計（/chi_metrics と同じ内容）も出す")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    random.seed(args.seed)
+    main.RNG_SEED = f"sim:{args.seed}"      # 卓ごとの出目は卓・ラウンドだけで決まる（並行の順番に左右されない）
+    tmp = tempfile.mkdtemp(prefix="chi_sim_") if args.store else ""
+    main.STORE = main.GameStore(os.path.join(tmp, "games.db") if tmp else "")
+    main.ROLL_LOG = main.RollLog(os.path.join(tmp, "rolls") if tmp else "")
+    jsonl = os.path.join(tmp or tempfile.mkdtemp(prefix="chi_sim_"), "settlements.jsonl")
+    main.OUTBOX = main.SettlementOutbox(main.default_sinks(args.settle_sinks, jsonl))
+    urgent = args.channel_burst if args.channel_urgent_burst is None else args.channel_urgent_burst
+    main.OUTBOUND = main.OutboundScheduler(args.channel_burst, args.channel_per, urgent_burst=urgent)
+    if args.max_live:
+        main.GAMES.max_live = args.max_live
+    return asyncio.run(run(args))
+
+if __name__ == "__main__":
+    sys.exit(main_cli())